@@ -0,0 +1,100 @@
+"""Benchmark the memory and time of fusing 3D tiles, with and without
+low-memory fusion.
+
+Writes a synthetic 3D image whose chunks span `--z-chunk` planes, so that
+blocks are fused in 3D, and fuses it with multiview-stitcher's fusion and
+with `fuse_low_memory`. Peak memory is measured with tracemalloc, which
+tracks the numpy buffers allocated by all threads. Run from the repository
+root:
+
+    python benchmarks/fusion_memory_benchmark.py --num-z 32 --z-chunk 16
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import zarr
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tests"))
+from conftest import write_synthetic_image
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+
+
+def rechunk_z(zarr_url, z_chunk):
+    """Rewrite the full-resolution array with chunks spanning `z_chunk` planes."""
+    array = zarr.open(f"{zarr_url}/0", mode="r")
+    data, chunks = array[:], (*array.chunks[:-3], z_chunk, *array.chunks[-2:])
+    zarr.open(
+        f"{zarr_url}/0",
+        mode="w",
+        shape=data.shape,
+        chunks=chunks,
+        dtype=data.dtype,
+        dimension_separator="/",
+    )[:] = data
+
+
+def run(zarr_url, low_memory_fusion):
+    """Fuse an image in memory, returning the result, time and peak memory."""
+    image_context = ImageContext(zarr_url)
+    # sub-pixel corrections, as after registration
+    fov_corrections = {
+        fov: {"y": 0.3 * ifov, "x": -0.2 * ifov}
+        for ifov, fov in enumerate(image_context.fov_roi_table.index)
+    }
+    fused = fuse_fovs(
+        image_context, fov_corrections, low_memory_fusion=low_memory_fusion
+    )
+    tracemalloc.start()
+    start = time.perf_counter()
+    # compute block by block, as when writing to Zarr
+    result = np.empty(fused.shape, dtype=fused.dtype)
+    fused.data.store(result, lock=False)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak - result.nbytes
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-z", type=int, default=32)
+    parser.add_argument("--z-chunk", type=int, default=16)
+    parser.add_argument("--grid", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stage_errors = {f"FOV_{i + 1}": (0, 0) for i in range(args.grid * args.grid)}
+        zarr_url = write_synthetic_image(
+            f"{tmpdir}/plate.zarr/B/03/0",
+            stage_errors=stage_errors,
+            num_z=args.num_z,
+            num_columns=args.grid,
+        )
+        rechunk_z(zarr_url, args.z_chunk)
+        results = {}
+        for low_memory_fusion in [False, True]:
+            result, elapsed, peak = run(zarr_url, low_memory_fusion)
+            results[low_memory_fusion] = result
+            print(
+                f"low_memory_fusion={low_memory_fusion}: {elapsed:.1f} s, "
+                f"peak memory {peak / 1e6:.0f} MB ({args.grid}x{args.grid} FOVs, "
+                f"{args.num_z} planes, chunks of {args.z_chunk} planes)"
+            )
+        difference = np.abs(results[False].astype(int) - results[True])
+        print(
+            f"Max. difference {difference.max()} gray values, "
+            f"{np.mean(difference > 0):.1%} of the pixels differ"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark the sparse global optimization on large grids of tiles.
+
+Solves synthetic translation problems between horizontal and vertical
+neighbors of square grids of tiles, with noisy pairwise shifts and a
+fraction of outlier pairs. Run from the repository root:
+
+    python benchmarks/global_optimization_benchmark.py --max-tiles 10000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from fractal_ome_zarr_hcs_stitching.optimization_utils import solve_translations
+
+
+def make_grid_problem(grid, outlier_fraction, rng):
+    """Pairwise shifts between neighbors on a `grid` x `grid` tile grid."""
+    translations = rng.normal(scale=3, size=(grid * grid, 2))
+    index = np.arange(grid * grid).reshape(grid, grid)
+    pairs = np.concatenate(
+        [
+            np.stack([index[:, :-1].ravel(), index[:, 1:].ravel()], axis=1),
+            np.stack([index[:-1].ravel(), index[1:].ravel()], axis=1),
+        ]
+    )
+    shifts = (
+        translations[pairs[:, 0]]
+        - translations[pairs[:, 1]]
+        + rng.normal(scale=0.05, size=(len(pairs), 2))
+    )
+    outliers = rng.choice(len(pairs), int(outlier_fraction * len(pairs)), False)
+    shifts[outliers] += rng.choice([-1, 1], size=(len(outliers), 2)) * rng.uniform(
+        5, 20, size=(len(outliers), 2)
+    )
+    return translations, pairs, shifts
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-tiles", type=int, default=10000)
+    parser.add_argument("--outlier-fraction", type=float, default=0.01)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for grid in [10, 20, 40, 70, 100, 200]:
+        if grid * grid > args.max_tiles:
+            break
+        translations, pairs, shifts = make_grid_problem(
+            grid, args.outlier_fraction, rng
+        )
+        start = time.perf_counter()
+        solution, inliers = solve_translations(
+            len(translations), pairs, shifts, outlier_threshold=1
+        )
+        elapsed = time.perf_counter() - start
+        errors = solution - translations
+        errors -= errors.mean(axis=0)
+        print(
+            f"{grid * grid} tiles, {len(pairs)} pairs: {elapsed:.2f} s, "
+            f"{np.sum(~inliers)} pairs rejected, "
+            f"RMS error {np.sqrt(np.mean(errors**2)):.3f} pixels"
+        )
+
+
+if __name__ == "__main__":
+    main()
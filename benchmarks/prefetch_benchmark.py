@@ -0,0 +1,84 @@
+"""Benchmark fusion with and without prefetching on a high-latency store.
+
+Simulates a network filesystem or object store by delaying every chunk read
+from the local input image. Run from the repository root:
+
+    python benchmarks/prefetch_benchmark.py --latency 0.05 --workers 16
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+import zarr
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tests"))
+from conftest import write_synthetic_image
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs, write_fused_image
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+
+
+def delayed_getitem(zarr_url, latency):
+    """Delay every chunk read of the input image by `latency` seconds."""
+    getitem = zarr.storage.DirectoryStore.__getitem__
+
+    def __getitem__(self, key):
+        if self.path == zarr_url and not key.split("/")[-1].startswith("."):
+            time.sleep(latency)
+        return getitem(self, key)
+
+    return __getitem__
+
+
+def run(zarr_url, output_zarr_url, prefetch_workers):
+    """Fuse and write an image, returning the elapsed time in seconds.
+
+    Includes building the pyramid of the output, which is read without delay.
+    """
+    image_context = ImageContext(zarr_url, prefetch_workers=prefetch_workers)
+    start = time.perf_counter()
+    fused = fuse_fovs(image_context, {})
+    write_fused_image(image_context, fused, output_zarr_url, fov_corrections={})
+    elapsed = time.perf_counter() - start
+    image_context.log_cache_statistics()
+    return elapsed
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--grid", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stage_errors = {f"FOV_{i + 1}": (0, 0) for i in range(args.grid * args.grid)}
+        zarr_url = write_synthetic_image(
+            f"{tmpdir}/plate.zarr/B/03/0",
+            stage_errors=stage_errors,
+            num_columns=args.grid,
+            chunk_shape=(32, 32),
+        )
+        with mock.patch.object(
+            zarr.storage.DirectoryStore,
+            "__getitem__",
+            delayed_getitem(zarr_url, args.latency),
+        ):
+            for prefetch_workers in [None, args.workers]:
+                elapsed = run(
+                    zarr_url, f"{tmpdir}/fused_{prefetch_workers}", prefetch_workers
+                )
+                print(
+                    f"prefetch_workers={prefetch_workers}: {elapsed:.1f} s "
+                    f"({args.grid}x{args.grid} FOVs, {args.latency * 1000:.0f} ms "
+                    "latency per chunk)"
+                )
+
+
+if __name__ == "__main__":
+    main()
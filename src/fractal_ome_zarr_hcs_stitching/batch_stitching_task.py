@@ -0,0 +1,243 @@
+"""Stitches the FOVs of many OME-Zarr images in a single process."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from pydantic import validate_call
+
+from fractal_ome_zarr_hcs_stitching.cost_utils import log_stitching_cost
+from fractal_ome_zarr_hcs_stitching.image_context import (
+    ChunkCacheInputModel,
+    ImageContext,
+    LocalityAwareFusionInputModel,
+)
+from fractal_ome_zarr_hcs_stitching.stitching_task import (
+    check_stitching_modes,
+    estimate_image_cost,
+    fuse_image,
+    log_image_metadata,
+    register_image,
+)
+from fractal_ome_zarr_hcs_stitching.utils import (
+    GlobalOptimizationMethod,
+    HierarchicalRegistrationInputModel,
+    PreRegistrationPruningMethod,
+    RegistrationParallelizationInputModel,
+    StitchingChannelInputModel,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@validate_call
+def batch_stitching_task(
+    *,
+    # Fractal parameters
+    zarr_urls: list[str],
+    zarr_dir: str,
+    # Core parameters
+    channel: StitchingChannelInputModel,
+    overwrite_input: bool = False,
+    output_group_suffix: str = "fused",
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    global_optimization_method: GlobalOptimizationMethod = GlobalOptimizationMethod.ITERATIVE,  # noqa: E501
+    hierarchical_registration: Optional[HierarchicalRegistrationInputModel] = None,
+    input_cache: Optional[ChunkCacheInputModel] = None,
+    prefetch_workers: Optional[int] = None,
+    locality_aware_fusion: Optional[LocalityAwareFusionInputModel] = None,
+    low_memory_fusion: bool = False,
+    progress_file: Optional[str] = None,
+    fuse_labels: bool = False,
+    dry_run: bool = False,
+    incremental: bool = False,
+    incremental_content_checksums: bool = False,
+    preview: bool = False,
+) -> Optional[dict[str, list[dict[str, Any]]]]:
+    """Stitches the FOVs of many OME-Zarr images in a single process.
+
+    Works like `stitching_task` on each image, but for plates with many
+    small wells, where starting a process per image (imports, dask startup)
+    costs more than stitching it. The images are processed one after the
+    other: while an image is fused by a background thread, the FOVs of the
+    next image are registered in the main thread. Registration and fusion
+    do not share a worker pool. Dask keeps one pool per calling thread for
+    the whole batch, so that registration and fusion each use up to one
+    thread per CPU, and up to twice as many threads together. Set
+    `registration_parallelization` to bound the threads and memory of
+    registration while an image is fused.
+
+    Args:
+        zarr_urls: List of paths or urls to the individual OME-Zarr images
+            to be stitched.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        zarr_dir: path of the directory where the new OME-Zarrs will be
+            created. Not used by this task.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        channel: Channel for registration; requires either
+            `wavelength_id` (e.g. `A01_C01`) or `label` (e.g. `DAPI`), but not
+            both. Images without this channel are skipped.
+        overwrite_input: Whether to override the original, not stitched
+            images with the output of this task.
+        output_group_suffix: Suffix of the new OME-Zarr images to write the
+            fused images to.
+        registration_resolution_level: Resolution level to use for registration.
+        registration_on_z_proj: Whether to perform registration on a maximum
+            projection along z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting a subset
+            of all overlapping tiles for pairwise registration (see
+            `stitching_task`).
+        min_overlap_signal_fraction: If set, tile pairs are only registered
+            if at least this fraction of their overlap contains signal (see
+            `stitching_task`).
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many z planes around the
+            best-focus plane of each FOV are projected for registration.
+        registration_parallelization: If set, tile pairs are registered in
+            batches of a bounded size (see `stitching_task`).
+        global_optimization_method: Method to find the FOV positions
+            agreeing best with the registered tile pairs (see
+            `stitching_task`).
+        hierarchical_registration: If set, tile pairs are registered on a
+            coarse pyramid level first and only unreliable pairs are refined
+            on finer levels (see `stitching_task`).
+        input_cache: If set, chunks of each input image are staged in a
+            read-through cache in memory or on a node-local disk.
+        prefetch_workers: If set, chunks of the input images are read and
+            fused blocks are written concurrently by this many threads.
+        locality_aware_fusion: If set, output chunks are fused in an order
+            that reuses cached input chunks (see `stitching_task`).
+        low_memory_fusion: Whether to fuse FOVs in single precision and one
+            at a time (see `stitching_task`).
+        progress_file: Local path of a JSON file to which the progress of
+            fusing the current image is written periodically (see
+            `stitching_task`).
+        fuse_labels: Whether to also fuse the label images of the input
+            images with the same transforms.
+        dry_run: If set, only the costs of stitching each image are
+            estimated and logged (see `stitching_task`).
+        incremental: If set, existing fused images are updated where FOVs
+            changed since the last incremental run (see `stitching_task`).
+        incremental_content_checksums: If set together with `incremental`,
+            changed FOVs are detected by hashing their input chunks (see
+            `stitching_task`).
+        preview: If set, the images are stitched on their coarsest pyramid
+            level only, for a quick quality control (see `stitching_task`).
+
+    Returns:
+        Image list updates for Fractal of all stitched images, or None if
+        there are none.
+    """
+    logger.info(f"Running `batch_stitching_task` for {len(zarr_urls)} images")
+    check_stitching_modes(overwrite_input, incremental, preview)
+
+    if dry_run:
+        for zarr_url in zarr_urls:
+            logger.info(f"{zarr_url=}")
+            image_context = ImageContext(zarr_url)
+            try:
+                log_image_metadata(image_context)
+                log_stitching_cost(
+                    estimate_image_cost(
+                        image_context,
+                        output_group_suffix=output_group_suffix,
+                        registration_resolution_level=registration_resolution_level,
+                        registration_on_z_proj=registration_on_z_proj,
+                        pre_registration_pruning_method=pre_registration_pruning_method,
+                        min_overlap_signal_fraction=min_overlap_signal_fraction,
+                        hierarchical_registration=hierarchical_registration,
+                        low_memory_fusion=low_memory_fusion,
+                        incremental=incremental,
+                        incremental_content_checksums=incremental_content_checksums,
+                        preview=preview,
+                    )
+                )
+            finally:
+                image_context.close()
+        return None
+
+    def register(zarr_url):
+        logger.info(f"{zarr_url=}")
+        image_context = ImageContext(
+            zarr_url,
+            input_cache=input_cache,
+            prefetch_workers=prefetch_workers,
+            locality_aware_fusion=locality_aware_fusion,
+        )
+        try:
+            log_image_metadata(image_context)
+            registration = register_image(
+                image_context,
+                channel=channel,
+                output_group_suffix=output_group_suffix,
+                registration_resolution_level=registration_resolution_level,
+                registration_on_z_proj=registration_on_z_proj,
+                pre_registration_pruning_method=pre_registration_pruning_method,
+                min_overlap_signal_fraction=min_overlap_signal_fraction,
+                registration_focus_planes=registration_focus_planes,
+                registration_parallelization=registration_parallelization,
+                global_optimization_method=global_optimization_method,
+                hierarchical_registration=hierarchical_registration,
+                incremental=incremental,
+                incremental_content_checksums=incremental_content_checksums,
+                preview=preview,
+            )
+        except BaseException:
+            image_context.close()
+            raise
+        return image_context, registration
+
+    def fuse(image_context, registration):
+        try:
+            if registration is None:
+                return None
+            return fuse_image(
+                image_context,
+                registration,
+                overwrite_input=overwrite_input,
+                low_memory_fusion=low_memory_fusion,
+                fuse_labels=fuse_labels,
+                progress_file=progress_file,
+            )
+        finally:
+            image_context.close()
+
+    image_list_updates = []
+
+    def collect(zarr_url, fusion, num_processed):
+        updates = fusion.result()
+        if updates is not None:
+            image_list_updates.extend(updates["image_list_updates"])
+        logger.info(
+            f"Processed {zarr_url} ({num_processed} of {len(zarr_urls)} images)"
+        )
+
+    # A single fusion thread, so that dask keeps one worker pool for it.
+    # Registration stays in the main thread, as in `stitching_task`, and runs
+    # one image ahead of fusion.
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="fusion") as executor:
+        previous = None
+        for izarr_url, zarr_url in enumerate(zarr_urls):
+            image_context, registration = register(zarr_url)
+            if previous is not None:
+                collect(*previous, num_processed=izarr_url)
+            previous = (zarr_url, executor.submit(fuse, image_context, registration))
+        if previous is not None:
+            collect(*previous, num_processed=len(zarr_urls))
+
+    if not image_list_updates:
+        return None
+    return dict(image_list_updates=image_list_updates)
+
+
+if __name__ == "__main__":
+    from fractal_tasks_core.tasks._utils import run_fractal_task
+
+    run_fractal_task(task_function=batch_stitching_task)
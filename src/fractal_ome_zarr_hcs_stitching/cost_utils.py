@@ -0,0 +1,255 @@
+"""Estimate the resources needed to stitch an image from its metadata."""
+
+import json
+import logging
+import math
+from typing import Optional
+
+import dask
+import numpy as np
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import (
+    LOW_MEMORY_FUSION_BYTES_PER_PIXEL,
+)
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.utils import (
+    PreRegistrationPruningMethod,
+    estimate_pair_registration_bytes,
+    get_fov_msims,
+    get_registration_pairs,
+)
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_DIMS = ["z", "y", "x"]
+
+# Bytes per pixel and view held while fusing a block: the transformed views
+# and blending weights as float64, and their weighted product
+FUSION_BYTES_PER_VIEW_PIXEL = 3 * 8
+
+
+def _get_fused_extent(image_context: ImageContext) -> dict[str, tuple[float, float]]:
+    """Physical extent of the fused image, from the stage positions."""
+    fov_roi_table = image_context.fov_roi_table
+    extent = {}
+    for dim in ["y", "x"]:
+        origins = fov_roi_table[f"{dim}_micrometer_original"]
+        ends = origins + fov_roi_table[f"len_{dim}_micrometer"]
+        extent[dim] = (float(origins.min()), float(ends.max()))
+    return extent
+
+
+def count_tile_pairs(
+    image_context: ImageContext,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    changed_fovs: Optional[list[str]] = None,
+) -> int:
+    """Count the tile pairs registration would register.
+
+    Only uses the stage positions of the FOVs, no pixel data is read.
+
+    Args:
+        image_context: Metadata of the image.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs to register.
+        changed_fovs: If set, only pairs involving these FOVs are counted, as
+            registered by an incremental update.
+    """
+    msims, _ = get_fov_msims(
+        image_context,
+        resolution=registration_resolution_level,
+        project_z=registration_on_z_proj,
+    )
+    pairs = get_registration_pairs(
+        image_context,
+        msims,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+    )
+    if changed_fovs is None:
+        return len(pairs)
+    fov_names = list(image_context.fov_roi_table.index)
+    changed_indices = {fov_names.index(fov_name) for fov_name in changed_fovs}
+    return sum(a in changed_indices or b in changed_indices for a, b in pairs)
+
+
+def estimate_stitching_cost(
+    image_context: ImageContext,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    num_workers: Optional[int] = None,
+    low_memory_fusion: bool = False,
+    fusion_resolution: int = 0,
+    coarse_resolution_level: Optional[int] = None,
+    min_overlap_signal_fraction: Optional[float] = None,
+    changed_fovs: Optional[list[str]] = None,
+) -> dict:
+    """Estimate the resources needed to stitch an image.
+
+    Reads only the image metadata and the FOV ROI table. The output shape is
+    derived from the stage positions; registration typically changes it by a
+    few pixels. Sizes are uncompressed, i.e. upper bounds of the size on
+    disk. The peak memory is a rough estimate of the arrays held by the
+    concurrently fused blocks or registered pairs.
+
+    Which pairs pass the signal check of `min_overlap_signal_fraction`, and
+    which pairs hierarchical registration refines in their full overlap
+    rather than in a window, depends on the pixel data. The number of tile
+    pairs is then an upper bound, and the peak memory assumes that pairs are
+    refined in full on `registration_resolution_level`.
+
+    Args:
+        image_context: Metadata of the image.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs to register.
+        num_workers: Number of blocks or pairs processed concurrently. By
+            default, the number of threads of the dask scheduler.
+        low_memory_fusion: Whether blocks are fused with `fuse_low_memory`.
+        fusion_resolution: Resolution level to fuse on. The output has the
+            pyramid levels of the input from this level on.
+        coarse_resolution_level: If set, all pairs are registered on this
+            level first, as by hierarchical registration.
+        min_overlap_signal_fraction: If set, pairs without enough signal in
+            their overlap are skipped, which is checked on the coarsest
+            level.
+        changed_fovs: If set, only pairs involving these FOVs are registered,
+            as by an incremental update.
+
+    Returns:
+        Report with the input size, the output size and number of chunks per
+        pyramid level, the number of tile pairs to register, the bytes of
+        the levels read in full for registration and the peak memory, all
+        sizes in bytes.
+    """
+    ngff_image_meta = image_context.ngff_image_meta
+    axes = ngff_image_meta.axes_names
+    input_array = image_context.get_array(fusion_resolution)
+    itemsize = input_array.dtype.itemsize
+    scales = dict(zip(SPATIAL_DIMS, ngff_image_meta.pixel_sizes_zyx[fusion_resolution]))
+    chunks = dict(zip(axes, input_array.chunks))
+    num_workers = num_workers or dask.system.CPU_COUNT
+    fov_roi_table = image_context.fov_roi_table
+
+    # Output shape and chunks per pyramid level, as written by build_pyramid
+    extent = _get_fused_extent(image_context)
+    shape = dict(zip(axes, input_array.shape))
+    for dim, (start, end) in extent.items():
+        shape[dim] = round((end - start) / scales[dim])
+    output_levels = []
+    for level in range(ngff_image_meta.num_levels - fusion_resolution):
+        level_shape = {
+            dim: size // ngff_image_meta.coarsening_xy**level if dim in extent else size
+            for dim, size in shape.items()
+        }
+        output_levels.append(
+            {
+                "level": level,
+                "shape": [level_shape[dim] for dim in axes],
+                "bytes": math.prod(level_shape.values()) * itemsize,
+                "num_chunks": math.prod(
+                    math.ceil(level_shape[dim] / chunks[dim]) for dim in axes
+                ),
+            }
+        )
+
+    # Largest number of FOVs overlapping one output block
+    overlaps = []
+    for dim, (start, end) in extent.items():
+        block_size = chunks[dim] * scales[dim]
+        block_starts = np.arange(start, end, block_size)
+        fov_starts = fov_roi_table[f"{dim}_micrometer_original"].to_numpy()
+        fov_ends = fov_starts + fov_roi_table[f"len_{dim}_micrometer"].to_numpy()
+        overlaps.append(
+            (block_starts[:, None] < fov_ends[None])
+            & (block_starts[:, None] + block_size > fov_starts[None])
+        )
+    max_views_per_block = int(
+        np.einsum("if,jf->ij", *[o.astype(int) for o in overlaps]).max()
+    )
+    block_pixels = math.prod(
+        chunks[dim] for dim in axes if dim in SPATIAL_DIMS and dim in chunks
+    )
+    if low_memory_fusion:
+        # the input regions of the views and the single precision buffers
+        fusion_memory = (
+            num_workers
+            * block_pixels
+            * (max_views_per_block * itemsize + LOW_MEMORY_FUSION_BYTES_PER_PIXEL)
+        )
+    else:
+        fusion_memory = (
+            num_workers
+            * max_views_per_block
+            * block_pixels
+            * FUSION_BYTES_PER_VIEW_PIXEL
+        )
+
+    # Registration loads pairs of tiles at the registration level, after
+    # registering all of them on the coarse level if hierarchical
+    first_level = registration_resolution_level
+    if coarse_resolution_level is not None:
+        first_level = coarse_resolution_level
+    num_pairs = count_tile_pairs(
+        image_context,
+        registration_resolution_level=first_level,
+        registration_on_z_proj=registration_on_z_proj,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+        changed_fovs=changed_fovs,
+    )
+    registration_memory = min(
+        num_workers, max(num_pairs, 1)
+    ) * estimate_pair_registration_bytes(
+        image_context,
+        registration_resolution_level=registration_resolution_level,
+        registration_on_z_proj=registration_on_z_proj,
+    )
+    registration_levels = sorted({first_level, registration_resolution_level})
+    read_levels = {first_level}
+    if min_overlap_signal_fraction is not None:
+        read_levels.add(ngff_image_meta.num_levels - 1)
+
+    return {
+        "num_fovs": len(fov_roi_table),
+        "input_shape": list(input_array.shape),
+        "input_bytes": input_array.nbytes,
+        "registration_levels": registration_levels,
+        "registration_level_bytes": sum(
+            image_context.get_array(level).nbytes for level in read_levels
+        ),
+        "num_tile_pairs": num_pairs,
+        "num_tile_pairs_is_upper_bound": min_overlap_signal_fraction is not None,
+        "output_levels": output_levels,
+        "output_bytes": sum(level["bytes"] for level in output_levels),
+        "max_fovs_per_output_chunk": max_views_per_block,
+        "peak_memory_bytes": max(fusion_memory, registration_memory),
+    }
+
+
+def log_stitching_cost(report: dict):
+    """Log a report of `estimate_stitching_cost` for humans and machines."""
+    logger.info(
+        f"Input: {report['num_fovs']} FOVs, shape {report['input_shape']}, "
+        f"{report['input_bytes'] / 1e6:.1f} MB"
+    )
+    for level in report["output_levels"]:
+        logger.info(
+            f"Output level {level['level']}: shape {level['shape']}, "
+            f"{level['bytes'] / 1e6:.1f} MB in {level['num_chunks']} chunks"
+        )
+    at_most = "at most " if report["num_tile_pairs_is_upper_bound"] else ""
+    logger.info(
+        f"Tile pairs to register: {at_most}{report['num_tile_pairs']}, on "
+        f"levels {report['registration_levels']}"
+    )
+    logger.info(f"Estimated peak memory: {report['peak_memory_bytes'] / 1e6:.0f} MB")
+    logger.info(f"Stitching cost estimate: {json.dumps(report)}")
@@ -17,6 +17,31 @@ if __name__ == "__main__":
                 "fractal_ome_zarr_hcs_stitching",
                 "utils.py",
                 "StitchingChannelInputModel",
-            )
+            ),
+            (
+                "fractal_ome_zarr_hcs_stitching",
+                "utils.py",
+                "InitArgsPlateStitching",
+            ),
+            (
+                "fractal_ome_zarr_hcs_stitching",
+                "image_context.py",
+                "ChunkCacheInputModel",
+            ),
+            (
+                "fractal_ome_zarr_hcs_stitching",
+                "utils.py",
+                "RegistrationParallelizationInputModel",
+            ),
+            (
+                "fractal_ome_zarr_hcs_stitching",
+                "utils.py",
+                "HierarchicalRegistrationInputModel",
+            ),
+            (
+                "fractal_ome_zarr_hcs_stitching",
+                "image_context.py",
+                "LocalityAwareFusionInputModel",
+            ),
         ],
     )
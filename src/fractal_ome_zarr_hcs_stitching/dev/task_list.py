@@ -1,6 +1,10 @@
 """Contains the list of tasks available to fractal."""
 
-from fractal_tasks_core.dev.task_models import ParallelTask
+from fractal_tasks_core.dev.task_models import (
+    CompoundTask,
+    NonParallelTask,
+    ParallelTask,
+)
 
 TASK_LIST = [
     ParallelTask(
@@ -12,4 +16,24 @@ TASK_LIST = [
         category="Registration",
         tags=["multiview-stitcher", "Fusion", "Registration", "Stitching", "2D", "3D"],
     ),
+    CompoundTask(
+        name="Plate Stitching Task",
+        input_types={"stitched": False},
+        output_types={"stitched": True},
+        executable_init="init_plate_stitching_task.py",
+        executable="plate_stitching_task.py",
+        meta_init={"cpus_per_task": 1, "mem": 4000},
+        meta={"cpus_per_task": 1, "mem": 4000},
+        category="Registration",
+        tags=["multiview-stitcher", "Fusion", "Registration", "Stitching", "2D", "3D"],
+    ),
+    NonParallelTask(
+        name="Batch Stitching Task",
+        input_types={"stitched": False},
+        output_types={"stitched": True},
+        executable="batch_stitching_task.py",
+        meta={"cpus_per_task": 1, "mem": 4000},
+        category="Registration",
+        tags=["multiview-stitcher", "Fusion", "Registration", "Stitching", "2D", "3D"],
+    ),
 ]
@@ -0,0 +1,773 @@
+"""Fusion of the FOVs of an image and writing of the fused image.
+
+Besides the fusion of multiview-stitcher, tiles placed by translations can
+be fused with less memory by `fuse_low_memory`.
+"""
+
+import itertools
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+import dask
+import dask.array as da
+import dask.threaded
+import numpy as np
+import spatial_image as si
+import xarray as xr
+import zarr
+from dask import delayed
+from dask.optimization import cull
+from fractal_tasks_core.roi import get_single_image_ROI
+from fractal_tasks_core.tables import write_table
+from multiview_stitcher import fusion, msi_utils, mv_graph
+from multiview_stitcher import spatial_image_utils as si_utils
+from ome_zarr import writer
+from ome_zarr.io import parse_url
+from scipy import ndimage
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.io_utils import build_pyramid, count_pyramid_chunks
+from fractal_ome_zarr_hcs_stitching.progress_utils import (
+    PROGRESS_INTERVAL_SECONDS,
+    ProgressReporter,
+)
+from fractal_ome_zarr_hcs_stitching.store_utils import CountingStore, log_chunk_rereads
+from fractal_ome_zarr_hcs_stitching.utils import (
+    get_fov_msims,
+    set_fov_corrections,
+    write_fov_corrections,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bytes per pixel held while fusing a block in single precision: the
+# transformed view, its blending weights, the weighted sum and the sum of
+# weights
+LOW_MEMORY_FUSION_BYTES_PER_PIXEL = 4 * 4
+
+# Default of `multiview_stitcher.weights.get_blending_weights`
+DEFAULT_BLENDING_WIDTHS = {"z": 3, "y": 10, "x": 10}
+
+
+def _affine_transform(
+    data: np.ndarray,
+    spacing: np.ndarray,
+    origin: np.ndarray,
+    affine: np.ndarray,
+    output_properties: dict,
+    sdims: list[str],
+    cval: float,
+) -> np.ndarray:
+    """Resample an array into an output bounding box by linear interpolation.
+
+    Equivalent to `multiview_stitcher.transformation.transform_sim`, without
+    wrapping the arrays into spatial images, which dominates the time of
+    fusing small blocks.
+    """
+    ndim = len(sdims)
+    inverse = np.linalg.inv(affine)
+    output_spacing = np.array([output_properties["spacing"][dim] for dim in sdims])
+    output_origin = np.array([output_properties["origin"][dim] for dim in sdims])
+    matrix = np.diag(1 / spacing) @ inverse[:ndim, :ndim] @ np.diag(output_spacing)
+    offset = (inverse[:ndim, ndim] - origin + inverse[:ndim, :ndim] @ output_origin) / (
+        spacing
+    )
+    matrix, offset = np.around(matrix, decimals=10), np.around(offset, decimals=10)
+    # scipy takes a faster path for diagonal matrices, e.g. translations
+    if not np.any(matrix - np.diag(np.diag(matrix))):
+        matrix = np.diag(matrix)
+    return ndimage.affine_transform(
+        data,
+        matrix,
+        offset,
+        order=1,
+        output_shape=tuple(output_properties["shape"][dim] for dim in sdims),
+        mode="constant",
+        cval=cval,
+    )
+
+
+def _get_blending_support(
+    view_bb: dict, sdims: list[str], blending_widths: dict[str, float]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Coarse distance to the edges of a view, with its spacing and origin.
+
+    Interpolated into an output block and passed through a cosine ramp, it
+    gives the blending weights of `multiview_stitcher.weights.
+    get_blending_weights`.
+    """
+    mask = np.zeros([5] * len(sdims))
+    mask[(slice(1, -1),) * len(sdims)] = 1
+    shape = np.array([view_bb["shape"][dim] for dim in sdims])
+    view_spacing = np.array([view_bb["spacing"][dim] for dim in sdims])
+    # slightly enlarged, for smooth transitions at shared boundaries
+    spacing = (shape - 1) / 4 * view_spacing * (shape + 1) / (shape - 1)
+    origin = np.array([view_bb["origin"][dim] for dim in sdims]) - view_spacing
+    support = ndimage.distance_transform_edt(
+        mask, sampling=spacing / np.array([blending_widths[dim] for dim in sdims])
+    )
+    return support.astype(np.float32), spacing, origin
+
+
+def fuse_block_low_memory(
+    sims: list[xr.DataArray],
+    params: list[xr.DataArray],
+    output_properties: dict,
+    full_view_bbs: list[dict],
+    blending_widths: Optional[dict[str, float]] = None,
+) -> np.ndarray:
+    """Fuse the views overlapping one output block by weighted averaging.
+
+    Computes the same blending as `multiview_stitcher.fusion.fuse_np` with
+    `weighted_average_fusion`, but in single precision and one view at a
+    time: instead of all views, their blending weights and products in
+    double precision, only two accumulators and the current view are held.
+
+    Args:
+        sims: Regions of the views overlapping the block.
+        params: Affine transform of each view.
+        output_properties: Bounding box of the block.
+        full_view_bbs: Bounding box of each full view, to place the
+            blending weights.
+        blending_widths: Physical blending widths per spatial dimension.
+
+    Returns:
+        Fused block, in the dtype of the views. Integer intensities are
+        rounded to the nearest gray value.
+    """
+    if blending_widths is None:
+        blending_widths = DEFAULT_BLENDING_WIDTHS
+    input_dtype = sims[0].dtype
+    sdims = si_utils.get_spatial_dims_from_sim(sims[0])
+    shape = tuple(output_properties["shape"][dim] for dim in sdims)
+    weighted_sum = np.zeros(shape, dtype=np.float32)
+    weight_sum = np.zeros(shape, dtype=np.float32)
+    for sim, param, full_view_bb in zip(sims, params, full_view_bbs):
+        affine = np.asarray(param)
+        view = _affine_transform(
+            sim.data.astype(np.float32),
+            si_utils.get_spacing_from_sim(sim, asarray=True),
+            si_utils.get_origin_from_sim(sim, asarray=True),
+            affine,
+            output_properties,
+            sdims,
+            cval=np.nan,
+        )
+        support, spacing, origin = _get_blending_support(
+            full_view_bb, sdims, blending_widths
+        )
+        view_weights = _affine_transform(
+            support, spacing, origin, affine, output_properties, sdims, cval=0
+        )
+        # cosine ramp towards the edges of the view
+        ramp = view_weights < 1
+        view_weights[ramp] = (np.cos((1 - view_weights[ramp]) * np.pi) + 1) / 2
+        np.clip(view_weights, 0, 1, out=view_weights)
+        invalid = np.isnan(view)
+        view_weights[invalid] = 0
+        view[invalid] = 0
+        view *= view_weights
+        weighted_sum += view
+        weight_sum += view_weights
+    weight_sum[weight_sum == 0] = 1
+    weighted_sum /= weight_sum
+    if np.issubdtype(input_dtype, np.integer):
+        # round to the nearest gray value instead of truncating towards zero
+        np.rint(weighted_sum, out=weighted_sum)
+        dtype_info = np.iinfo(input_dtype)
+        np.clip(weighted_sum, dtype_info.min, dtype_info.max, out=weighted_sum)
+    return weighted_sum.astype(input_dtype)
+
+
+def _stack_blocks(blocks: np.ndarray) -> da.Array:
+    """Stack an object array of equally shaped arrays along new leading axes."""
+    if blocks.ndim == 0:
+        return blocks[()]
+    return da.stack([_stack_blocks(blocks[i, ...]) for i in range(len(blocks))])
+
+
+def fuse_low_memory(
+    sims: list[xr.DataArray],
+    transform_key: str,
+    output_chunksize: Union[int, dict[str, int]],
+    output_spacing: Optional[dict[str, float]] = None,
+    blending_widths: Optional[dict[str, float]] = None,
+) -> xr.DataArray:
+    """Fuse views like `multiview_stitcher.fusion.fuse`, with less memory.
+
+    The output has the same geometry (union of the views) and chunks as
+    `multiview_stitcher.fusion.fuse` with its default weighted average
+    fusion, and each block is fused by `fuse_block_low_memory`. Integer
+    intensities are rounded to the nearest gray value, where
+    `multiview_stitcher.fusion.fuse` truncates, so they may be higher by one.
+
+    Args:
+        sims: Input views.
+        transform_key: Transform key placing the views.
+        output_chunksize: Chunksize of the fused image per spatial dimension.
+        output_spacing: Spacing of the fused image. By default, the spacing
+            of the first view.
+        blending_widths: Physical blending widths per spatial dimension.
+
+    Returns:
+        Lazy fused image.
+    """
+    sdims = si_utils.get_spatial_dims_from_sim(sims[0])
+    nsdims = [dim for dim in sims[0].dims if dim not in sdims]
+    if isinstance(output_chunksize, int):
+        output_chunksize = {dim: output_chunksize for dim in sdims}
+    if output_spacing is None:
+        output_spacing = si_utils.get_spacing_from_sim(sims[0])
+
+    params = [
+        si_utils.get_affine_from_sim(sim, transform_key=transform_key) for sim in sims
+    ]
+    output_stack_properties = fusion.calc_fusion_stack_properties(
+        sims, params=params, spacing=output_spacing, mode="union"
+    )
+    output_chunk_bbs, block_indices = mv_graph.get_chunk_bbs(
+        output_stack_properties, output_chunksize
+    )
+    views_bb = [si_utils.get_stack_properties_from_sim(sim) for sim in sims]
+
+    ns_blocks = np.empty([len(sims[0].coords[nsdim]) for nsdim in nsdims], dtype=object)
+    for ns_index in np.ndindex(ns_blocks.shape):
+        sim_coord_dict = {
+            nsdim: sims[0].coords[nsdim].values[i] for nsdim, i in zip(nsdims, ns_index)
+        }
+        sparams = [
+            param.sel(
+                {
+                    nsdim: coord
+                    for nsdim, coord in sim_coord_dict.items()
+                    if nsdim in param.dims
+                }
+            )
+            for param in params
+        ]
+
+        # dimensions along which views are only shifted by whole pixels need
+        # no interpolation margin, as in `multiview_stitcher.fusion.fuse`
+        fix_dims = []
+        for dim in sdims:
+            other_dims = [odim for odim in sdims if odim != dim]
+            if (
+                any((param.sel(x_in=dim, x_out=dim) - 1) for param in sparams)
+                or any(any(param.sel(x_in=dim, x_out=other_dims)) for param in sparams)
+                or any(any(param.sel(x_in=other_dims, x_out=dim)) for param in sparams)
+                or any(
+                    output_stack_properties["spacing"][dim] - view_bb["spacing"][dim]
+                    for view_bb in views_bb
+                )
+                or any(
+                    float(
+                        output_stack_properties["origin"][dim]
+                        - param.sel(x_in=dim, x_out="1")
+                    )
+                    % output_stack_properties["spacing"][dim]
+                    for param in sparams
+                )
+            ):
+                continue
+            fix_dims.append(dim)
+
+        spatial_blocks = np.empty(np.max(block_indices, 0) + 1, dtype=object)
+        for output_chunk_bb, block_index in zip(output_chunk_bbs, block_indices):
+            block_shape = tuple(output_chunk_bb["shape"][dim] for dim in sdims)
+            views_overlap_bb = [
+                mv_graph.get_overlap_for_bbs(
+                    target_bb=output_chunk_bb,
+                    query_bbs=[view_bb],
+                    param=sparams[iview],
+                    additional_extent_in_pixels={
+                        dim: 0 if dim in fix_dims else 1 for dim in sdims
+                    },
+                )[0]
+                for iview, view_bb in enumerate(views_bb)
+            ]
+            relevant_views = [
+                iview
+                for iview, view_overlap_bb in enumerate(views_overlap_bb)
+                if view_overlap_bb is not None
+            ]
+            if not relevant_views:
+                spatial_blocks[tuple(block_index)] = da.zeros(
+                    block_shape, dtype=sims[0].dtype
+                )
+                continue
+
+            tol = 1e-6
+            sims_slices = [
+                sims[iview].sel(
+                    sim_coord_dict
+                    | {
+                        dim: slice(
+                            views_overlap_bb[iview]["origin"][dim] - tol,
+                            views_overlap_bb[iview]["origin"][dim]
+                            + (views_overlap_bb[iview]["shape"][dim] - 1)
+                            * views_overlap_bb[iview]["spacing"][dim]
+                            + tol,
+                        )
+                        for dim in sdims
+                    },
+                    drop=True,
+                )
+                for iview in relevant_views
+            ]
+            block_bb = output_chunk_bb
+            block_params = [sparams[iview] for iview in relevant_views]
+            full_view_bbs = [views_bb[iview] for iview in relevant_views]
+
+            # fuse single planes in 2D, to avoid weighting edge artifacts
+            fuse_planewise = "z" in fix_dims and output_chunk_bb["shape"]["z"] == 1
+            if fuse_planewise:
+                sims_slices = [sim.isel(z=0) for sim in sims_slices]
+                block_params = [
+                    param.sel(x_in=["y", "x", "1"], x_out=["y", "x", "1"])
+                    for param in block_params
+                ]
+                block_bb = mv_graph.project_bb_along_dim(block_bb, dim="z")
+                full_view_bbs = [
+                    mv_graph.project_bb_along_dim(view_bb, dim="z")
+                    for view_bb in full_view_bbs
+                ]
+
+            fused_block = delayed(fuse_block_low_memory)(
+                sims=sims_slices,
+                params=block_params,
+                output_properties=block_bb,
+                full_view_bbs=full_view_bbs,
+                blending_widths=blending_widths,
+            )
+            fused_block = da.from_delayed(
+                fused_block,
+                shape=block_shape[1:] if fuse_planewise else block_shape,
+                dtype=sims[0].dtype,
+            )
+            if fuse_planewise:
+                fused_block = fused_block[np.newaxis]
+            spatial_blocks[tuple(block_index)] = fused_block
+
+        ns_blocks[ns_index] = da.block(spatial_blocks.tolist())
+
+    fused = si.to_spatial_image(
+        _stack_blocks(ns_blocks),
+        dims=nsdims + list(sdims),
+        scale=output_stack_properties["spacing"],
+        translation=output_stack_properties["origin"],
+    )
+    fused = fused.assign_coords(
+        {nsdim: sims[0].coords[nsdim].values for nsdim in nsdims}
+    )
+    logger.info(f"Fusing {len(sims)} views in single precision, one at a time")
+    return fused
+
+
+def fuse_fovs(
+    image_context: ImageContext,
+    fov_corrections: dict[str, dict[str, float]],
+    transform_key: str = "fractal_input",
+    fusion_transform_key: str = "translation_registered",
+    resolution: int = 0,
+    low_memory_fusion: bool = False,
+) -> xr.DataArray:
+    """Build the graph fusing the FOVs of an image.
+
+    Args:
+        image_context: Metadata of the image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as returned by `register_fovs`.
+        transform_key: Transform key of the stage positions.
+        fusion_transform_key: Transform key of the corrected positions.
+        resolution: Resolution level to fuse the FOVs on. The output has the
+            pixel size and chunks of this level.
+        low_memory_fusion: Whether to fuse with `fuse_low_memory`, in single
+            precision and one FOV at a time.
+
+    Returns:
+        Lazy fused image, with the axes of the input image and the physical
+        coordinates of the fused spatial dimensions.
+    """
+    msims, sdims = get_fov_msims(
+        image_context, resolution=resolution, transform_key=transform_key
+    )
+    set_fov_corrections(
+        msims,
+        image_context.fov_roi_table.index,
+        fov_corrections,
+        base_transform_key=transform_key,
+        transform_key=fusion_transform_key,
+    )
+    sims = [msi_utils.get_sim_from_msim(msim) for msim in msims]
+    ndim = len(sdims)
+
+    logger.info(f"Started fusion using transform key {fusion_transform_key}")
+
+    input_chunksize = image_context.get_array(resolution).chunks
+    output_chunksize = {
+        dim: input_chunksize[(-ndim + idim)] for idim, dim in enumerate(sdims)
+    }
+    logger.info(f"Output chunksize: {output_chunksize}")
+    logger.info("Started building fusion graph")
+
+    if low_memory_fusion:
+        fused = fuse_low_memory(
+            sims,
+            transform_key=fusion_transform_key,
+            output_chunksize=output_chunksize,
+            output_spacing=si_utils.get_spacing_from_sim(sims[0]),
+        )
+    else:
+        fused = fusion.fuse(
+            sims,
+            transform_key=fusion_transform_key,
+            output_chunksize=output_chunksize,
+            output_spacing=si_utils.get_spacing_from_sim(sims[0]),
+            # fusion_func=fusion.max_fusion,
+        )
+
+    fused = fused.sel(t=0, drop=True)
+
+    if "z" not in fused.dims:
+        fused = fused.expand_dims(
+            "z", image_context.ngff_image_meta.axes_names.index("z")
+        )
+
+    fused = fused.sel({"c": fused.coords["c"].values})
+
+    logger.info("Finished building fusion graph")
+
+    return fused
+
+
+def get_input_chunk_keys(
+    image_context: ImageContext,
+    fov_corrections: dict[str, dict[str, float]],
+    fused: xr.DataArray,
+    margin: int = 1,
+    resolution: int = 0,
+) -> dict[tuple[int, ...], list[str]]:
+    """Find the input chunks each block of a fused image is computed from.
+
+    The chunks are derived from the geometry of the tiles, which is cheaper
+    and more reliable than walking the fusion graph.
+
+    Args:
+        image_context: Metadata of the input image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used for fusion.
+        fused: Fused image, as returned by `fuse_fovs`.
+        margin: Number of pixels to add around the region of each tile that
+            overlaps a block, to account for interpolation.
+        resolution: Resolution level the image was fused on.
+
+    Returns:
+        Store keys of the input chunks per block index of the fused array.
+    """
+    array = image_context.get_array(resolution)
+    axes = image_context.ngff_image_meta.axes_names
+    scales = dict(
+        zip(["z", "y", "x"], image_context.ngff_image_meta.pixel_sizes_zyx[resolution])
+    )
+    # dimensions placed by the tile positions; others map one-to-one
+    fused_sdims = [dim for dim in ["z", "y", "x"] if dim in fused.coords]
+
+    tiles = []
+    for fov_name, row in image_context.fov_roi_table.iterrows():
+        corrections = fov_corrections.get(fov_name, {})
+        tiles.append(
+            {
+                dim: (
+                    round(row[f"{dim}_micrometer"] / scales[dim]),
+                    round(row[f"len_{dim}_micrometer"] / scales[dim]),
+                    (row[f"{dim}_micrometer_original"] if dim != "z" else 0)
+                    + corrections.get(dim, 0),
+                )
+                for dim in fused_sdims
+            }
+        )
+
+    block_starts = [np.cumsum((0, *chunks)) for chunks in fused.data.chunks]
+    chunk_keys = {}
+    for block in np.ndindex(fused.data.numblocks):
+        block_slices = {
+            dim: slice(block_starts[iaxis][iblock], block_starts[iaxis][iblock + 1])
+            for iaxis, (dim, iblock) in enumerate(zip(axes, block))
+        }
+        keys = set()
+        for tile in tiles:
+            pixel_ranges = []
+            for iaxis, dim in enumerate(axes):
+                start, stop = block_slices[dim].start, block_slices[dim].stop - 1
+                if dim in tile:
+                    roi_start, roi_len, origin = tile[dim]
+                    coords = fused.coords[dim].values
+                    start = int(np.floor((coords[start] - origin) / scales[dim]))
+                    stop = int(np.ceil((coords[stop] - origin) / scales[dim]))
+                    start = max(start - margin, 0) + roi_start
+                    stop = min(stop + margin, roi_len - 1) + roi_start
+                stop = min(stop, array.shape[iaxis] - 1)
+                if start > stop:
+                    break
+                pixel_ranges.append(
+                    range(start // array.chunks[iaxis], stop // array.chunks[iaxis] + 1)
+                )
+            else:
+                keys.update(
+                    array._chunk_key(chunk)
+                    for chunk in itertools.product(*pixel_ranges)
+                )
+        chunk_keys[block] = sorted(keys)
+    return chunk_keys
+
+
+def store_fused_blocks(
+    image_context: ImageContext,
+    fused_da: da.Array,
+    output_zarr_arr: zarr.Array,
+    chunk_keys: dict[tuple[int, ...], list[str]],
+    blocks: Optional[list[tuple[int, ...]]] = None,
+    progress: Optional[ProgressReporter] = None,
+):
+    """Compute and store (some of) the blocks of a fused array in batches.
+
+    If the image context prefetches, the input chunks of the next batch are
+    read meanwhile, and the blocks of a batch are written concurrently by
+    as many threads while the next batch is fused, which keeps high-latency
+    stores like object stores busy. The graph is optimized once and culled
+    per batch, as optimizing the full fusion graph for every batch would
+    cost more than the prefetching saves.
+
+    Args:
+        image_context: Metadata of the input image.
+        fused_da: Fused array.
+        output_zarr_arr: Array to store the blocks in, chunked like
+            `fused_da`.
+        chunk_keys: Input chunk keys per block, as returned by
+            `get_input_chunk_keys`. Blocks without keys are not prefetched.
+        blocks: Indices of the blocks to store. By default, all blocks.
+            With locality-aware fusion, they are stored in its block order,
+            otherwise in the given order.
+        progress: If set, counts the stored blocks.
+    """
+    if blocks is None:
+        blocks = list(np.ndindex(fused_da.numblocks))
+    if not blocks:
+        return
+    if image_context.locality_aware_fusion is not None:
+        blocks = image_context.locality_aware_fusion.block_order.sort_blocks(blocks)
+    batch_size = max(dask.system.CPU_COUNT, 1)
+    batches = [
+        blocks[start : start + batch_size]
+        for start in range(0, len(blocks), batch_size)
+    ]
+    block_starts = [np.cumsum((0, *chunks)) for chunks in fused_da.chunks]
+    (fused_da,) = dask.optimize(fused_da)
+    graph = dict(fused_da.__dask_graph__())
+
+    def batch_keys(batch):
+        return {key for block in batch for key in chunk_keys.get(block, [])}
+
+    def store_block(block, data):
+        output_zarr_arr[
+            tuple(
+                slice(starts[iblock], starts[iblock + 1])
+                for starts, iblock in zip(block_starts, block)
+            )
+        ] = data
+        if progress is not None:
+            progress.update()
+
+    image_context.prefetch(sorted(batch_keys(batches[0])))
+    with ThreadPoolExecutor(
+        max_workers=image_context.prefetch_workers or 1, thread_name_prefix="write"
+    ) as write_executor:
+        pending_writes = []
+        for ibatch, batch in enumerate(batches):
+            next_keys = set()
+            if ibatch + 1 < len(batches):
+                next_keys = batch_keys(batches[ibatch + 1])
+                image_context.prefetch(sorted(next_keys))
+            task_keys = [(fused_da.name, *block) for block in batch]
+            batch_graph, _ = cull(graph, task_keys)
+            results = dask.threaded.get(batch_graph, task_keys)
+            # hold at most two batches of results in memory
+            for write in pending_writes:
+                write.result()
+            pending_writes = [
+                write_executor.submit(store_block, block, data)
+                for block, data in zip(batch, results)
+            ]
+            # free prefetched chunks that are not needed by the next batch
+            image_context.discard_prefetched(sorted(batch_keys(batch) - next_keys))
+        for write in pending_writes:
+            write.result()
+
+
+def write_fused_image(
+    image_context: ImageContext,
+    fused: xr.DataArray,
+    output_zarr_url: str,
+    fov_corrections: Optional[dict[str, dict[str, float]]] = None,
+    resolution: int = 0,
+    progress_file: Optional[str] = None,
+    progress_interval: float = PROGRESS_INTERVAL_SECONDS,
+):
+    """Write a fused image, its pyramid, metadata and ROI table.
+
+    If the image context prefetches or fuses locality-aware, the fused image
+    is computed in batches of blocks (see `store_fused_blocks`). Prefetching
+    reads the input chunks of the next batch in the background meanwhile.
+    The progress of fusion and of building the pyramid is reported
+    periodically (see `ProgressReporter`), and the re-read ratio of the input
+    chunks after fusion (see `log_chunk_rereads`).
+
+    Args:
+        image_context: Metadata of the input image.
+        fused: Fused image, as returned by `fuse_fovs`.
+        output_zarr_url: Path of the new OME-Zarr image.
+        fov_corrections: Corrections used for fusion, needed to find the
+            input chunks to prefetch. If set, they are recorded in the
+            attributes of the new image (see `read_fov_corrections`).
+        resolution: Resolution level the image was fused on. The output has
+            the pyramid levels of the input from this level on.
+        progress_file: Local path of a JSON file to write the progress
+            reports to, e.g. for a scheduler to poll.
+        progress_interval: Seconds between two progress reports.
+    """
+    ngff_image_meta = image_context.ngff_image_meta
+    num_levels = ngff_image_meta.num_levels - resolution
+    fused_da = fused.data
+    output_store = CountingStore(
+        zarr.storage.normalize_store_arg(f"{output_zarr_url}/0", mode="w")
+    )
+
+    # Open output array. This allows setting `write_empty_chunks=True`,
+    # which cannot be passed to dask.array.to_zarr below.
+    output_zarr_arr = zarr.open(
+        output_store,
+        shape=fused_da.shape,
+        chunks=fused_da.chunksize,
+        dtype=fused_da.dtype,
+        write_empty_chunks=False,
+        dimension_separator="/",
+        fill_value=0,
+        mode="w",
+    )
+
+    logger.info("Started fusion computation")
+
+    reads_before = image_context.counting_store.key_reads.copy()
+    with ProgressReporter(
+        "fusion",
+        math.prod(fused_da.numblocks),
+        stores=[image_context.counting_store, output_store],
+        interval=progress_interval,
+        progress_file=progress_file,
+    ) as progress:
+        if (
+            image_context.prefetch_workers
+            or image_context.locality_aware_fusion is not None
+        ):
+            chunk_keys = {}
+            if image_context.prefetch_workers:
+                chunk_keys = get_input_chunk_keys(
+                    image_context, fov_corrections or {}, fused, resolution=resolution
+                )
+            store_fused_blocks(
+                image_context,
+                fused_da,
+                output_zarr_arr,
+                chunk_keys,
+                progress=progress,
+            )
+        else:
+            # Write the fused array back to the same full-resolution Zarr array
+            progress.track(fused_da).to_zarr(
+                output_zarr_arr,
+                overwrite=True,
+                dimension_separator="/",
+                return_stored=False,
+                compute=True,
+            )
+
+    log_chunk_rereads(image_context.counting_store, reads_before)
+    logger.info("Finished fusion computation")
+    logger.info("Started building resolution pyramid")
+
+    # Starting from on-disk full-resolution data, build and write to disk a
+    # pyramid of coarser levels
+    # Provide original chunksize to avoid "ValueError: Attempt to save array
+    # to zarr with irregular chunking, please call `arr.rechunk(...)` first."
+    chunksize = image_context.get_array(resolution).chunks
+    with ProgressReporter(
+        "pyramid",
+        count_pyramid_chunks(
+            fused_da.shape, num_levels, ngff_image_meta.coarsening_xy, chunksize
+        ),
+        interval=progress_interval,
+        progress_file=progress_file,
+    ) as progress:
+        build_pyramid(
+            output_zarr_url,
+            num_levels=num_levels,
+            chunksize=chunksize,
+            coarsening_xy=ngff_image_meta.coarsening_xy,
+            open_array_kwargs={"write_empty_chunks": False, "fill_value": 0},
+            progress=progress,
+        )
+
+    # attach metadata to the fused image
+    store = parse_url(output_zarr_url, mode="w").store
+    output_group = zarr.group(store=store)
+    writer.write_multiscales_metadata(
+        group=output_group,
+        axes=ngff_image_meta.axes_names,
+        datasets=[
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {
+                        "type": coordinateTransformation.type,
+                        "scale": coordinateTransformation.scale,
+                    }
+                    for coordinateTransformation in fractal_ds.coordinateTransformations
+                ],
+            }
+            for level, fractal_ds in enumerate(
+                ngff_image_meta.multiscales[0].datasets[
+                    resolution : ngff_image_meta.num_levels
+                ]
+            )
+        ],
+    )
+    output_group.attrs["omero"] = ngff_image_meta.omero.model_dump()
+
+    # Workaround: Manually add wavelength_id attr back to omero channel
+    original_omero_attrs = image_context.attrs["omero"]["channels"]
+    for i, omero_channel in enumerate(output_group.attrs["omero"]["channels"]):
+        omero_channel["wavelength_id"] = original_omero_attrs[i]["wavelength_id"]
+    output_attrs = output_group.attrs
+    output_group.attrs["omero"] = dict(output_attrs["omero"])
+    if fov_corrections is not None:
+        write_fov_corrections(output_zarr_url, fov_corrections)
+
+    logger.info("Finished building resolution pyramid")
+
+    # Add ROI table to the image
+    pixels_ZYX = (
+        ngff_image_meta.multiscales[0]
+        .datasets[resolution]
+        .coordinateTransformations[0]
+        .scale[-3:]
+    )
+    image_ROI_table = get_single_image_ROI(fused_da.shape, pixels_ZYX=pixels_ZYX)
+    write_table(
+        output_group,
+        "well_ROI_table",  # Could also be image_ROI_table
+        image_ROI_table,
+        overwrite=True,
+        table_attrs={"type": "roi_table"},
+    )
@@ -0,0 +1,318 @@
+"""Coarse-to-fine registration of the FOVs of an image."""
+
+import logging
+from typing import Optional
+
+import numpy as np
+from multiview_stitcher import msi_utils, param_utils
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.optimization_utils import solve_translations
+from fractal_ome_zarr_hcs_stitching.utils import (
+    OUTLIER_THRESHOLD_PIXELS,
+    HierarchicalRegistrationInputModel,
+    PreRegistrationPruningMethod,
+    RegistrationParallelizationInputModel,
+    get_focus_z_slices,
+    get_num_parallel_pairs,
+    get_registration_msims,
+    get_registration_pairs,
+    register_pairs,
+    set_fov_corrections,
+)
+
+logger = logging.getLogger(__name__)
+
+# Transform key of the FOV positions estimated on a coarser level
+ESTIMATE_TRANSFORM_KEY = "translation_estimated"
+
+
+def _register_pairs(
+    msims,
+    pairs: list[tuple[int, int]],
+    reg_spatial_dims: list[str],
+    transform_key: str,
+    num_parallel_pairs: Optional[int],
+) -> tuple[np.ndarray, np.ndarray]:
+    """Register tile pairs, returning their shifts and qualities."""
+    pair_params = register_pairs(
+        msims,
+        pairs,
+        reg_spatial_dims=reg_spatial_dims,
+        transform_key=transform_key,
+        num_parallel_pairs=num_parallel_pairs,
+    )
+    shifts = np.array(
+        [
+            param_utils.translation_from_affine(params["transform"].sel(t=0).data)
+            for params in pair_params
+        ]
+    )
+    qualities = np.array([float(params["quality"].mean()) for params in pair_params])
+    return shifts, qualities
+
+
+def _crop_to_overlap_window(
+    msims,
+    pair: tuple[int, int],
+    translations: np.ndarray,
+    reg_spatial_dims: list[str],
+    window_size: dict[str, float],
+) -> list:
+    """Crop the tiles of a pair to a window centered in their expected overlap.
+
+    Args:
+        msims: Tiles of the registration channel.
+        pair: Indices of the tiles of the pair.
+        translations: Estimated translation of each tile.
+        reg_spatial_dims: Spatial dimensions of the tiles and translations.
+        window_size: Physical size of the window per dimension to crop.
+
+    Returns:
+        The two cropped tiles, or the uncropped tiles if they do not overlap
+        at their estimated positions.
+    """
+    sims = [msi_utils.get_sim_from_msim(msims[itile]) for itile in pair]
+    windows = {}
+    for idim, dim in enumerate(reg_spatial_dims):
+        if dim not in window_size:
+            continue
+        start = max(
+            float(sim.coords[dim][0]) + translations[itile, idim]
+            for sim, itile in zip(sims, pair)
+        )
+        stop = min(
+            float(sim.coords[dim][-1]) + translations[itile, idim]
+            for sim, itile in zip(sims, pair)
+        )
+        if start >= stop:
+            return [msims[itile] for itile in pair]
+        center = (start + stop) / 2
+        windows[idim, dim] = (
+            max(start, center - window_size[dim] / 2),
+            min(stop, center + window_size[dim] / 2),
+        )
+    # Tile coordinates are the stage positions, without the translations
+    return [
+        msi_utils.get_msim_from_sim(
+            sim.sel(
+                {
+                    dim: slice(
+                        start - translations[itile, idim],
+                        stop - translations[itile, idim],
+                    )
+                    for (idim, dim), (start, stop) in windows.items()
+                }
+            ),
+            scale_factors=[],
+        )
+        for sim, itile in zip(sims, pair)
+    ]
+
+
+def register_fovs_hierarchically(
+    image_context: ImageContext,
+    reg_channel_index: int,
+    hierarchical_registration: HierarchicalRegistrationInputModel,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    transform_key: str = "fractal_input",
+) -> dict[str, dict[str, float]]:
+    """Register the FOVs of an image from a coarse to a fine level.
+
+    The tile pairs are selected on the coarse level as in `register_fovs`
+    and registered there. The FOV translations are solved for by sparse
+    least squares (see `solve_translations`). On each finer level, down to
+    the registration resolution level, the pairs with a quality below
+    `min_quality` or rejected as outliers, i.e. with a residual above
+    `OUTLIER_THRESHOLD_PIXELS` pixels of that level, are registered again.
+    This includes pairs accepted on a coarser level that disagree with the
+    others at the precision of the finer level. The tiles are placed at the
+    estimated positions, so that only their expected overlap is read and
+    registered, and the translations are solved for again. On the
+    registration resolution level, all other pairs are registered too, but
+    only in a window of `window_size` pixels centered in their expected
+    overlap, so that every pair reaches the accuracy of that level.
+
+    Args:
+        image_context: Metadata of the image.
+        reg_channel_index: Index of the channel to use for registration.
+        hierarchical_registration: Levels and thresholds of the
+            refinement.
+        registration_resolution_level: Finest resolution level to refine
+            pairs on.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs to register.
+        min_overlap_signal_fraction: If set, only tile pairs with signal in
+            their overlap are registered, see `get_pairs_with_signal`.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many planes around the
+            best-focus plane of each FOV are projected.
+        registration_parallelization: If set, bounds the number of tile
+            pairs registered at the same time.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Translation (in micrometer) correcting the stage position of each FOV,
+        keyed by FOV name and spatial dimension. Empty if no overlapping
+        tiles were found.
+    """
+    ngff_image_meta = image_context.ngff_image_meta
+    coarse_level = hierarchical_registration.get_coarse_level(
+        ngff_image_meta.num_levels, registration_resolution_level
+    )
+    fov_names = list(image_context.fov_roi_table.index)
+
+    z_slices = None
+    if registration_on_z_proj and registration_focus_planes is not None:
+        z_slices = get_focus_z_slices(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            num_planes=registration_focus_planes,
+        )
+
+    def get_level_msims(level):
+        return get_registration_msims(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            resolution=level,
+            project_z=registration_on_z_proj,
+            transform_key=transform_key,
+            z_slices=z_slices,
+        )
+
+    def get_num_pairs(level):
+        return get_num_parallel_pairs(
+            image_context,
+            registration_parallelization,
+            registration_resolution_level=level,
+            registration_on_z_proj=registration_on_z_proj,
+        )
+
+    def get_pixel_size(level):
+        return max(ngff_image_meta.pixel_sizes_zyx[level][-2:])
+
+    msims, reg_spatial_dims = get_level_msims(coarse_level)
+    pairs = list(
+        get_registration_pairs(
+            image_context,
+            msims,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            reg_channel_index=reg_channel_index,
+            transform_key=transform_key,
+        )
+    )
+    if not pairs:
+        logger.warning(
+            "Did not find overlapping tiles for stitching. Skipping registration."
+        )
+        return {}
+
+    logger.info(f"Registering {len(pairs)} tile pairs on level {coarse_level}")
+    shifts, qualities = _register_pairs(
+        msims,
+        pairs,
+        reg_spatial_dims,
+        transform_key=transform_key,
+        num_parallel_pairs=get_num_pairs(coarse_level),
+    )
+
+    def solve(level):
+        return solve_translations(
+            len(fov_names),
+            np.array(pairs),
+            shifts,
+            weights=qualities,
+            outlier_threshold=OUTLIER_THRESHOLD_PIXELS * get_pixel_size(level),
+        )
+
+    translations, inliers = solve(coarse_level)
+    refined = np.zeros(len(pairs), dtype=bool)
+
+    for level in range(coarse_level - 1, registration_resolution_level - 1, -1):
+        # the outlier threshold tightens with the pixel size of the level
+        translations, inliers = solve(level)
+        refine = (qualities < hierarchical_registration.min_quality) | ~inliers
+        # On the registration level, all other pairs are refined in windows
+        in_window = ~refine if level == registration_resolution_level else None
+        if not refine.any() and in_window is None:
+            continue
+        refined_pairs = [pair for pair, r in zip(pairs, refine) if r]
+        if refined_pairs:
+            logger.info(
+                f"Refining {len(refined_pairs)} of {len(pairs)} tile pairs on "
+                f"level {level}: "
+                f"{[(fov_names[a], fov_names[b]) for a, b in refined_pairs]}"
+            )
+        msims, reg_spatial_dims = get_level_msims(level)
+        set_fov_corrections(
+            msims,
+            fov_names,
+            {
+                fov_name: dict(zip(reg_spatial_dims, translation))
+                for fov_name, translation in zip(fov_names, translations)
+            },
+            base_transform_key=transform_key,
+            transform_key=ESTIMATE_TRANSFORM_KEY,
+        )
+        registered = refine.copy()
+        level_pairs = list(refined_pairs)
+        if in_window is not None and in_window.any():
+            logger.info(
+                f"Refining the other {int(in_window.sum())} tile pairs on level "
+                f"{level} in windows of {hierarchical_registration.window_size} "
+                "pixels"
+            )
+            window_size = {
+                dim: hierarchical_registration.window_size * get_pixel_size(level)
+                for dim in ["y", "x"]
+            }
+            # refined and windowed pairs are registered in the order of `pairs`
+            level_pairs = []
+            for pair, r in zip(pairs, refine):
+                if r:
+                    level_pairs.append(pair)
+                    continue
+                msims.extend(
+                    _crop_to_overlap_window(
+                        msims, pair, translations, reg_spatial_dims, window_size
+                    )
+                )
+                level_pairs.append((len(msims) - 2, len(msims) - 1))
+            registered = np.ones(len(pairs), dtype=bool)
+        # Relative to the estimated positions, the pairs register the
+        # remaining error of the estimate
+        residual_shifts, level_qualities = _register_pairs(
+            msims,
+            level_pairs,
+            reg_spatial_dims,
+            transform_key=ESTIMATE_TRANSFORM_KEY,
+            num_parallel_pairs=get_num_pairs(level),
+        )
+        qualities[registered] = level_qualities
+        registered_indices = np.array(pairs)[registered]
+        shifts[registered] = (
+            translations[registered_indices[:, 0]]
+            - translations[registered_indices[:, 1]]
+            + residual_shifts
+        )
+        refined |= refine
+        translations, inliers = solve(level)
+
+    logger.info(
+        f"Refined {int(refined.sum())} of {len(pairs)} tile pairs, kept "
+        f"{int(inliers.sum())} pairs for the FOV positions"
+    )
+    return {
+        fov: dict(zip(reg_spatial_dims, (float(s) for s in translation)))
+        for fov, translation in zip(fov_names, translations)
+    }
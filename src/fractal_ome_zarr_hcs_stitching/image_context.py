@@ -0,0 +1,249 @@
+"""Metadata and cached, prefetched reads of an OME-Zarr image."""
+
+import uuid
+from enum import Enum
+from functools import cached_property
+from typing import Optional
+
+import anndata as ad
+import pandas as pd
+import zarr
+from fractal_tasks_core.channels import OmeroChannel
+from fractal_tasks_core.ngff.specs import NgffImageMeta
+from pydantic import BaseModel, Field
+from zarr.storage import LRUStoreCache
+
+from fractal_ome_zarr_hcs_stitching.store_utils import (
+    CountingStore,
+    DecodedChunkCache,
+    DiskLRUStoreCache,
+    PrefetchingStore,
+    log_prefetch_statistics,
+    log_store_cache_statistics,
+)
+
+
+class ChunkCacheInputModel(BaseModel):
+    """Read-through cache for the chunks of the input image.
+
+    Attributes:
+        max_size_mb: Maximal size of the cache in megabytes. The least
+            recently used chunks are evicted first.
+        cache_dir: Node-local directory to stage chunks in, e.g. `/tmp` or a
+            scratch disk. If not set, chunks are cached in memory.
+    """
+
+    max_size_mb: int = 1024
+    cache_dir: Optional[str] = None
+
+    def get_store_cache(self, store) -> LRUStoreCache:
+        """Wrap a store into the configured cache."""
+        max_size = self.max_size_mb * 2**20
+        if self.cache_dir is None:
+            return LRUStoreCache(store, max_size=max_size)
+        return DiskLRUStoreCache(store, max_size=max_size, cache_dir=self.cache_dir)
+
+
+def _hilbert_distance(y: int, x: int, size: int) -> int:
+    """Position of a cell along a Hilbert curve filling a square grid.
+
+    Args:
+        y: Row of the cell.
+        x: Column of the cell.
+        size: Side length of the grid, a power of two.
+    """
+    distance = 0
+    s = size // 2
+    while s > 0:
+        ry = int(y & s > 0)
+        rx = int(x & s > 0)
+        distance += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant, so that the curve is continuous
+        if ry == 0:
+            if rx == 1:
+                y, x = size - 1 - y, size - 1 - x
+            y, x = x, y
+        s //= 2
+    return distance
+
+
+class FusionBlockOrder(Enum):
+    """FusionBlockOrder Enum class
+
+    Attributes:
+        ROWS: Blocks are fused row by row, plane by plane.
+        HILBERT: Blocks of each plane are fused along a Hilbert curve, so
+            that blocks fused shortly after each other are neighbors in both
+            y and x and share most of their input chunks.
+    """
+
+    ROWS = "rows"
+    HILBERT = "hilbert"
+
+    def sort_blocks(self, blocks: list[tuple[int, ...]]) -> list[tuple[int, ...]]:
+        """Sort block indices of an array in this order.
+
+        The last two axes of the blocks are y and x; all leading axes are
+        iterated over as outer loops.
+        """
+        if self == FusionBlockOrder.ROWS or not blocks:
+            return sorted(blocks)
+        size = 1 << max(max(block[-2:]) for block in blocks).bit_length()
+        return sorted(
+            blocks,
+            key=lambda block: (
+                block[:-2],
+                _hilbert_distance(block[-2], block[-1], size),
+            ),
+        )
+
+
+class LocalityAwareFusionInputModel(BaseModel):
+    """Fusion of output blocks in an order that reuses their input chunks.
+
+    The blocks of the fused image are computed in batches, in a fixed order
+    that keeps neighboring blocks close together, instead of in the order
+    chosen by dask. Decoded input chunks are kept in a cache in between, so
+    that a chunk shared by neighboring blocks is read and decoded once.
+
+    Attributes:
+        block_order: Order in which the output blocks are fused.
+        decoded_chunk_cache_mb: Size of the cache of decoded input chunks in
+            megabytes. The least recently used chunks are evicted first. It
+            should hold the input chunks of a few rows of output blocks.
+    """
+
+    block_order: FusionBlockOrder = FusionBlockOrder.HILBERT
+    decoded_chunk_cache_mb: int = Field(default=512, ge=0)
+
+
+class ImageContext:
+    """Metadata of an OME-Zarr image, read from the store at most once.
+
+    All helpers of this package accept an `ImageContext` so that the
+    `.zattrs` of the image, its omero channels, pyramid information and
+    the FOV ROI table are parsed a single time per task run, which avoids
+    repeated round-trips on high-latency storage.
+
+    Attributes:
+        zarr_url: Path to the OME-Zarr image.
+        input_cache: If set, all reads from the image go through this cache.
+        prefetch_workers: If set, chunks are read concurrently and ahead of
+            time by this many threads (see `prefetch`).
+        locality_aware_fusion: If set, fused blocks are computed in this
+            order and decoded chunks are cached (see `decoded_chunk_cache`).
+        token: Token unique to this context, naming the dask arrays reading
+            the image. The context holds the image as first read, so arrays
+            of a context opened after rewriting the image never share graph
+            keys (and cached results) with arrays of an earlier context.
+    """
+
+    def __init__(
+        self,
+        zarr_url,
+        input_cache: Optional[ChunkCacheInputModel] = None,
+        prefetch_workers: Optional[int] = None,
+        locality_aware_fusion: Optional[LocalityAwareFusionInputModel] = None,
+    ):
+        """Create a context; nothing is read until first accessed."""
+        self.zarr_url = str(zarr_url)
+        self.input_cache = input_cache
+        self.prefetch_workers = prefetch_workers
+        self.locality_aware_fusion = locality_aware_fusion
+        self.token = uuid.uuid4().hex
+        self._prefetching_store = None
+        self._arrays = {}
+
+    @cached_property
+    def counting_store(self) -> CountingStore:
+        """Store of the image, counting the bytes read from the storage."""
+        return CountingStore(zarr.storage.normalize_store_arg(self.zarr_url, mode="r"))
+
+    @cached_property
+    def store(self) -> zarr.storage.BaseStore:
+        """Store of the image, wrapped into the prefetcher and input cache."""
+        store = self.counting_store
+        if self.prefetch_workers:
+            store = PrefetchingStore(store, max_workers=self.prefetch_workers)
+            self._prefetching_store = store
+        if self.input_cache is not None:
+            store = self.input_cache.get_store_cache(store)
+        return store
+
+    @cached_property
+    def decoded_chunk_cache(self) -> Optional[DecodedChunkCache]:
+        """Cache of decoded chunks of the image, if locality-aware fusion."""
+        if self.locality_aware_fusion is None:
+            return None
+        return DecodedChunkCache(
+            self.locality_aware_fusion.decoded_chunk_cache_mb * 2**20
+        )
+
+    def prefetch(self, keys: list[str]):
+        """Start reading store keys in the background, if enabled.
+
+        Keys already held by the input cache are skipped.
+        """
+        if self._prefetching_store is None:
+            return
+        if isinstance(self.store, LRUStoreCache):
+            keys = [key for key in keys if key not in self.store._values_cache]
+        self._prefetching_store.prefetch(keys)
+
+    def discard_prefetched(self, keys: list[str]):
+        """Drop prefetched values of keys that will not be read anymore."""
+        if self._prefetching_store is not None:
+            self._prefetching_store.discard(keys)
+
+    @cached_property
+    def group(self) -> zarr.Group:
+        """Zarr group of the image, opened read-only."""
+        return zarr.open_group(self.store, mode="r")
+
+    @cached_property
+    def attrs(self) -> dict:
+        """Attributes (`.zattrs`) of the image group."""
+        return self.group.attrs.asdict()
+
+    @cached_property
+    def ngff_image_meta(self) -> NgffImageMeta:
+        """Parsed NGFF image metadata."""
+        return NgffImageMeta(**self.attrs)
+
+    @cached_property
+    def omero_channels(self) -> list[OmeroChannel]:
+        """List of omero channels of the image."""
+        return [OmeroChannel(**c) for c in self.attrs["omero"]["channels"]]
+
+    @cached_property
+    def fov_roi_table(self) -> pd.DataFrame:
+        """FOV ROI table of the image."""
+        return ad.read_zarr(f"{self.zarr_url}/tables/FOV_ROI_table").to_df()
+
+    def close(self):
+        """Stop prefetching and remove the disk and chunk caches, if any."""
+        if self._prefetching_store is not None:
+            self._prefetching_store.close()
+        if isinstance(self.__dict__.get("store"), DiskLRUStoreCache):
+            self.store.close()
+        if self.__dict__.get("decoded_chunk_cache") is not None:
+            self.decoded_chunk_cache.clear()
+
+    def log_cache_statistics(self):
+        """Log statistics of the input caches and prefetcher, if configured."""
+        log_store_cache_statistics(self.store)
+        log_store_cache_statistics(
+            self.decoded_chunk_cache, name="Decoded input chunk cache"
+        )
+        log_prefetch_statistics(self.store)
+
+    def get_array(self, resolution: int = 0) -> zarr.Array:
+        """Get the zarr array of a given resolution level.
+
+        Args:
+            resolution: Resolution level index.
+        """
+        if resolution not in self._arrays:
+            path = self.ngff_image_meta.datasets[resolution].path
+            self._arrays[resolution] = self.group[path]
+        return self._arrays[resolution]
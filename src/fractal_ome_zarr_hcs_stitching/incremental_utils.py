@@ -0,0 +1,584 @@
+"""Update a fused image after some of its FOVs were re-acquired."""
+
+import hashlib
+import itertools
+import logging
+import math
+import posixpath
+from typing import Optional
+
+import fsspec
+import numpy as np
+import xarray as xr
+import zarr
+from dask.array.chunk import coarsen
+from fractal_tasks_core.ngff.specs import NgffImageMeta
+from multiview_stitcher import param_utils
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import (
+    get_input_chunk_keys,
+    store_fused_blocks,
+)
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.progress_utils import (
+    PROGRESS_INTERVAL_SECONDS,
+    ProgressReporter,
+)
+from fractal_ome_zarr_hcs_stitching.store_utils import CountingStore, log_chunk_rereads
+from fractal_ome_zarr_hcs_stitching.utils import (
+    PreRegistrationPruningMethod,
+    RegistrationParallelizationInputModel,
+    get_focus_z_slices,
+    get_num_parallel_pairs,
+    get_registration_msims,
+    get_registration_pairs,
+    register_pairs,
+    write_fov_corrections,
+)
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_DIMS = ["z", "y", "x"]
+
+# Attribute of the fused image holding the state of the last stitching run
+STITCHING_STATE_KEY = "stitching_state"
+
+
+def _get_object_signature(info: dict) -> str:
+    """Size and modification stamp of a stored object, from its listing.
+
+    Object stores list an ETag, which changes with the content of the
+    object, and filesystems a modification time.
+    """
+    for field in ("ETag", "etag", "mtime", "LastModified", "last_modified"):
+        if info.get(field) is not None:
+            return f"{info['size']}:{info[field]}"
+    return f"{info['size']}:"
+
+
+def get_fov_checksums(
+    image_context: ImageContext, content_checksums: bool = False
+) -> dict[str, str]:
+    """Checksum the full-resolution input chunks of each FOV.
+
+    By default, only the full-resolution level of the image is listed and
+    each chunk is represented by its size and modification time (or ETag),
+    so no chunk is read. With `content_checksums`, the stored (compressed)
+    bytes of each chunk are hashed instead, one chunk at a time: this reads
+    the whole level but also ignores chunks rewritten with the same content.
+
+    Args:
+        image_context: Metadata of the input image.
+        content_checksums: Whether to hash the content of the chunks.
+
+    Returns:
+        Hex digest per FOV name, over the keys and signatures of all chunks
+        overlapping the FOV in all channels and z planes.
+    """
+    array = image_context.get_array(0)
+    axes = image_context.ngff_image_meta.axes_names
+    scales = dict(zip(SPATIAL_DIMS, image_context.ngff_image_meta.pixel_sizes_zyx[0]))
+
+    fov_keys = {}
+    for fov_name, row in image_context.fov_roi_table.iterrows():
+        chunk_ranges = []
+        for iaxis, dim in enumerate(axes):
+            start, stop = 0, array.shape[iaxis]
+            if dim in scales and f"{dim}_micrometer" in row:
+                start = round(row[f"{dim}_micrometer"] / scales[dim])
+                stop = start + round(row[f"len_{dim}_micrometer"] / scales[dim])
+                stop = min(max(stop, start + 1), array.shape[iaxis])
+            chunk_ranges.append(
+                range(
+                    start // array.chunks[iaxis], (stop - 1) // array.chunks[iaxis] + 1
+                )
+            )
+        fov_keys[fov_name] = [
+            array._chunk_key(chunk) for chunk in itertools.product(*chunk_ranges)
+        ]
+
+    # Chunks never written hold the fill value and have an empty signature
+    all_keys = sorted({key for keys in fov_keys.values() for key in keys})
+    if content_checksums:
+        signatures = {}
+        batch_size = 2 * (image_context.prefetch_workers or 1)
+        for ibatch in range(0, len(all_keys), batch_size):
+            keys = all_keys[ibatch : ibatch + batch_size]
+            image_context.prefetch(keys)
+            for key in keys:
+                try:
+                    signatures[key] = hashlib.sha256(
+                        image_context.store[key]
+                    ).hexdigest()
+                except KeyError:
+                    signatures[key] = ""
+    else:
+        fs, root = fsspec.core.url_to_fs(image_context.zarr_url)
+        level_path = f"{root}/{image_context.ngff_image_meta.datasets[0].path}"
+        fs.invalidate_cache(level_path)
+        signatures = {
+            posixpath.relpath(path, root): _get_object_signature(info)
+            for path, info in fs.find(level_path, detail=True).items()
+        }
+
+    checksums = {}
+    for fov_name, keys in fov_keys.items():
+        checksum = hashlib.sha256()
+        for key in keys:
+            checksum.update(f"{key}={signatures.get(key, '')};".encode())
+        checksums[fov_name] = checksum.hexdigest()
+    return checksums
+
+
+def _get_fov_positions(image_context: ImageContext) -> dict[str, dict[str, float]]:
+    """Columns of the FOV ROI table per FOV name."""
+    return {
+        fov_name: {column: float(value) for column, value in row.items()}
+        for fov_name, row in image_context.fov_roi_table.iterrows()
+    }
+
+
+def read_stitching_state(output_zarr_url: str) -> Optional[dict]:
+    """Read the state recorded by the last stitching run, if any."""
+    try:
+        output_group = zarr.open_group(output_zarr_url, mode="r")
+    except zarr.errors.GroupNotFoundError:
+        return None
+    return output_group.attrs.get(STITCHING_STATE_KEY)
+
+
+def write_stitching_state(
+    image_context: ImageContext,
+    output_zarr_url: str,
+    fused: xr.DataArray,
+    fov_corrections: dict[str, dict[str, float]],
+    fov_checksums: dict[str, str],
+):
+    """Record what a fused image was computed from, for incremental updates.
+
+    Args:
+        image_context: Metadata of the input image.
+        output_zarr_url: Path of the fused OME-Zarr image.
+        fused: Fused image, as returned by `fuse_fovs`.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used for fusion.
+        fov_checksums: Checksums of the input FOVs, as returned by
+            `get_fov_checksums`.
+    """
+    output_group = zarr.open_group(output_zarr_url, mode="r+")
+    output_group.attrs[STITCHING_STATE_KEY] = {
+        "shape": list(fused.shape),
+        "origin": {
+            dim: float(fused.coords[dim][0])
+            for dim in SPATIAL_DIMS
+            if dim in fused.coords
+        },
+        "fov_positions": _get_fov_positions(image_context),
+        "fov_corrections": fov_corrections,
+        "fov_checksums": fov_checksums,
+    }
+
+
+def find_changed_fovs(
+    image_context: ImageContext,
+    state: Optional[dict],
+    fov_checksums: dict[str, str],
+) -> Optional[list[str]]:
+    """Find the FOVs that changed since the last stitching run.
+
+    Args:
+        image_context: Metadata of the input image.
+        state: State of the last stitching run, as returned by
+            `read_stitching_state`.
+        fov_checksums: Current checksums of the input FOVs, as returned by
+            `get_fov_checksums`.
+
+    Returns:
+        Names of the changed or added FOVs, or None if the fused image can
+        not be updated incrementally, i.e. if there is no recorded state or
+        FOVs were removed.
+    """
+    if state is None:
+        logger.info("No state of a previous stitching run found")
+        return None
+    removed_fovs = set(state["fov_positions"]) - set(fov_checksums)
+    if removed_fovs:
+        logger.info(f"FOVs {sorted(removed_fovs)} were removed")
+        return None
+    positions = _get_fov_positions(image_context)
+    changed_fovs = [
+        fov_name
+        for fov_name in image_context.fov_roi_table.index
+        if positions[fov_name] != state["fov_positions"].get(fov_name)
+        or fov_checksums[fov_name] != state["fov_checksums"].get(fov_name)
+    ]
+    logger.info(f"Changed or added FOVs: {changed_fovs}")
+    return changed_fovs
+
+
+def register_changed_fovs(
+    image_context: ImageContext,
+    changed_fovs: list[str],
+    previous_corrections: dict[str, dict[str, float]],
+    reg_channel_index: int,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    transform_key: str = "fractal_input",
+) -> dict[str, dict[str, float]]:
+    """Register only the tile pairs involving changed FOVs.
+
+    The pairs are selected as in `register_fovs`, restricted to those with
+    at least one changed FOV. The unchanged FOVs keep their previous
+    corrections and the corrections of the changed FOVs are solved for by
+    least squares. Changed FOVs without any registered pair keep their
+    previous correction.
+
+    Args:
+        image_context: Metadata of the input image.
+        changed_fovs: Names of the changed FOVs, as returned by
+            `find_changed_fovs`.
+        previous_corrections: Corrections of the last stitching run.
+        reg_channel_index: Index of the channel to use for registration.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs to register.
+        min_overlap_signal_fraction: If set, only tile pairs with signal in
+            their overlap are registered, see `get_pairs_with_signal`.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many planes around the
+            best-focus plane of each FOV are projected.
+        registration_parallelization: If set, bounds the number of tile
+            pairs registered at the same time.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Translation correction per FOV name and spatial dimension.
+    """
+    fov_names = list(image_context.fov_roi_table.index)
+    fov_corrections = {
+        fov_name: dict(previous_corrections[fov_name])
+        for fov_name in fov_names
+        if fov_name in previous_corrections
+    }
+    if not changed_fovs:
+        return fov_corrections
+
+    z_slices = None
+    if registration_on_z_proj and registration_focus_planes is not None:
+        z_slices = get_focus_z_slices(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            num_planes=registration_focus_planes,
+        )
+    msims, reg_spatial_dims = get_registration_msims(
+        image_context,
+        reg_channel_index=reg_channel_index,
+        resolution=registration_resolution_level,
+        project_z=registration_on_z_proj,
+        transform_key=transform_key,
+        z_slices=z_slices,
+    )
+
+    changed_indices = [fov_names.index(fov_name) for fov_name in changed_fovs]
+    pairs = [
+        pair
+        for pair in get_registration_pairs(
+            image_context,
+            msims,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            reg_channel_index=reg_channel_index,
+            transform_key=transform_key,
+        )
+        if pair[0] in changed_indices or pair[1] in changed_indices
+    ]
+    logger.info(
+        f"Registering tile pairs {[(fov_names[a], fov_names[b]) for a, b in pairs]}"
+    )
+    if not pairs:
+        return fov_corrections
+
+    pair_params = register_pairs(
+        msims,
+        pairs,
+        reg_spatial_dims=reg_spatial_dims,
+        transform_key=transform_key,
+        num_parallel_pairs=get_num_parallel_pairs(
+            image_context,
+            registration_parallelization,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+        ),
+    )
+    # The shift registered for a pair (a, b) approximates the difference of
+    # the corrections of a and b
+    shifts = [
+        param_utils.translation_from_affine(params["transform"].sel(t=0).data)
+        for params in pair_params
+    ]
+
+    unknowns = sorted({i for pair in pairs for i in pair if i in changed_indices})
+    matrix = np.zeros((len(pairs), len(unknowns)))
+    rhs = np.zeros((len(pairs), len(reg_spatial_dims)))
+    for ipair, (pair, shift) in enumerate(zip(pairs, shifts)):
+        rhs[ipair] = shift
+        for itile, sign in zip(pair, (1, -1)):
+            if itile in unknowns:
+                matrix[ipair, unknowns.index(itile)] = sign
+            else:
+                correction = fov_corrections.get(fov_names[itile], {})
+                rhs[ipair] -= sign * np.array(
+                    [correction.get(dim, 0.0) for dim in reg_spatial_dims]
+                )
+    solution = np.linalg.lstsq(matrix, rhs, rcond=None)[0]
+    for itile, correction in zip(unknowns, solution):
+        fov_corrections[fov_names[itile]] = {
+            dim: float(c) for dim, c in zip(reg_spatial_dims, correction)
+        }
+    return fov_corrections
+
+
+def _get_fov_footprints(
+    fov_positions: dict[str, dict[str, float]],
+    fov_corrections: dict[str, dict[str, float]],
+    origin: dict[str, float],
+    scales: dict[str, float],
+    fov_names: list[str],
+) -> list[dict[str, tuple[float, float]]]:
+    """Pixel ranges covered by FOVs in the fused image."""
+    footprints = []
+    for fov_name in fov_names:
+        if fov_name not in fov_positions:
+            continue
+        row = fov_positions[fov_name]
+        corrections = fov_corrections.get(fov_name, {})
+        footprint = {}
+        for dim in origin:
+            start = (
+                (row[f"{dim}_micrometer_original"] if dim != "z" else 0)
+                + corrections.get(dim, 0)
+                - origin[dim]
+            ) / scales[dim]
+            footprint[dim] = (start, start + row[f"len_{dim}_micrometer"] / scales[dim])
+        footprints.append(footprint)
+    return footprints
+
+
+def get_affected_blocks(
+    fused: xr.DataArray,
+    footprints: list[dict[str, tuple[float, float]]],
+    margin: int = 1,
+) -> list[tuple[int, ...]]:
+    """Find the blocks of a fused image overlapping some FOV footprints.
+
+    Args:
+        fused: Fused image, as returned by `fuse_fovs`.
+        footprints: Pixel range per spatial dimension of each FOV.
+        margin: Number of pixels to add around each footprint, to account
+            for interpolation.
+
+    Returns:
+        Indices of the affected blocks of the fused array.
+    """
+    block_starts = [np.cumsum((0, *chunks)) for chunks in fused.data.chunks]
+    affected = set()
+    for footprint in footprints:
+        block_ranges = []
+        for iaxis, dim in enumerate(fused.dims):
+            starts = block_starts[iaxis]
+            if dim not in footprint:
+                block_ranges.append(range(len(starts) - 1))
+                continue
+            start, stop = footprint[dim]
+            start = max(math.floor(start) - margin, 0)
+            stop = min(math.ceil(stop) + margin, starts[-1])
+            block_ranges.append(
+                range(
+                    int(np.searchsorted(starts, start, side="right")) - 1,
+                    int(np.searchsorted(starts, stop, side="left")),
+                )
+            )
+        affected.update(itertools.product(*block_ranges))
+    return sorted(affected)
+
+
+def update_pyramid(
+    output_zarr_url: str,
+    regions: list[tuple[slice, ...]],
+    aggregation_function=np.mean,
+):
+    """Recompute the pyramid tiles of an image covering updated regions.
+
+    Each level is computed from the previous one as by `build_pyramid` of
+    fractal-tasks-core, one output chunk at a time.
+
+    Args:
+        output_zarr_url: Path of the OME-Zarr image.
+        regions: Updated regions of the full-resolution array.
+        aggregation_function: Function aggregating the pixels of a coarsening
+            window, as passed to `build_pyramid`.
+    """
+    ngff_image_meta = NgffImageMeta(
+        **zarr.open_group(output_zarr_url, mode="r").attrs.asdict()
+    )
+    coarsening_xy = ngff_image_meta.coarsening_xy
+    paths = [dataset.path for dataset in ngff_image_meta.datasets]
+
+    for previous_path, path in zip(paths[:-1], paths[1:]):
+        previous_level = zarr.open_array(f"{output_zarr_url}/{previous_path}", mode="r")
+        level = zarr.open_array(
+            f"{output_zarr_url}/{path}", mode="r+", write_empty_chunks=False
+        )
+        yx_axes = [level.ndim - 2, level.ndim - 1]
+        chunk_indices = set()
+        for region in regions:
+            chunk_ranges = []
+            for iaxis in yx_axes:
+                start = region[iaxis].start // coarsening_xy
+                stop = min(
+                    math.ceil(region[iaxis].stop / coarsening_xy), level.shape[iaxis]
+                )
+                if start >= stop:
+                    break
+                chunk_ranges.append(
+                    range(
+                        start // level.chunks[iaxis],
+                        (stop - 1) // level.chunks[iaxis] + 1,
+                    )
+                )
+            else:
+                chunk_indices.update(itertools.product(*chunk_ranges))
+
+        regions = []
+        for chunk_index in sorted(chunk_indices):
+            region = [slice(None)] * level.ndim
+            previous_region = [slice(None)] * level.ndim
+            for iaxis, ichunk in zip(yx_axes, chunk_index):
+                start = ichunk * level.chunks[iaxis]
+                stop = min(start + level.chunks[iaxis], level.shape[iaxis])
+                region[iaxis] = slice(start, stop)
+                previous_region[iaxis] = slice(
+                    start * coarsening_xy, stop * coarsening_xy
+                )
+            level[tuple(region)] = coarsen(
+                aggregation_function,
+                previous_level[tuple(previous_region)],
+                {iaxis: coarsening_xy for iaxis in yx_axes},
+                trim_excess=True,
+            ).astype(level.dtype)
+            regions.append(
+                tuple(
+                    slice(0, level.shape[iaxis]) if s == slice(None) else s
+                    for iaxis, s in enumerate(region)
+                )
+            )
+
+
+def update_fused_image(
+    image_context: ImageContext,
+    fused: xr.DataArray,
+    output_zarr_url: str,
+    state: dict,
+    changed_fovs: list[str],
+    fov_corrections: dict[str, dict[str, float]],
+    progress_file: Optional[str] = None,
+    progress_interval: float = PROGRESS_INTERVAL_SECONDS,
+) -> bool:
+    """Recompute the parts of an existing fused image covered by changed FOVs.
+
+    Only the full-resolution blocks overlapping the previous or the new
+    position of a changed FOV are fused again, followed by the pyramid tiles
+    covering them. The new corrections are recorded in the fused image.
+
+    Args:
+        image_context: Metadata of the input image.
+        fused: Fused image, as returned by `fuse_fovs`.
+        output_zarr_url: Path of the existing fused OME-Zarr image.
+        state: State of the last stitching run, as returned by
+            `read_stitching_state`.
+        changed_fovs: Names of the changed FOVs, as returned by
+            `find_changed_fovs`.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used for fusion.
+        progress_file: Local path of a JSON file to write the progress
+            reports of fusing the blocks to.
+        progress_interval: Seconds between two progress reports.
+
+    Returns:
+        Whether the image was updated. False if the fused image changed its
+        shape or origin and needs to be written in full.
+    """
+    origin = {
+        dim: float(fused.coords[dim][0]) for dim in SPATIAL_DIMS if dim in fused.coords
+    }
+    if list(fused.shape) != state["shape"] or not all(
+        np.isclose(origin[dim], state["origin"].get(dim, np.nan)) for dim in origin
+    ):
+        logger.info("The extent of the fused image changed")
+        return False
+
+    scales = dict(zip(SPATIAL_DIMS, image_context.ngff_image_meta.pixel_sizes_zyx[0]))
+    footprints = _get_fov_footprints(
+        state["fov_positions"],
+        state["fov_corrections"],
+        origin,
+        scales,
+        changed_fovs,
+    ) + _get_fov_footprints(
+        _get_fov_positions(image_context), fov_corrections, origin, scales, changed_fovs
+    )
+    blocks = get_affected_blocks(fused, footprints)
+    logger.info(
+        f"Recomputing {len(blocks)} of {math.prod(fused.data.numblocks)} output blocks"
+    )
+
+    output_store = CountingStore(
+        zarr.storage.normalize_store_arg(
+            f"{output_zarr_url}/{image_context.ngff_image_meta.datasets[0].path}",
+            mode="r+",
+        )
+    )
+    output_zarr_arr = zarr.open_array(output_store, mode="r+", write_empty_chunks=False)
+    chunk_keys = {}
+    if image_context.prefetch_workers:
+        chunk_keys = get_input_chunk_keys(image_context, fov_corrections, fused)
+    reads_before = image_context.counting_store.key_reads.copy()
+    with ProgressReporter(
+        "fusion",
+        len(blocks),
+        stores=[image_context.counting_store, output_store],
+        interval=progress_interval,
+        progress_file=progress_file,
+    ) as progress:
+        store_fused_blocks(
+            image_context,
+            fused.data,
+            output_zarr_arr,
+            chunk_keys,
+            blocks=blocks,
+            progress=progress,
+        )
+    log_chunk_rereads(image_context.counting_store, reads_before)
+
+    block_starts = [np.cumsum((0, *chunks)) for chunks in fused.data.chunks]
+    update_pyramid(
+        output_zarr_url,
+        [
+            tuple(
+                slice(starts[iblock], starts[iblock + 1])
+                for starts, iblock in zip(block_starts, block)
+            )
+            for block in blocks
+        ],
+    )
+    write_fov_corrections(output_zarr_url, fov_corrections)
+    return True
@@ -0,0 +1,188 @@
+"""Initializes plate-level stitching by registering reference wells."""
+
+import logging
+from typing import Any, Optional
+
+import numpy as np
+from fractal_tasks_core.tasks._zarr_utils import _split_well_path_image_path
+from pydantic import validate_call
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.utils import (
+    GlobalOptimizationMethod,
+    PreRegistrationPruningMethod,
+    RegistrationParallelizationInputModel,
+    StitchingChannelInputModel,
+    combine_fov_corrections,
+    register_fovs,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@validate_call
+def init_plate_stitching_task(
+    *,
+    # Fractal parameters
+    zarr_urls: list[str],
+    zarr_dir: str,
+    # Core parameters
+    channel: StitchingChannelInputModel,
+    reference_wells: Optional[list[str]] = None,
+    num_reference_wells: int = 1,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    global_optimization_method: GlobalOptimizationMethod = GlobalOptimizationMethod.ITERATIVE,  # noqa: E501
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+) -> dict[str, list[dict[str, Any]]]:
+    """Registers the FOVs of reference wells for stitching a whole plate.
+
+    Stage positioning errors are often highly reproducible across the wells
+    of a plate. This task registers the FOVs of one or a few reference wells
+    and passes the learned per-FOV corrections on to `plate_stitching_task`,
+    which applies them to all other wells of the plate without registering
+    them again. The reference images are fused with their own corrections.
+
+    Args:
+        zarr_urls: List of paths or urls to the individual OME-Zarr image to
+            be processed.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        zarr_dir: path of the directory where the new OME-Zarrs will be
+            created. Not used by this task.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        channel: Channel for registration; requires either
+            `wavelength_id` (e.g. `A01_C01`) or `label` (e.g. `DAPI`), but not
+            both.
+        reference_wells: Wells to learn the FOV corrections on, e.g. `B03` or
+            `B/03`. If not set, `num_reference_wells` wells spread evenly over
+            the plate are used.
+        num_reference_wells: Number of reference wells to pick if
+            `reference_wells` is not set. The corrections of several
+            reference wells are combined by their median.
+        registration_resolution_level: Resolution level to use for registration.
+        registration_on_z_proj: Whether to perform registration on a maximum
+            projection along z in case of 3D data.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many z planes around the
+            best-focus plane of each FOV are projected for registration (see
+            `stitching_task`).
+        registration_parallelization: If set, tile pairs are registered in
+            batches of a bounded size (see `stitching_task`).
+        global_optimization_method: Method to find the FOV positions
+            agreeing best with the registered tile pairs (see
+            `stitching_task`).
+        pre_registration_pruning_method: Method to use for selecting a subset
+            of all overlapping tiles for pairwise registration (see
+            `stitching_task`).
+
+    Returns:
+        task_output: Dictionary for Fractal server that contains a
+            parallelization list.
+    """
+    logger.info(f"Running `init_plate_stitching_task` for {zarr_urls=}")
+
+    well_images = {}
+    for zarr_url in zarr_urls:
+        well_url, _ = _split_well_path_image_path(zarr_url)
+        well_name = "".join(well_url.split("/")[-2:])
+        well_images.setdefault(well_name, []).append(zarr_url)
+
+    if reference_wells is not None:
+        reference_wells = [well.replace("/", "") for well in reference_wells]
+        missing_wells = set(reference_wells) - set(well_images)
+        if missing_wells:
+            raise ValueError(
+                f"Reference wells {sorted(missing_wells)} are not part of the "
+                f"processed wells {sorted(well_images)}."
+            )
+    else:
+        sorted_wells = sorted(well_images)
+        num_reference_wells = min(num_reference_wells, len(sorted_wells))
+        reference_wells = [
+            sorted_wells[i]
+            for i in np.linspace(0, len(sorted_wells) - 1, num_reference_wells)
+            .round()
+            .astype(int)
+        ]
+    logger.info(f"Reference wells: {reference_wells}")
+
+    reference_corrections = {}
+    for well_name in reference_wells:
+        for zarr_url in well_images[well_name]:
+            image_context = ImageContext(zarr_url)
+            omero_channel = channel.get_omero_channel(
+                zarr_url, image_context=image_context
+            )
+            if not omero_channel:
+                logger.info(
+                    f"Skipping reference image {zarr_url} because {channel} is "
+                    "not available in that OME-Zarr image"
+                )
+                continue
+            logger.info(f"Started registration of reference image {zarr_url}")
+            fov_corrections = register_fovs(
+                image_context,
+                reg_channel_index=omero_channel.index,
+                registration_resolution_level=registration_resolution_level,
+                registration_on_z_proj=registration_on_z_proj,
+                registration_focus_planes=registration_focus_planes,
+                pre_registration_pruning_method=pre_registration_pruning_method,
+                registration_parallelization=registration_parallelization,
+                global_optimization_method=global_optimization_method,
+            )
+            logger.info(f"Obtained shifts: {fov_corrections}")
+            reference_corrections[zarr_url] = fov_corrections
+
+    if not reference_corrections:
+        raise ValueError(
+            f"{channel} is not available in any image of the reference wells "
+            f"{reference_wells}."
+        )
+
+    fov_corrections = combine_fov_corrections(list(reference_corrections.values()))
+    logger.info(f"Plate-level FOV corrections: {fov_corrections}")
+
+    init_args = dict(
+        fov_corrections=fov_corrections,
+        reference_zarr_urls=list(reference_corrections),
+        is_reference=False,
+        channel=channel.model_dump(),
+        registration_resolution_level=registration_resolution_level,
+        registration_on_z_proj=registration_on_z_proj,
+        registration_focus_planes=registration_focus_planes,
+        pre_registration_pruning_method=pre_registration_pruning_method.value,
+        registration_parallelization=(
+            registration_parallelization.model_dump()
+            if registration_parallelization is not None
+            else None
+        ),
+        global_optimization_method=global_optimization_method.value,
+    )
+    # reference images are fused with their own, registered corrections
+    parallelization_list = [
+        dict(
+            zarr_url=zarr_url,
+            init_args=(
+                dict(
+                    init_args,
+                    fov_corrections=reference_corrections[zarr_url],
+                    is_reference=True,
+                )
+                if zarr_url in reference_corrections
+                else init_args
+            ),
+        )
+        for zarr_url in zarr_urls
+    ]
+
+    return dict(parallelization_list=parallelization_list)
+
+
+if __name__ == "__main__":
+    from fractal_tasks_core.tasks._utils import run_fractal_task
+
+    run_fractal_task(task_function=init_plate_stitching_task)
@@ -0,0 +1,260 @@
+"""Reading and writing OME-Zarr images on local paths and fsspec URLs.
+
+Images can live on a local filesystem or behind any fsspec URL, e.g. on
+S3-compatible object storage (`s3://bucket/plate.zarr/B/03/0`, with `s3fs`
+installed). Credentials and endpoints are configured as usual for fsspec,
+e.g. by environment variables or `fsspec.config.conf`.
+"""
+
+import logging
+import math
+import os
+from typing import Callable, Optional
+
+import dask.array as da
+import fsspec
+import numpy as np
+import zarr
+from fractal_tasks_core.ngff.specs import NgffWellMeta
+from fractal_tasks_core.pyramids import build_pyramid as build_local_pyramid
+from fractal_tasks_core.tasks._zarr_utils import _update_well_metadata
+from fsspec.implementations.local import LocalFileSystem
+
+from fractal_ome_zarr_hcs_stitching.progress_utils import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+# Zarr metadata keys, copied last when replacing an image so that it only
+# appears complete once all its chunks are in place
+ZARR_METADATA_KEYS = (".zarray", ".zattrs", ".zgroup")
+
+# Attempts to update the metadata of a well on an object store, if it is
+# changed concurrently
+MAX_WELL_METADATA_ATTEMPTS = 3
+
+
+def is_local_url(url: str) -> bool:
+    """Whether a path or URL points to the local filesystem."""
+    fs, _ = fsspec.core.url_to_fs(url)
+    return isinstance(fs, LocalFileSystem)
+
+
+def build_pyramid(
+    zarr_url: str,
+    num_levels: int,
+    coarsening_xy: int,
+    chunksize: Optional[tuple[int, ...]] = None,
+    aggregation_function: Callable = np.mean,
+    open_array_kwargs: Optional[dict] = None,
+    progress: Optional[ProgressReporter] = None,
+):
+    """Build the coarser levels of an image from its full-resolution level.
+
+    Local paths use `fractal_tasks_core.pyramids.build_pyramid`, which
+    normalizes its argument as a local path. For other URLs, each level is
+    computed from the stored previous one in the same way, overwriting
+    existing levels.
+
+    Args:
+        zarr_url: Path or URL of the image, without the level.
+        num_levels: Total number of levels, including the full resolution.
+        coarsening_xy: Linear coarsening factor between subsequent levels.
+        chunksize: Chunks of the coarser levels.
+        aggregation_function: Function aggregating the coarsened pixels.
+        open_array_kwargs: Additional arguments to open the level arrays.
+        progress: If set, counts the chunks of the coarser levels. For other
+            URLs than local paths, the chunks are counted as they are
+            written, together with the reads and writes of the image; for
+            local paths, all at once when the pyramid is built.
+    """
+    if is_local_url(zarr_url):
+        build_local_pyramid(
+            zarrurl=zarr_url,
+            overwrite=True,
+            num_levels=num_levels,
+            coarsening_xy=coarsening_xy,
+            chunksize=chunksize,
+            aggregation_function=aggregation_function,
+            open_array_kwargs=open_array_kwargs,
+        )
+        if progress is not None:
+            progress.update(
+                sum(
+                    zarr.open_array(f"{zarr_url}/{level}", mode="r").nchunks
+                    for level in range(1, num_levels)
+                )
+            )
+        return
+
+    open_array_kwargs = open_array_kwargs or {}
+    store = zarr.storage.normalize_store_arg(zarr_url, mode="a")
+    if progress is not None:
+        store = progress.wrap_store(store)
+    previous_level = da.from_zarr(zarr.open_array(store, path="0", mode="r"))
+    dtype = previous_level.dtype
+    yx_axes = (previous_level.ndim - 2, previous_level.ndim - 1)
+    for level in range(1, num_levels):
+        if min(previous_level.shape[-2:]) < coarsening_xy:
+            raise ValueError(
+                f"At level {level}, {coarsening_xy=} but the previous level "
+                f"has shape {previous_level.shape}"
+            )
+        new_level = da.coarsen(
+            aggregation_function,
+            previous_level,
+            {axis: coarsening_xy for axis in yx_axes},
+            trim_excess=True,
+        ).astype(dtype)
+        if chunksize is not None:
+            new_level = new_level.rechunk(chunksize)
+        level_array = zarr.open_array(
+            store,
+            path=str(level),
+            shape=new_level.shape,
+            chunks=new_level.chunksize,
+            dtype=new_level.dtype,
+            mode="w",
+            dimension_separator="/",
+            **open_array_kwargs,
+        )
+        if progress is not None:
+            new_level = progress.track(new_level)
+        new_level.to_zarr(level_array, compute=True)
+        previous_level = da.from_zarr(level_array)
+
+
+def count_pyramid_chunks(
+    shape: tuple[int, ...],
+    num_levels: int,
+    coarsening_xy: int,
+    chunksize: tuple[int, ...],
+) -> int:
+    """Number of chunks of the coarser levels written by `build_pyramid`.
+
+    Args:
+        shape: Shape of the full-resolution level.
+        num_levels: Total number of levels, including the full resolution.
+        coarsening_xy: Linear coarsening factor between subsequent levels.
+        chunksize: Chunks of the coarser levels.
+    """
+    num_chunks = 0
+    for level in range(1, num_levels):
+        level_shape = [
+            *shape[:-2],
+            *(size // coarsening_xy**level for size in shape[-2:]),
+        ]
+        num_chunks += math.prod(
+            math.ceil(size / chunk) for size, chunk in zip(level_shape, chunksize)
+        )
+    return num_chunks
+
+
+def _read_well_attrs(well_url: str) -> dict:
+    """Attributes of a well, read from its `.zattrs`."""
+    return zarr.open_group(well_url, mode="r").attrs.asdict()
+
+
+def update_well_metadata(well_url: str, old_image_path: str, new_image_path: str):
+    """Add an image derived from another one to the metadata of its well.
+
+    Local wells are updated by `fractal_tasks_core`, under a file lock.
+    Object stores offer no locks: the images of a well all share its
+    `.zattrs`, which is read, extended and written back. To detect images
+    added concurrently by other tasks, the `.zattrs` is read again right
+    before writing it and the update is repeated if it changed. This leaves
+    a short window between reading and writing, so tasks adding images to
+    the same well should not run at exactly the same time.
+
+    Args:
+        well_url: Path or URL of the well.
+        old_image_path: Path of the original image, relative to the well.
+        new_image_path: Path of the new image, relative to the well.
+    """
+    if is_local_url(well_url):
+        _update_well_metadata(
+            well_url=well_url,
+            old_image_path=old_image_path,
+            new_image_path=new_image_path,
+        )
+        return
+
+    for _ in range(MAX_WELL_METADATA_ATTEMPTS):
+        attrs = _read_well_attrs(well_url)
+        well_meta = NgffWellMeta(**attrs)
+        images = {image.path: image for image in well_meta.well.images}
+        if new_image_path in images:
+            raise ValueError(
+                f"Could not add the {new_image_path=} image to the well metadata "
+                f"because an image with that name already exists: {well_meta}"
+            )
+        if old_image_path not in images:
+            raise ValueError(
+                f"Could not find an image with {old_image_path=} in the well metadata."
+            )
+        new_image = images[old_image_path].model_copy(update={"path": new_image_path})
+        well_meta.well.images = sorted(
+            [*well_meta.well.images, new_image], key=lambda image: image.path
+        )
+        if _read_well_attrs(well_url) != attrs:
+            logger.info(f"The metadata of {well_url} changed meanwhile, retrying")
+            continue
+        zarr.open_group(well_url, mode="r+").attrs.put(
+            well_meta.model_dump(exclude_none=True)
+        )
+        return
+    raise RuntimeError(
+        f"Could not add the {new_image_path=} image to the metadata of {well_url}, "
+        "which kept being changed concurrently."
+    )
+
+
+def replace_image(zarr_url: str, new_zarr_url: str):
+    """Replace an image by another one, which is moved to its place.
+
+    On a local filesystem, the directories are swapped by renaming. Object
+    stores can't rename: their objects are copied one by one, so a failure
+    could leave both images incomplete. There, the chunks of the new image
+    are copied over the objects of the old image first and its Zarr
+    metadata last, then only the objects of the old image that were not
+    overwritten are deleted, and finally the new image. The old image thus
+    keeps its metadata until all new chunks are in place, while the new
+    image stays complete at `new_zarr_url` until it was copied, so that an
+    interrupted replacement can be repeated.
+
+    Args:
+        zarr_url: Path or URL of the image to replace.
+        new_zarr_url: Path or URL of the replacing image.
+    """
+    fs, path = fsspec.core.url_to_fs(zarr_url)
+    _, new_path = fsspec.core.url_to_fs(new_zarr_url)
+    if isinstance(fs, LocalFileSystem):
+        os.rename(path, f"{path}_tmp")
+        os.rename(new_path, path)
+        fs.rm(f"{path}_tmp", recursive=True)
+        return
+
+    old_files = fs.find(path)
+    new_files = fs.find(new_path)
+    targets = {
+        new_file: f"{path}/{os.path.relpath(new_file, new_path)}"
+        for new_file in new_files
+    }
+    metadata = [
+        new_file
+        for new_file in new_files
+        if os.path.basename(new_file) in ZARR_METADATA_KEYS
+    ]
+    chunks = [new_file for new_file in new_files if new_file not in metadata]
+    for files in [chunks, metadata]:
+        if files:
+            # fsspec copies lists of files concurrently on async filesystems
+            fs.copy(files, [targets[file] for file in files])
+    stale_files = sorted(set(old_files) - set(targets.values()))
+    if stale_files:
+        fs.rm(stale_files)
+    fs.rm(new_path, recursive=True)
+    fs.invalidate_cache()
+    logger.info(
+        f"Copied {len(new_files)} objects of {new_zarr_url} to {zarr_url} and "
+        f"deleted {len(stale_files)} stale objects"
+    )
@@ -0,0 +1,355 @@
+"""Apply the stitching transforms to the label images and tables of an image."""
+
+import logging
+from functools import partial
+from typing import Optional
+
+import anndata as ad
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from dask.base import tokenize
+from fractal_tasks_core.labels import prepare_label_group
+from fractal_tasks_core.ngff.specs import NgffImageMeta
+from fractal_tasks_core.tables import write_table
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.io_utils import build_pyramid
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_DIMS = ["z", "y", "x"]
+
+
+def get_label_names(image_context: ImageContext) -> list[str]:
+    """Get the names of the label images of an image."""
+    if "labels" not in image_context.group:
+        return []
+    return image_context.group["labels"].attrs.get("labels", [])
+
+
+def _get_fused_origin(fused: xr.DataArray) -> dict[str, float]:
+    """Position of the first pixel of a fused image along the placed axes."""
+    return {
+        dim: float(fused.coords[dim][0]) for dim in SPATIAL_DIMS if dim in fused.coords
+    }
+
+
+def _fuse_label_block(array, axes, tiles, block_info=None):
+    """Paste the label tiles overlapping one block of the fused label image.
+
+    In overlaps, each pixel takes the label of the tile whose border is
+    farthest away, i.e. the labels are never mixed or interpolated.
+    """
+    location = block_info[None]["array-location"]
+    block = np.zeros(block_info[None]["chunk-shape"], dtype=array.dtype)
+    best_distance = np.full(block.shape, -1)
+    for tile in tiles:
+        block_slices, tile_slices, distances = [], [], []
+        for iaxis, dim in enumerate(axes):
+            start, stop = location[iaxis]
+            if dim not in tile:
+                block_slices.append(slice(None))
+                tile_slices.append(slice(start, stop))
+                continue
+            roi_start, roi_len, offset = tile[dim]
+            start, stop = max(start, offset), min(stop, offset + roi_len)
+            if start >= stop:
+                break
+            block_slices.append(
+                slice(start - location[iaxis][0], stop - location[iaxis][0])
+            )
+            tile_slices.append(
+                slice(roi_start + start - offset, roi_start + stop - offset)
+            )
+            positions = np.arange(start, stop) - offset
+            distance = np.minimum(positions, roi_len - 1 - positions)
+            distances.append(
+                distance.reshape([-1 if i == iaxis else 1 for i in range(len(axes))])
+            )
+        else:
+            block_slices = tuple(block_slices)
+            data = array[tuple(tile_slices)]
+            distance = np.broadcast_to(
+                np.minimum.reduce(np.broadcast_arrays(*distances)), data.shape
+            )
+            is_closer = distance > best_distance[block_slices]
+            block[block_slices][is_closer] = data[is_closer]
+            best_distance[block_slices][is_closer] = distance[is_closer]
+    return block
+
+
+def fuse_label_image(
+    image_context: ImageContext,
+    label_name: str,
+    fov_corrections: dict[str, dict[str, float]],
+    fused: xr.DataArray,
+) -> da.Array:
+    """Build the graph fusing the FOVs of a label image.
+
+    The FOVs are placed at the same corrected positions as for the fused
+    image, rounded to whole pixels of the label image (nearest-neighbor), so
+    that label IDs are preserved and no new IDs appear.
+
+    Args:
+        image_context: Metadata of the input image.
+        label_name: Name of the label image, e.g. `nuclei`.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used to fuse the image.
+        fused: Fused image, as returned by `fuse_fovs`.
+
+    Returns:
+        Lazy array of the fused label image, with the axes of the input
+        label image.
+    """
+    label_group = image_context.group[f"labels/{label_name}"]
+    label_meta = NgffImageMeta(**label_group.attrs.asdict())
+    array = label_group[label_meta.datasets[0].path]
+    axes = label_meta.axes_names
+    label_scales = dict(zip(SPATIAL_DIMS, label_meta.pixel_sizes_zyx[0]))
+    image_scales = dict(
+        zip(SPATIAL_DIMS, image_context.ngff_image_meta.pixel_sizes_zyx[0])
+    )
+    origin = _get_fused_origin(fused)
+
+    shape = [
+        (
+            round(fused.sizes[dim] * image_scales[dim] / label_scales[dim])
+            if dim in origin
+            else array.shape[iaxis]
+        )
+        for iaxis, dim in enumerate(axes)
+    ]
+
+    tiles = []
+    for fov_name, row in image_context.fov_roi_table.iterrows():
+        corrections = fov_corrections.get(fov_name, {})
+        tiles.append(
+            {
+                dim: (
+                    round(row[f"{dim}_micrometer"] / label_scales[dim]),
+                    round(row[f"len_{dim}_micrometer"] / label_scales[dim]),
+                    round(
+                        (
+                            (row[f"{dim}_micrometer_original"] if dim != "z" else 0)
+                            + corrections.get(dim, 0)
+                            - origin[dim]
+                        )
+                        / label_scales[dim]
+                    ),
+                )
+                for dim in origin
+            }
+        )
+
+    return da.map_blocks(
+        partial(_fuse_label_block, array, axes, tiles),
+        chunks=da.core.normalize_chunks(array.chunks, shape),
+        dtype=array.dtype,
+        meta=np.array((), dtype=array.dtype),
+        name=f"fuse-labels-{tokenize(image_context.token, label_name, tiles)}",
+    )
+
+
+def write_fused_label_image(
+    image_context: ImageContext,
+    label_name: str,
+    fused_label: da.Array,
+    output_zarr_url: str,
+):
+    """Write a fused label image and its pyramid next to the fused image.
+
+    Args:
+        image_context: Metadata of the input image.
+        label_name: Name of the label image.
+        fused_label: Fused label image, as returned by `fuse_label_image`.
+        output_zarr_url: Path of the fused OME-Zarr image.
+    """
+    label_group = image_context.group[f"labels/{label_name}"]
+    label_attrs = label_group.attrs.asdict()
+    label_meta = NgffImageMeta(**label_attrs)
+    prepare_label_group(
+        zarr.open_group(output_zarr_url, mode="r+"),
+        label_name,
+        label_attrs=label_attrs,
+        overwrite=True,
+        logger=logger,
+    )
+
+    label_url = f"{output_zarr_url}/labels/{label_name}"
+    chunksize = label_group[label_meta.datasets[0].path].chunks
+    output_label_arr = zarr.open(
+        f"{label_url}/{label_meta.datasets[0].path}",
+        shape=fused_label.shape,
+        chunks=chunksize,
+        dtype=fused_label.dtype,
+        write_empty_chunks=False,
+        dimension_separator="/",
+        fill_value=0,
+        mode="w",
+    )
+    fused_label.to_zarr(
+        output_label_arr,
+        overwrite=True,
+        dimension_separator="/",
+        return_stored=False,
+        compute=True,
+    )
+    build_pyramid(
+        label_url,
+        num_levels=label_meta.num_levels,
+        chunksize=chunksize,
+        coarsening_xy=label_meta.coarsening_xy,
+        aggregation_function=np.max,
+        open_array_kwargs={"write_empty_chunks": False, "fill_value": 0},
+    )
+
+
+def transform_roi_table(
+    image_context: ImageContext,
+    roi_table: pd.DataFrame,
+    fov_corrections: dict[str, dict[str, float]],
+    fused: xr.DataArray,
+) -> Optional[pd.DataFrame]:
+    """Move the ROIs of a table to their positions in the fused image.
+
+    Each ROI is moved like the FOV containing its center.
+
+    Args:
+        image_context: Metadata of the input image.
+        roi_table: ROI table of the input image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used to fuse the image.
+        fused: Fused image, as returned by `fuse_fovs`.
+
+    Returns:
+        Transformed ROI table, or None if some ROIs lie outside of all FOVs.
+    """
+    origin = _get_fused_origin(fused)
+    fov_roi_table = image_context.fov_roi_table
+
+    fov_indices = np.full(len(roi_table), -1)
+    for ifov, (_, fov_row) in enumerate(fov_roi_table.iterrows()):
+        is_inside = np.ones(len(roi_table), dtype=bool)
+        for dim in origin:
+            center = (
+                roi_table[f"{dim}_micrometer"] + roi_table[f"len_{dim}_micrometer"] / 2
+            ).to_numpy()
+            start = fov_row[f"{dim}_micrometer"]
+            is_inside &= (center >= start) & (
+                center < start + fov_row[f"len_{dim}_micrometer"]
+            )
+        fov_indices[is_inside & (fov_indices < 0)] = ifov
+    if (fov_indices < 0).any():
+        return None
+
+    roi_table = roi_table.copy()
+    for dim in origin:
+        shifts = np.array(
+            [
+                (row[f"{dim}_micrometer_original"] if dim != "z" else 0)
+                + fov_corrections.get(fov_name, {}).get(dim, 0)
+                - origin[dim]
+                - row[f"{dim}_micrometer"]
+                for fov_name, row in fov_roi_table.iterrows()
+            ]
+        )
+        roi_table[f"{dim}_micrometer"] += shifts[fov_indices]
+    return roi_table
+
+
+def write_fused_tables(
+    image_context: ImageContext,
+    fov_corrections: dict[str, dict[str, float]],
+    fused: xr.DataArray,
+    output_zarr_url: str,
+    label_names: list[str],
+):
+    """Write the tables of the input image that remain valid after fusion.
+
+    ROI tables are moved with their FOVs (see `transform_roi_table`). Tables
+    of fused label images are copied, since label IDs are preserved. Other
+    tables, and the well ROI table which is written by `write_fused_image`,
+    are skipped.
+
+    Args:
+        image_context: Metadata of the input image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used to fuse the image.
+        fused: Fused image, as returned by `fuse_fovs`.
+        output_zarr_url: Path of the fused OME-Zarr image.
+        label_names: Names of the fused label images.
+    """
+    if "tables" not in image_context.group:
+        return
+    tables_group = image_context.group["tables"]
+    output_group = zarr.open_group(output_zarr_url, mode="r+")
+    for table_name in tables_group.attrs.get("tables", []):
+        table_attrs = tables_group[table_name].attrs.asdict()
+        table_type = table_attrs.get("type")
+        region = table_attrs.get("region", {}).get("path", "")
+        if region and region.split("/")[-1] not in label_names:
+            logger.info(f"Skipping table {table_name} of a label image not fused")
+            continue
+        if table_name == "well_ROI_table" or table_type not in [
+            "roi_table",
+            "masking_roi_table",
+            "feature_table",
+        ]:
+            logger.info(f"Skipping table {table_name} of type {table_type}")
+            continue
+
+        table = ad.read_zarr(f"{image_context.zarr_url}/tables/{table_name}")
+        if table_type != "feature_table":
+            roi_table = transform_roi_table(
+                image_context, table.to_df(), fov_corrections, fused
+            )
+            if roi_table is None:
+                logger.warning(
+                    f"Skipping table {table_name}, as some of its ROIs lie "
+                    "outside of all FOVs"
+                )
+                continue
+            table.X = roi_table.to_numpy(dtype=table.X.dtype)
+        write_table(
+            output_group,
+            table_name,
+            table,
+            overwrite=True,
+            table_attrs=table_attrs,
+        )
+        logger.info(f"Wrote table {table_name} to the fused image")
+
+
+def fuse_labels_and_tables(
+    image_context: ImageContext,
+    fov_corrections: dict[str, dict[str, float]],
+    fused: xr.DataArray,
+    output_zarr_url: str,
+):
+    """Fuse all label images of an image and write its tables.
+
+    Reuses the corrections of the intensity image instead of registering
+    again, so that e.g. nuclei segmented per FOV don't need to be segmented
+    again on the fused image.
+
+    Args:
+        image_context: Metadata of the input image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as used to fuse the image.
+        fused: Fused image, as returned by `fuse_fovs`.
+        output_zarr_url: Path of the fused OME-Zarr image.
+    """
+    label_names = get_label_names(image_context)
+    for label_name in label_names:
+        logger.info(f"Started fusion of label image {label_name}")
+        fused_label = fuse_label_image(
+            image_context, label_name, fov_corrections, fused
+        )
+        write_fused_label_image(image_context, label_name, fused_label, output_zarr_url)
+        logger.info(f"Finished fusion of label image {label_name}")
+    write_fused_tables(
+        image_context, fov_corrections, fused, output_zarr_url, label_names
+    )
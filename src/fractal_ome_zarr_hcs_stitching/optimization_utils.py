@@ -0,0 +1,145 @@
+"""Global optimization of tile translations from pairwise registrations."""
+
+import logging
+from typing import Optional
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
+
+logger = logging.getLogger(__name__)
+
+
+def _solve_weighted_least_squares(
+    num_tiles: int,
+    pairs: np.ndarray,
+    shifts: np.ndarray,
+    weights: np.ndarray,
+    reference_tiles: np.ndarray,
+) -> np.ndarray:
+    """Solve for positions with `x[a] - x[b] ~ shift` and fixed references."""
+    num_pairs = len(pairs)
+    rows = np.repeat(np.arange(num_pairs), 2)
+    matrix = sparse.csr_matrix(
+        (np.tile([1.0, -1.0], num_pairs), (rows, pairs.ravel())),
+        shape=(num_pairs, num_tiles),
+    )
+    free = np.ones(num_tiles, dtype=bool)
+    free[reference_tiles] = False
+    matrix = matrix[:, free]
+    weighted = matrix.T @ sparse.diags(weights)
+    positions = np.zeros((num_tiles, shifts.shape[1]))
+    if free.any():
+        solution = spsolve((weighted @ matrix).tocsc(), weighted @ shifts)
+        positions[free] = solution.reshape(free.sum(), shifts.shape[1])
+    return positions
+
+
+def solve_translations(
+    num_tiles: int,
+    pairs: np.ndarray,
+    shifts: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+    outlier_threshold: Optional[float] = None,
+    max_iter: int = 100,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find tile translations agreeing best with pairwise registrations.
+
+    Solves the sparse weighted least-squares problem
+    `x[a] - x[b] ~ shift` over all registered pairs `(a, b)`, which scales
+    to many thousands of tiles. In each connected component of the pair
+    graph, the tile with the largest sum of weights is kept in place, as
+    by the global optimization of multiview-stitcher.
+
+    Outliers are rejected iteratively: in each round, the pairs whose
+    residual exceeds `outlier_threshold` and at least half the largest
+    residual are removed, largest first and none close to another since an
+    outlier also increases the residuals of the pairs around it, and the
+    problem is solved again. Pairs whose removal would
+    disconnect tiles are kept.
+
+    Args:
+        num_tiles: Number of tiles.
+        pairs: Indices of the registered tile pairs, of shape
+            `(num_pairs, 2)`.
+        shifts: Registered shift of each pair, approximating the difference
+            of the translations of its two tiles, of shape
+            `(num_pairs, ndim)`.
+        weights: Weight (e.g. registration quality) of each pair. All pairs
+            weigh the same by default.
+        outlier_threshold: Largest residual (in the units of `shifts`) of a
+            pair considered consistent. If not set, no pairs are rejected.
+        max_iter: Maximal number of rejection rounds.
+
+    Returns:
+        Translation of each tile, of shape `(num_tiles, ndim)`, and a mask
+        of the pairs kept.
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    shifts = np.asarray(shifts, dtype=float).reshape(len(pairs), -1)
+    if weights is None:
+        weights = np.ones(len(pairs))
+    weights = np.clip(np.asarray(weights, dtype=float), 1e-6, None)
+
+    # reference tile per connected component
+    adjacency = sparse.coo_matrix(
+        (weights, (pairs[:, 0], pairs[:, 1])), shape=(num_tiles, num_tiles)
+    ).tocsr()
+    adjacency = adjacency + adjacency.T
+    _, components = connected_components(adjacency, directed=False)
+    weight_sums = np.asarray(adjacency.sum(axis=1)).ravel()
+    reference_tiles = np.array(
+        [
+            np.flatnonzero(components == component)[
+                np.argmax(weight_sums[components == component])
+            ]
+            for component in np.unique(components)
+        ]
+    )
+
+    inliers = np.ones(len(pairs), dtype=bool)
+    for iteration in range(max_iter + 1):
+        positions = _solve_weighted_least_squares(
+            num_tiles,
+            pairs[inliers],
+            shifts[inliers],
+            weights[inliers],
+            reference_tiles,
+        )
+        if outlier_threshold is None or iteration == max_iter:
+            break
+        residuals = np.linalg.norm(
+            positions[pairs[:, 0]] - positions[pairs[:, 1]] - shifts, axis=1
+        )
+        residuals[~inliers] = 0
+        candidates = np.flatnonzero(
+            (residuals > outlier_threshold) & (residuals >= residuals.max() / 2)
+        )
+        if not len(candidates):
+            break
+        graph = nx.Graph()
+        graph.add_edges_from(map(tuple, pairs[inliers]))
+        outliers, visited_tiles = [], set()
+        for ipair in candidates[np.argsort(-residuals[candidates])]:
+            tile_a, tile_b = pairs[ipair]
+            if tile_a in visited_tiles or tile_b in visited_tiles:
+                continue
+            graph.remove_edge(tile_a, tile_b)
+            if nx.has_path(graph, tile_a, tile_b):
+                outliers.append(ipair)
+                # the pairs closing loops with an outlier share its error
+                visited_tiles.update((tile_a, tile_b))
+                visited_tiles.update(graph[tile_a])
+                visited_tiles.update(graph[tile_b])
+            else:
+                graph.add_edge(tile_a, tile_b)
+        if not outliers:
+            break
+        logger.info(
+            f"Rejecting {len(outliers)} tile pairs with residuals up to "
+            f"{residuals[outliers].max():.2f}"
+        )
+        inliers[outliers] = False
+    return positions, inliers
@@ -0,0 +1,175 @@
+"""Stitches FOVs of an OME-Zarr image using plate-level FOV corrections."""
+
+import logging
+from typing import Optional
+
+from pydantic import validate_call
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs, write_fused_image
+from fractal_ome_zarr_hcs_stitching.image_context import (
+    ChunkCacheInputModel,
+    ImageContext,
+    LocalityAwareFusionInputModel,
+)
+from fractal_ome_zarr_hcs_stitching.label_utils import fuse_labels_and_tables
+from fractal_ome_zarr_hcs_stitching.utils import (
+    InitArgsPlateStitching,
+    finalize_output_image,
+    get_output_zarr_url,
+    register_fovs,
+    verify_fov_corrections,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@validate_call
+def plate_stitching_task(
+    *,
+    # Fractal parameters
+    zarr_url: str,
+    init_args: InitArgsPlateStitching,
+    # Core parameters
+    num_verification_pairs: int = 0,
+    max_verification_shift: float = 1.0,
+    overwrite_input: bool = False,
+    output_group_suffix: str = "fused",
+    input_cache: Optional[ChunkCacheInputModel] = None,
+    prefetch_workers: Optional[int] = None,
+    locality_aware_fusion: Optional[LocalityAwareFusionInputModel] = None,
+    low_memory_fusion: bool = False,
+    progress_file: Optional[str] = None,
+    fuse_labels: bool = False,
+):
+    """Stitches FOVs from an OME-Zarr image using plate-level corrections.
+
+    Fuses the FOVs of the image after correcting their stage positions with
+    the corrections learned on the reference wells by
+    `init_plate_stitching_task`, without registering all tile pairs again.
+    Reference images are fused with the corrections registered on them.
+
+    Args:
+        zarr_url: Absolute path or fsspec URL (e.g. on S3-compatible object
+            storage, `s3://bucket/plate.zarr/B/03/0`) to the OME-Zarr image.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        init_args: Intialization arguments provided by
+            `init_plate_stitching_task`.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        num_verification_pairs: Number of overlapping tile pairs to register
+            after applying the plate-level corrections, as a check that they
+            fit this image. Set to 0 to skip the check.
+        max_verification_shift: Largest remaining shift (in micrometer)
+            between verified tile pairs for which the plate-level corrections
+            are accepted. Otherwise, all tile pairs of this image are
+            registered.
+        overwrite_input: Whether to override the original, not stitched image
+            with the output of this task.
+        output_group_suffix: Suffix of the new OME-Zarr image to write the
+            fused image to.
+        input_cache: If set, chunks of the input image are staged in a
+            read-through cache in memory or on a node-local disk (see
+            `stitching_task`).
+        prefetch_workers: If set, chunks of the input image are read and
+            fused blocks are written concurrently by this many threads (see
+            `stitching_task`).
+        locality_aware_fusion: If set, output chunks are fused in an order
+            that reuses cached input chunks (see `stitching_task`).
+        low_memory_fusion: Whether to fuse FOVs in single precision and one
+            at a time (see `stitching_task`).
+        progress_file: Local path of a JSON file to which the progress of
+            fusion and of building the pyramid is written periodically (see
+            `stitching_task`).
+        fuse_labels: Whether to also fuse the label images of the input
+            image with the same transforms (see `stitching_task`).
+    """
+    logger.info(f"{zarr_url=}")
+
+    image_context = ImageContext(
+        zarr_url,
+        input_cache=input_cache,
+        prefetch_workers=prefetch_workers,
+        locality_aware_fusion=locality_aware_fusion,
+    )
+    try:
+        fov_corrections = init_args.fov_corrections
+
+        if (
+            num_verification_pairs > 0
+            and fov_corrections
+            and not init_args.is_reference
+        ):
+            channel = init_args.channel
+            omero_channel = channel.get_omero_channel(
+                zarr_url, image_context=image_context
+            )
+            if not omero_channel:
+                logger.info(
+                    f"Skipping stitching for {zarr_url} because {channel} is "
+                    "not available in that OME-Zarr image"
+                )
+                return
+
+            logger.info("Started verification of plate-level FOV corrections")
+            max_shift = verify_fov_corrections(
+                image_context,
+                fov_corrections,
+                reg_channel_index=omero_channel.index,
+                num_pairs=num_verification_pairs,
+                registration_resolution_level=init_args.registration_resolution_level,
+                registration_on_z_proj=init_args.registration_on_z_proj,
+                registration_focus_planes=init_args.registration_focus_planes,
+            )
+            if max_shift is not None and max_shift > max_verification_shift:
+                logger.warning(
+                    f"Plate-level FOV corrections leave a shift of {max_shift:.2f} "
+                    f"micrometer (> {max_verification_shift}). Registering all "
+                    "tile pairs of this image instead."
+                )
+                fov_corrections = register_fovs(
+                    image_context,
+                    reg_channel_index=omero_channel.index,
+                    registration_resolution_level=init_args.registration_resolution_level,
+                    registration_on_z_proj=init_args.registration_on_z_proj,
+                    registration_focus_planes=init_args.registration_focus_planes,
+                    pre_registration_pruning_method=init_args.pre_registration_pruning_method,
+                    registration_parallelization=init_args.registration_parallelization,
+                    global_optimization_method=init_args.global_optimization_method,
+                )
+                logger.info(f"Obtained shifts: {fov_corrections}")
+            logger.info("Finished verification of plate-level FOV corrections")
+
+        fused = fuse_fovs(
+            image_context, fov_corrections, low_memory_fusion=low_memory_fusion
+        )
+
+        output_zarr_url = get_output_zarr_url(zarr_url, output_group_suffix)
+        logger.info(f"Output fused path: {output_zarr_url}")
+
+        write_fused_image(
+            image_context,
+            fused,
+            output_zarr_url,
+            fov_corrections=fov_corrections,
+            progress_file=progress_file,
+        )
+        if fuse_labels:
+            fuse_labels_and_tables(
+                image_context, fov_corrections, fused, output_zarr_url
+            )
+        image_context.log_cache_statistics()
+
+        image_list_updates = finalize_output_image(
+            zarr_url, output_zarr_url, overwrite_input=overwrite_input
+        )
+
+        logger.info("Done stitching")
+
+        return image_list_updates
+    finally:
+        image_context.close()
+
+
+if __name__ == "__main__":
+    from fractal_tasks_core.tasks._utils import run_fractal_task
+
+    run_fractal_task(task_function=plate_stitching_task)
@@ -0,0 +1,167 @@
+"""Periodic progress reports of the chunks written by long computations."""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import dask.array as da
+
+from fractal_ome_zarr_hcs_stitching.store_utils import CountingStore
+
+logger = logging.getLogger(__name__)
+
+# Default number of seconds between two progress reports
+PROGRESS_INTERVAL_SECONDS = 60.0
+
+
+def _format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+class ProgressReporter:
+    """Periodically report the progress of a stage writing chunks.
+
+    Used as a context manager around the stage. Meanwhile, a background
+    thread logs the number of chunks done out of the total, the read and
+    write throughput of the counted stores and the estimated time remaining
+    every `interval` seconds, and once more when the stage ends. If
+    `progress_file` is set, each report is also written to it as JSON. The
+    file is replaced atomically, so that a scheduler can poll it at any time.
+
+    Args:
+        stage: Name of the stage, e.g. `fusion`.
+        total_chunks: Number of chunks the stage computes.
+        stores: Stores whose reads and writes make up the throughput. More
+            can be added by `wrap_store`.
+        interval: Seconds between two reports.
+        progress_file: Local path of a JSON file to write the reports to.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        total_chunks: int,
+        stores: Optional[list[CountingStore]] = None,
+        interval: float = PROGRESS_INTERVAL_SECONDS,
+        progress_file: Optional[str] = None,
+    ):
+        """Create a reporter; the clock starts when entering the context."""
+        self.stage = stage
+        self.total_chunks = total_chunks
+        self.interval = interval
+        self.progress_file = progress_file
+        self.chunks_done = 0
+        self._stores = {}
+        for store in stores or []:
+            self._add_store(store)
+        self._mutex = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def _add_store(self, store: CountingStore):
+        # only count the bytes read and written from now on
+        self._stores[id(store)] = (store, store.bytes_read, store.bytes_written)
+
+    def wrap_store(self, store) -> CountingStore:
+        """Wrap a store to count its reads and writes into the throughput."""
+        counting_store = CountingStore(store)
+        self._add_store(counting_store)
+        return counting_store
+
+    def update(self, num_chunks: int = 1):
+        """Record that chunks were done."""
+        with self._mutex:
+            self.chunks_done += num_chunks
+
+    def _count_block(self, block):
+        self.update()
+        return block
+
+    def track(self, array: da.Array) -> da.Array:
+        """Count the blocks of a dask array as done when they are computed."""
+        # passing the meta avoids a call to infer it, which would be counted
+        return array.map_blocks(
+            self._count_block, meta=array._meta, name=f"progress-{array.name}"
+        )
+
+    def get_report(self, status: str = "running") -> dict:
+        """Progress, throughput and estimated remaining time of the stage.
+
+        Args:
+            status: Status of the stage, `running`, `finished` or `failed`.
+        """
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        bytes_read = sum(
+            store.bytes_read - read for store, read, _ in self._stores.values()
+        )
+        bytes_written = sum(
+            store.bytes_written - written for store, _, written in self._stores.values()
+        )
+        chunks_done = self.chunks_done
+        eta = None
+        if status == "running" and chunks_done:
+            eta = elapsed / chunks_done * (self.total_chunks - chunks_done)
+        return {
+            "stage": self.stage,
+            "status": status,
+            "chunks_done": chunks_done,
+            "chunks_total": self.total_chunks,
+            "elapsed_seconds": elapsed,
+            "read_mb_per_second": bytes_read / 2**20 / elapsed if elapsed else 0.0,
+            "written_mb_per_second": (
+                bytes_written / 2**20 / elapsed if elapsed else 0.0
+            ),
+            "eta_seconds": eta,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+
+    def _write_progress_file(self, report: dict):
+        if self.progress_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.progress_file))
+        os.makedirs(directory, exist_ok=True)
+        tmp_file = f"{self.progress_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(report, f)
+        os.replace(tmp_file, self.progress_file)
+
+    def report(self, status: str = "running"):
+        """Log the progress and write it to the progress file, if set."""
+        report = self.get_report(status)
+        percent = report["chunks_done"] / max(report["chunks_total"], 1)
+        if report["eta_seconds"] is not None:
+            eta = f"ETA {_format_duration(report['eta_seconds'])}"
+        else:
+            eta = f"{status} after {_format_duration(report['elapsed_seconds'])}"
+        logger.info(
+            f"{self.stage.capitalize()}: {report['chunks_done']}/"
+            f"{report['chunks_total']} chunks ({percent:.1%}), "
+            f"read {report['read_mb_per_second']:.1f} MB/s, "
+            f"written {report['written_mb_per_second']:.1f} MB/s, {eta}"
+        )
+        self._write_progress_file(report)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        """Start the clock and the background reports."""
+        self._start_time = time.perf_counter()
+        self._write_progress_file(self.get_report())
+        self._thread = threading.Thread(
+            target=self._run, name=f"progress-{self.stage}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop the background reports and report the outcome."""
+        self._stopped.set()
+        self._thread.join()
+        self.report("failed" if exc_type is not None else "finished")
@@ -1,86 +1,101 @@
 """This is the Python module for sitching FOVs from an OME-Zarr image."""
 
 import logging
-import os
-import shutil
-from pathlib import Path
-
-import anndata as ad
-import numpy as np
-import zarr
-from fractal_tasks_core.ngff import load_NgffImageMeta
-from fractal_tasks_core.ngff.zarr_utils import ZarrGroupNotFoundError
-from fractal_tasks_core.pyramids import build_pyramid
-from fractal_tasks_core.roi import get_single_image_ROI
-from fractal_tasks_core.tables import write_table
-from fractal_tasks_core.tasks._zarr_utils import (
-    _split_well_path_image_path,
-    _update_well_metadata,
-)
-from multiview_stitcher import fusion, msi_utils, param_utils, registration
-from multiview_stitcher import spatial_image_utils as si_utils
-from multiview_stitcher.mv_graph import NotEnoughOverlapError
-from ome_zarr import writer
-from ome_zarr.io import parse_url
+from typing import Optional
+
 from pydantic import validate_call
 
+from fractal_ome_zarr_hcs_stitching.cost_utils import (
+    estimate_stitching_cost,
+    log_stitching_cost,
+)
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs, write_fused_image
+from fractal_ome_zarr_hcs_stitching.hierarchical_utils import (
+    register_fovs_hierarchically,
+)
+from fractal_ome_zarr_hcs_stitching.image_context import (
+    ChunkCacheInputModel,
+    ImageContext,
+    LocalityAwareFusionInputModel,
+)
+from fractal_ome_zarr_hcs_stitching.incremental_utils import (
+    find_changed_fovs,
+    get_fov_checksums,
+    read_stitching_state,
+    register_changed_fovs,
+    update_fused_image,
+    write_stitching_state,
+)
+from fractal_ome_zarr_hcs_stitching.label_utils import fuse_labels_and_tables
 from fractal_ome_zarr_hcs_stitching.utils import (
+    GlobalOptimizationMethod,
+    HierarchicalRegistrationInputModel,
     PreRegistrationPruningMethod,
+    RegistrationParallelizationInputModel,
     StitchingChannelInputModel,
-    get_sim_from_multiscales,
-    get_tiles_from_sim,
+    finalize_output_image,
+    get_output_zarr_url,
+    register_fovs,
 )
 
 logger = logging.getLogger(__name__)
 
 
-@validate_call
-def stitching_task(
-    *,
-    zarr_url: str,
-    channel: StitchingChannelInputModel,
-    overwrite_input: bool = False,
-    output_group_suffix: str = "fused",
-    registration_resolution_level: int = 0,
-    registration_on_z_proj: bool = True,
-    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
-) -> None:
-    """Stitches FOVs from an OME-Zarr image.
+class ImageRegistration:
+    """Outcome of registering the FOVs of an image, as needed for fusion.
+
+    Attributes:
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension.
+        output_zarr_url: Path of the fused image.
+        fusion_resolution: Resolution level to fuse on.
+        preview: Whether the fused image is a preview.
+        incremental: Whether the stitching is incremental.
+        state: State of the last incremental run, if any.
+        changed_fovs: FOVs changed since the last incremental run, or None
+            to fuse the image in full.
+        fov_checksums: Checksums of the FOVs, for the next incremental run.
+    """
 
-    Performs registration and fusion of FOVs indicated
-    in the FOV_ROI_table of the OME-Zarr image. Writes the
-    fused image back to a "fused" group in the same Zarr array.
+    def __init__(
+        self,
+        fov_corrections: dict[str, dict[str, float]],
+        output_zarr_url: str,
+        fusion_resolution: int = 0,
+        preview: bool = False,
+        incremental: bool = False,
+        state: Optional[dict] = None,
+        changed_fovs: Optional[list[str]] = None,
+        fov_checksums: Optional[dict[str, str]] = None,
+    ):
+        """Bundle the results of registration."""
+        self.fov_corrections = fov_corrections
+        self.output_zarr_url = output_zarr_url
+        self.fusion_resolution = fusion_resolution
+        self.preview = preview
+        self.incremental = incremental
+        self.state = state
+        self.changed_fovs = changed_fovs
+        self.fov_checksums = fov_checksums
+
+
+def check_stitching_modes(overwrite_input: bool, incremental: bool, preview: bool):
+    """Raise if stitching modes are combined that exclude each other."""
+    if incremental and overwrite_input:
+        raise ValueError(
+            "Incremental stitching updates the fused image next to the input "
+            "image and can't be combined with overwrite_input."
+        )
+    if preview and (overwrite_input or incremental):
+        raise ValueError(
+            "Preview stitching writes a standalone image and can't be combined "
+            "with overwrite_input or incremental."
+        )
 
-    Todo:
-      - include and update output metadata / FOV ROI table
-      - test 2D / 3D
-      - optimize for large data
-      - currently optimized for search first mode, need to implement
-        registration pair finding for "grid" (?) mode
 
-    Args:
-        zarr_url: Absolute path to the OME-Zarr image.
-        channel: Channel for registration; requires either
-            `wavelength_id` (e.g. `A01_C01`) or `label` (e.g. `DAPI`), but not
-            both.
-        overwrite_input: Whether to override the original, not stitched image
-            with the output of this task.
-        output_group_suffix: Suffix of the new OME-Zarr image to write the
-            fused image to.
-        registration_resolution_level: Resolution level to use for registration.
-        registration_on_z_proj: Whether to perform registration on a maximum
-            projection along z in case of 3D data.
-        pre_registration_pruning_method: Method to use for selecting a subset
-            of all overlapping tiles for pairwise registration. By default,
-            only lower, upper, right and left neighbors are considered. Set
-            this parameter to no_pruning if pairs of tiles which deviate
-            from this pattern need to be registered.
-    """
-    # Use the first of input_paths
-    logger.info(f"{zarr_url=}")
-
-    # Parse and log several NGFF-image metadata attributes
-    ngff_image_meta = load_NgffImageMeta(zarr_url)
+def log_image_metadata(image_context: ImageContext):
+    """Parse and log several NGFF-image metadata attributes."""
+    ngff_image_meta = image_context.ngff_image_meta
     logger.info(f"  Axes: {ngff_image_meta.axes_names}")
     logger.info(f"  Number of pyramid levels: {ngff_image_meta.num_levels}")
     logger.info(
@@ -95,42 +110,49 @@ def stitching_task(
         f"{ngff_image_meta.get_pixel_sizes_zyx(level=1)}"
     )
 
-    fov_roi_table = ad.read_zarr(Path(zarr_url) / "tables/FOV_ROI_table").to_df()
-    input_transform_key = "fractal_input"
 
-    #############
-    # Registration
-    ##############
+def get_fusion_resolution(image_context: ImageContext, preview: bool) -> int:
+    """Resolution level to fuse on, the coarsest one for a preview."""
+    if preview:
+        return image_context.ngff_image_meta.num_levels - 1
+    return 0
 
-    # Load FOVs for registration
-    xim_well_reg = get_sim_from_multiscales(
-        Path(zarr_url), resolution=registration_resolution_level
-    )  # could also be lower resolution
 
-    input_spatial_dims = si_utils.get_spatial_dims_from_sim(
-        xim_well_reg.squeeze(drop=True)
-    )
-
-    # determine whether to perform registration on maximum projection in Z
-    reg_max_project_z = registration_on_z_proj and ("z" in input_spatial_dims)
-
-    if reg_max_project_z:
-        xim_well_reg = xim_well_reg.max("z")
-
-    msims_reg = get_tiles_from_sim(
-        xim_well_reg, fov_roi_table, transform_key=input_transform_key
-    )
+def register_image(
+    image_context: ImageContext,
+    channel: StitchingChannelInputModel,
+    output_group_suffix: str = "fused",
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    global_optimization_method: GlobalOptimizationMethod = GlobalOptimizationMethod.ITERATIVE,  # noqa: E501
+    hierarchical_registration: Optional[HierarchicalRegistrationInputModel] = None,
+    incremental: bool = False,
+    incremental_content_checksums: bool = False,
+    preview: bool = False,
+) -> Optional[ImageRegistration]:
+    """Register the FOVs of an image, the first phase of `stitching_task`.
+
+    Arguments are as for `stitching_task`.
+
+    Returns:
+        The registration, or None if the image lacks the channel.
+    """
+    zarr_url = image_context.zarr_url
 
-    reg_spatial_dims = si_utils.get_spatial_dims_from_sim(
-        xim_well_reg.squeeze(drop=True)
-    )
+    #############
+    # Registration
+    ##############
 
     logger.info("Started registration")
-    logger.info(f"Registration res level: {registration_resolution_level}")
-    logger.info(f"Registration spatial dims: {reg_spatial_dims}")
 
     # Find channel index
-    omero_channel = channel.get_omero_channel(zarr_url)
+    omero_channel = channel.get_omero_channel(zarr_url, image_context=image_context)
     if omero_channel:
         reg_channel_index = omero_channel.index
     else:
@@ -138,228 +160,446 @@ def stitching_task(
             f"Skipping stitching for {zarr_url} because {channel} is "
             "not available in that OME-Zarr image"
         )
-        return
-
-    try:
-        fusion_transform_key = "translation_registered"
-        params = registration.register(
-            msims_reg,
-            transform_key=input_transform_key,
-            new_transform_key=fusion_transform_key,
+        return None
+
+    fusion_resolution = get_fusion_resolution(image_context, preview)
+    if preview:
+        output_group_suffix = f"{output_group_suffix}_preview"
+        registration_resolution_level = fusion_resolution
+        logger.info(f"Preview: stitching on resolution level {fusion_resolution}")
+
+    output_zarr_url = get_output_zarr_url(zarr_url, output_group_suffix)
+    state = changed_fovs = fov_checksums = None
+    if incremental:
+        fov_checksums = get_fov_checksums(
+            image_context, content_checksums=incremental_content_checksums
+        )
+        state = read_stitching_state(output_zarr_url)
+        changed_fovs = find_changed_fovs(image_context, state, fov_checksums)
+
+    if changed_fovs is not None:
+        if (
+            hierarchical_registration is not None
+            or global_optimization_method != GlobalOptimizationMethod.ITERATIVE
+        ):
+            logger.warning(
+                "hierarchical_registration and global_optimization_method are "
+                "only used when stitching in full: the changed FOVs are "
+                "registered on registration_resolution_level and placed by "
+                "least squares against the unchanged ones"
+            )
+        fov_corrections = register_changed_fovs(
+            image_context,
+            changed_fovs=changed_fovs,
+            previous_corrections=state["fov_corrections"],
             reg_channel_index=reg_channel_index,
-            registration_binning={dim: 1 for dim in reg_spatial_dims},
-            pre_registration_pruning_method=pre_registration_pruning_method.get_pruning_method(),
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            registration_focus_planes=registration_focus_planes,
+            registration_parallelization=registration_parallelization,
         )
-        shifts = {
-            ip: {
-                dim: s
-                for dim, s in zip(
-                    reg_spatial_dims,
-                    param_utils.translation_from_affine(p.sel(t=0).data),
-                )
-            }
-            for ip, p in enumerate(params)
-            if not np.allclose(p.sel(t=0).data, np.eye(len(reg_spatial_dims) + 1))
-        }
-        logger.info(f"Obtained shifts: {shifts}")
-    except NotEnoughOverlapError:
-        logger.warning(
-            "Did not find overlapping tiles for stitching. Skipping registration."
+    elif hierarchical_registration is not None:
+        fov_corrections = register_fovs_hierarchically(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            hierarchical_registration=hierarchical_registration,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            registration_focus_planes=registration_focus_planes,
+            registration_parallelization=registration_parallelization,
         )
-        fusion_transform_key = input_transform_key
+    else:
+        fov_corrections = register_fovs(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            registration_focus_planes=registration_focus_planes,
+            registration_parallelization=registration_parallelization,
+            global_optimization_method=global_optimization_method,
+        )
+    logger.info(f"Obtained shifts: {fov_corrections}")
 
     logger.info("Finished registration")
+    image_context.log_cache_statistics()
+    return ImageRegistration(
+        fov_corrections,
+        output_zarr_url,
+        fusion_resolution=fusion_resolution,
+        preview=preview,
+        incremental=incremental,
+        state=state,
+        changed_fovs=changed_fovs,
+        fov_checksums=fov_checksums,
+    )
 
-    ########
-    # Fusion
-    ########
 
-    if registration_resolution_level == 0 and not reg_max_project_z:
-        xim_well = xim_well_reg
-        msims_fusion = msims_reg
-    else:
-        # Load the full-resolution image for fusion
-        xim_well = get_sim_from_multiscales(Path(zarr_url), resolution=0)
-        msims_fusion = get_tiles_from_sim(
-            xim_well, fov_roi_table, transform_key=input_transform_key
+def estimate_image_cost(
+    image_context: ImageContext,
+    output_group_suffix: str = "fused",
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    hierarchical_registration: Optional[HierarchicalRegistrationInputModel] = None,
+    low_memory_fusion: bool = False,
+    incremental: bool = False,
+    incremental_content_checksums: bool = False,
+    preview: bool = False,
+) -> dict:
+    """Estimate the cost of stitching an image, the dry run of `stitching_task`.
+
+    The levels and pairs are chosen as by `register_image`: a preview is
+    registered and fused on the coarsest level, hierarchical registration
+    starts on its coarse level and an incremental update only registers the
+    pairs of the FOVs changed since the last run. The changed FOVs are found
+    from the chunk listing; with `incremental_content_checksums`, which
+    would read all chunks, the image is estimated as stitched in full.
+
+    Arguments are as for `stitching_task`.
+
+    Returns:
+        Report of `estimate_stitching_cost`.
+    """
+    fusion_resolution = get_fusion_resolution(image_context, preview)
+    if preview:
+        registration_resolution_level = fusion_resolution
+
+    changed_fovs = None
+    if incremental and not incremental_content_checksums:
+        changed_fovs = find_changed_fovs(
+            image_context,
+            read_stitching_state(
+                get_output_zarr_url(image_context.zarr_url, output_group_suffix)
+            ),
+            get_fov_checksums(image_context),
         )
-
-    # assign the registration parameters to the tiles to be fused
-    for itile in range(len(msims_fusion)):
-        affine = msi_utils.get_transform_from_msim(
-            msims_reg[itile], fusion_transform_key
+    coarse_resolution_level = None
+    if hierarchical_registration is not None and changed_fovs is None:
+        coarse_resolution_level = hierarchical_registration.get_coarse_level(
+            image_context.ngff_image_meta.num_levels, registration_resolution_level
         )
 
-        # if the registration was performed on a maximum projection in Z, we need to
-        # broadcast the obtained affine parameters to 3D
-        if reg_max_project_z:
-            affine_3d = param_utils.identity_transform(
-                ndim=3, t_coords=affine.coords["t"] if "t" in affine.dims else None
-            )
-            affine_3d.loc[{pdim: affine.coords[pdim] for pdim in affine.dims}] = affine
-            affine = affine_3d
+    return estimate_stitching_cost(
+        image_context,
+        registration_resolution_level=registration_resolution_level,
+        registration_on_z_proj=registration_on_z_proj,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+        low_memory_fusion=low_memory_fusion,
+        fusion_resolution=fusion_resolution,
+        coarse_resolution_level=coarse_resolution_level,
+        min_overlap_signal_fraction=min_overlap_signal_fraction,
+        changed_fovs=changed_fovs,
+    )
 
-        msi_utils.set_affine_transform(
-            msims_fusion[itile], affine, fusion_transform_key
-        )
 
-    sims = [msi_utils.get_sim_from_msim(msim) for msim in msims_fusion]
-    sdims = si_utils.get_spatial_dims_from_sim(xim_well)
-    ndim = len(sdims)
+def fuse_image(
+    image_context: ImageContext,
+    registration: ImageRegistration,
+    overwrite_input: bool = False,
+    low_memory_fusion: bool = False,
+    fuse_labels: bool = False,
+    progress_file: Optional[str] = None,
+) -> Optional[dict]:
+    """Fuse a registered image, the second phase of `stitching_task`.
 
-    logger.info(f"Started fusion using transform key {fusion_transform_key}")
+    Arguments are as for `stitching_task`.
 
-    output_chunksize = {
-        dim: xim_well.data.chunksize[(-ndim + idim)] for idim, dim in enumerate(sdims)
-    }
-    logger.info(f"Output chunksize: {output_chunksize}")
-    logger.info("Started building fusion graph")
+    Returns:
+        Image list updates for Fractal, or None if the input was replaced or
+        a preview was written.
+    """
+    zarr_url = image_context.zarr_url
+    fov_corrections = registration.fov_corrections
+    output_zarr_url = registration.output_zarr_url
+    changed_fovs = registration.changed_fovs
 
-    fused = fusion.fuse(
-        sims,
-        transform_key=fusion_transform_key,
-        output_chunksize=output_chunksize,
-        output_spacing=si_utils.get_spacing_from_sim(sims[0]),
-        # fusion_func=fusion.max_fusion,
+    ########
+    # Fusion
+    ########
+
+    fused = fuse_fovs(
+        image_context,
+        fov_corrections,
+        resolution=registration.fusion_resolution,
+        low_memory_fusion=low_memory_fusion,
     )
 
-    fused = fused.sel(t=0, drop=True)
+    logger.info(f"Output fused path: {output_zarr_url}")
 
-    if "z" not in fused.dims:
-        fused = fused.expand_dims("z", xim_well.dims.index("z"))
+    if changed_fovs is None or not update_fused_image(
+        image_context,
+        fused,
+        output_zarr_url,
+        registration.state,
+        changed_fovs,
+        fov_corrections,
+        progress_file=progress_file,
+    ):
+        write_fused_image(
+            image_context,
+            fused,
+            output_zarr_url,
+            fov_corrections=fov_corrections,
+            resolution=registration.fusion_resolution,
+            progress_file=progress_file,
+        )
+    if registration.preview:
+        image_context.log_cache_statistics()
+        logger.info(f"Done stitching preview {output_zarr_url}")
+        return None
+    if registration.incremental:
+        write_stitching_state(
+            image_context,
+            output_zarr_url,
+            fused,
+            fov_corrections,
+            registration.fov_checksums,
+        )
+    if fuse_labels:
+        fuse_labels_and_tables(image_context, fov_corrections, fused, output_zarr_url)
+    image_context.log_cache_statistics()
 
-    # get the dask array from the fused sim
-    fused_da = fused.sel({"c": fused.coords["c"].values}).data
+    ####################
+    # Clean up Zarr file
+    ####################
+    image_list_updates = finalize_output_image(
+        zarr_url, output_zarr_url, overwrite_input=overwrite_input
+    )
 
-    logger.info("Finished building fusion graph")
+    logger.info("Done stitching")
 
-    well_url, old_img_path = _split_well_path_image_path(zarr_url)
-    output_zarr_url = f"{well_url}/{zarr_url.split('/')[-1]}_{output_group_suffix}"
-    logger.info(f"Output fused path: {output_zarr_url}")
+    return image_list_updates
 
-    # Open output array. This allows setting `write_empty_chunks=True`,
-    # which cannot be passed to dask.array.to_zarr below.
-    output_zarr_arr = zarr.open(
-        f"{output_zarr_url}/0",
-        shape=fused_da.shape,
-        chunks=fused_da.chunksize,
-        dtype=fused_da.dtype,
-        write_empty_chunks=False,
-        dimension_separator="/",
-        fill_value=0,
-        mode="w",
-    )
 
-    logger.info("Started fusion computation")
+@validate_call
+def stitching_task(
+    *,
+    zarr_url: str,
+    channel: StitchingChannelInputModel,
+    overwrite_input: bool = False,
+    output_group_suffix: str = "fused",
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    global_optimization_method: GlobalOptimizationMethod = GlobalOptimizationMethod.ITERATIVE,  # noqa: E501
+    hierarchical_registration: Optional[HierarchicalRegistrationInputModel] = None,
+    input_cache: Optional[ChunkCacheInputModel] = None,
+    prefetch_workers: Optional[int] = None,
+    locality_aware_fusion: Optional[LocalityAwareFusionInputModel] = None,
+    low_memory_fusion: bool = False,
+    progress_file: Optional[str] = None,
+    fuse_labels: bool = False,
+    dry_run: bool = False,
+    incremental: bool = False,
+    incremental_content_checksums: bool = False,
+    preview: bool = False,
+) -> None:
+    """Stitches FOVs from an OME-Zarr image.
 
-    # Write the fused array back to the same full-resolution Zarr array
-    fused_da.to_zarr(
-        output_zarr_arr,
-        overwrite=True,
-        dimension_separator="/",
-        return_stored=False,
-        compute=True,
-    )
+    Performs registration and fusion of FOVs indicated
+    in the FOV_ROI_table of the OME-Zarr image. Writes the
+    fused image back to a "fused" group in the same Zarr array.
 
-    logger.info("Finished fusion computation")
-    logger.info("Started building resolution pyramid")
-
-    # Starting from on-disk full-resolution data, build and write to disk a
-    # pyramid of coarser levels
-    # Provide original chunksize to avoid "ValueError: Attempt to save array
-    # to zarr with irregular chunking, please call `arr.rechunk(...)` first."
-    build_pyramid(
-        zarrurl=output_zarr_url,
-        overwrite=True,
-        num_levels=ngff_image_meta.num_levels,
-        chunksize=xim_well.data.chunksize,
-        coarsening_xy=ngff_image_meta.coarsening_xy,
-        open_array_kwargs={"write_empty_chunks": False, "fill_value": 0},
-    )
+    Todo:
+      - include and update output metadata / FOV ROI table
+      - test 2D / 3D
+      - optimize for large data
+      - currently optimized for search first mode, need to implement
+        registration pair finding for "grid" (?) mode
 
-    # attach metadata to the fused image
-    store = parse_url(output_zarr_url, mode="w").store
-    output_group = zarr.group(store=store)
-    writer.write_multiscales_metadata(
-        group=output_group,
-        axes=ngff_image_meta.axes_names,
-        datasets=[
-            {
-                "path": fractal_ds.path,
-                "coordinateTransformations": [
-                    {
-                        "type": coordinateTransformation.type,
-                        "scale": coordinateTransformation.scale,
-                    }
-                    for coordinateTransformation in fractal_ds.coordinateTransformations
-                ],
-            }
-            for fractal_ds in ngff_image_meta.multiscales[0].datasets[
-                : ngff_image_meta.num_levels
-            ]
-        ],
-    )
-    output_group.attrs["omero"] = ngff_image_meta.omero.model_dump()
-
-    # Workaround: Manually add wavelength_id attr back to omero channel
-    original_omero_attrs = zarr.open(zarr_url).attrs["omero"]["channels"]
-    for i, omero_channel in enumerate(output_group.attrs["omero"]["channels"]):
-        omero_channel["wavelength_id"] = original_omero_attrs[i]["wavelength_id"]
-    output_attrs = output_group.attrs
-    output_group.attrs["omero"] = dict(output_attrs["omero"])
-
-    logger.info("Finished building resolution pyramid")
-
-    # Add ROI table to the image
-    ngff_image_meta.get_pixel_sizes_zyx(level=0)
-    pixels_ZYX = (
-        ngff_image_meta.multiscales[0]
-        .datasets[0]
-        .coordinateTransformations[0]
-        .scale[-3:]
-    )
-    image_ROI_table = get_single_image_ROI(fused_da.shape, pixels_ZYX=pixels_ZYX)
-    write_table(
-        output_group,
-        "well_ROI_table",  # Could also be image_ROI_table
-        image_ROI_table,
-        overwrite=True,
-        table_attrs={"type": "roi_table"},
+    Args:
+        zarr_url: Absolute path or fsspec URL (e.g. on S3-compatible object
+            storage, `s3://bucket/plate.zarr/B/03/0`) to the OME-Zarr image.
+        channel: Channel for registration; requires either
+            `wavelength_id` (e.g. `A01_C01`) or `label` (e.g. `DAPI`), but not
+            both.
+        overwrite_input: Whether to override the original, not stitched image
+            with the output of this task.
+        output_group_suffix: Suffix of the new OME-Zarr image to write the
+            fused image to.
+        registration_resolution_level: Resolution level to use for registration.
+        registration_on_z_proj: Whether to perform registration on a maximum
+            projection along z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting a subset
+            of all overlapping tiles for pairwise registration. By default,
+            only lower, upper, right and left neighbors are considered. Set
+            this parameter to no_pruning if pairs of tiles which deviate
+            from this pattern need to be registered.
+        min_overlap_signal_fraction: If set, tile pairs are only registered
+            if at least this fraction (between 0 and 1) of their overlap
+            contains signal, as determined cheaply on the coarsest pyramid
+            level. This skips empty or low-signal tiles of sparse wells,
+            which are placed at their stage positions instead.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many z planes around the
+            best-focus plane of each FOV are projected for registration,
+            instead of the whole stack. The best-focus plane is found by a
+            sharpness measure on the coarsest pyramid level. This reduces
+            the planes read for registration and avoids blurry projections
+            of thick samples.
+        registration_parallelization: If set, tile pairs are registered in
+            batches of at most `max_parallel_pairs` pairs, fewer if their
+            estimated memory would exceed `memory_limit_mb`, each by as many
+            threads. The tiles of the next batch are only read once the
+            previous batch is registered, which bounds the memory used.
+            Otherwise, all pairs are registered at once in 2D and one pair at
+            a time in 3D, which either risks running out of memory or leaves
+            CPUs idle.
+        global_optimization_method: Method to find the FOV positions
+            agreeing best with the registered tile pairs. The default
+            iterative optimization of multiview-stitcher suits up to a few
+            hundred FOVs; sparse_least_squares scales to thousands of FOVs
+            and rejects tile pairs that disagree with the others by more
+            than two pixels.
+        hierarchical_registration: If set, all tile pairs are registered on
+            a coarse pyramid level first. Pairs with a low quality or an
+            ambiguous shift are refined on each finer level down to
+            `registration_resolution_level`, in their overlap at the coarse
+            estimate, and all other pairs only in a small window of that
+            overlap on `registration_resolution_level`. The FOV positions are
+            then found by sparse least squares, as with
+            `global_optimization_method` sparse_least_squares. This reads
+            far less full-resolution data for the same accuracy.
+        input_cache: If set, chunks of the input image are staged in a
+            read-through cache in memory or on a node-local disk, so that
+            chunks read repeatedly by registration and fusion are fetched
+            from the (network) storage only once.
+        prefetch_workers: If set, chunks of the input image are read
+            concurrently by this many threads, and the chunks needed for the
+            next fusion blocks are read ahead while the current blocks are
+            fused. Fused blocks are also written by this many threads.
+            Speeds up fusion on high-latency storage like network
+            filesystems or object stores.
+        locality_aware_fusion: If set, the output chunks are fused in
+            batches in a fixed order keeping neighboring chunks together
+            (along a Hilbert curve or row by row), and decoded input chunks
+            are kept in a bounded cache in between. Input chunks shared by
+            neighboring output chunks are then read about once, instead of
+            being re-read in the order chosen by dask. The re-read ratio of
+            the input chunks is logged after fusion in any case.
+        low_memory_fusion: Whether to fuse FOVs in single precision and one
+            at a time, instead of holding all FOVs overlapping an output chunk
+            and their blending weights in double precision. Needs several
+            times less memory per chunk and is faster on 3D images. Fused
+            intensities may differ by one gray value due to rounding.
+        progress_file: Local path of a JSON file to which the progress of
+            fusion and of building the pyramid is written periodically: the
+            stage, its status, the chunks done out of the total, the read and
+            write throughput in MB/s and the estimated remaining seconds,
+            e.g. for a scheduler to poll. The progress is logged every minute
+            in any case.
+        fuse_labels: Whether to also fuse the label images of the input
+            image with the same transforms, without registering again. Label
+            IDs are preserved: FOVs are placed to the nearest pixel and, in
+            overlaps, each pixel takes the label of the FOV whose border is
+            farthest away. ROI tables are moved with their FOVs and feature
+            tables of the label images are copied.
+        dry_run: If set, only the metadata and the FOV ROI table are read
+            to log an estimate of the input and output sizes, the number of
+            output chunks, the tile pairs to register and the peak memory.
+            The levels and pairs follow `preview`, `hierarchical_registration`
+            and `incremental` (listing the input chunks to find the changed
+            FOVs); with `min_overlap_signal_fraction`, the number of pairs is
+            an upper bound. Nothing is registered, fused or written. Useful to
+            choose the resources of the task before processing a plate.
+        incremental: If set, an existing fused image is updated after some
+            FOVs were re-acquired: FOVs whose ROI or input chunks changed
+            since the last incremental run are detected from a listing of
+            the input chunks (their sizes and modification times or ETags),
+            only tile pairs involving them are registered, and only the
+            output chunks and pyramid tiles they cover are fused again. The
+            changed FOVs are registered on `registration_resolution_level`
+            and placed by least squares against the unchanged FOVs, which
+            keep their positions: `hierarchical_registration` and
+            `global_optimization_method` only apply when the image is
+            stitched in full. Falls back to a full stitching (recording the
+            state for the next run) if there is no previous state, FOVs were
+            removed or the extent of the fused image changed. Label images
+            are fused in full. Can't be combined with `overwrite_input`.
+        incremental_content_checksums: If set together with `incremental`,
+            changed FOVs are detected by hashing the stored bytes of their
+            input chunks, one chunk at a time, instead of from the chunk
+            listing. This reads the whole full-resolution input, but does not
+            take chunks rewritten with identical content for changes.
+        preview: If set, the FOVs are registered and fused on the coarsest
+            pyramid level only, for a quick quality control of the stitching.
+            The result is written as a single-level image with the suffix
+            `{output_group_suffix}_preview`, which is not added to the well;
+            label images are not fused. Can't be combined with
+            `overwrite_input` or `incremental`.
+    """
+    # Use the first of input_paths
+    logger.info(f"{zarr_url=}")
+    check_stitching_modes(overwrite_input, incremental, preview)
+
+    # Read the image metadata once and share it across all helpers
+    image_context = ImageContext(
+        zarr_url,
+        input_cache=input_cache,
+        prefetch_workers=prefetch_workers,
+        locality_aware_fusion=locality_aware_fusion,
     )
-
-    ####################
-    # Clean up Zarr file
-    ####################
-    if overwrite_input:
-        logger.info("Replace original zarr image with the newly created Zarr image")
-        os.rename(zarr_url, f"{zarr_url}_tmp")
-        os.rename(output_zarr_url, zarr_url)
-        shutil.rmtree(f"{zarr_url}_tmp")
-    else:
-        image_list_updates = dict(
-            image_list_updates=[dict(zarr_url=output_zarr_url, origin=zarr_url)]
-        )
-        # Update the metadata of the the well
-        well_url, new_img_path = _split_well_path_image_path(output_zarr_url)
-        try:
-            _update_well_metadata(
-                well_url=well_url,
-                old_image_path=old_img_path,
-                new_image_path=new_img_path,
-            )
-        except ZarrGroupNotFoundError:
-            logger.debug(
-                f"{zarr_url} is not in an HCS plate. No well metadata got updated"
-            )
-        except ValueError:
-            logger.debug(
-                f"Could not update well metadata, likely because "
-                f" {output_zarr_url} was already listed there."
+    try:
+        log_image_metadata(image_context)
+
+        if dry_run:
+            log_stitching_cost(
+                estimate_image_cost(
+                    image_context,
+                    output_group_suffix=output_group_suffix,
+                    registration_resolution_level=registration_resolution_level,
+                    registration_on_z_proj=registration_on_z_proj,
+                    pre_registration_pruning_method=pre_registration_pruning_method,
+                    min_overlap_signal_fraction=min_overlap_signal_fraction,
+                    hierarchical_registration=hierarchical_registration,
+                    low_memory_fusion=low_memory_fusion,
+                    incremental=incremental,
+                    incremental_content_checksums=incremental_content_checksums,
+                    preview=preview,
+                )
             )
-
-        return image_list_updates
-
-    logger.info("Done stitching")
+            return None
+
+        registration = register_image(
+            image_context,
+            channel=channel,
+            output_group_suffix=output_group_suffix,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+            pre_registration_pruning_method=pre_registration_pruning_method,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            registration_focus_planes=registration_focus_planes,
+            registration_parallelization=registration_parallelization,
+            global_optimization_method=global_optimization_method,
+            hierarchical_registration=hierarchical_registration,
+            incremental=incremental,
+            incremental_content_checksums=incremental_content_checksums,
+            preview=preview,
+        )
+        if registration is None:
+            return None
+        return fuse_image(
+            image_context,
+            registration,
+            overwrite_input=overwrite_input,
+            low_memory_fusion=low_memory_fusion,
+            fuse_labels=fuse_labels,
+            progress_file=progress_file,
+        )
+    finally:
+        image_context.close()
 
 
 if __name__ == "__main__":
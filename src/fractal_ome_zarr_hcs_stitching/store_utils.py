@@ -0,0 +1,479 @@
+"""Zarr store wrappers for reading the input images and counting I/O."""
+
+import logging
+import os
+import posixpath
+import tempfile
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+from urllib.parse import quote
+
+from zarr.errors import ReadOnlyError
+from zarr.storage import LRUStoreCache, Store, listdir, rmdir
+from zarr.util import buffer_size
+
+logger = logging.getLogger(__name__)
+
+
+class DiskLRUStoreCache(LRUStoreCache):
+    """Read-through cache staging the values of a store on a local disk.
+
+    Works like `zarr.storage.LRUStoreCache`, but keeps the cached values as
+    files in a temporary subdirectory of `cache_dir` instead of in memory.
+    This allows caching more data than fits into memory, e.g. on a node-local
+    scratch disk in front of a network filesystem. The temporary directory is
+    removed by `close` or when the cache is garbage collected.
+
+    Args:
+        store: The store containing the actual data to be cached.
+        max_size: The maximum size that the cache may grow to, in number of
+            bytes.
+        cache_dir: Directory in which to create the temporary cache directory.
+            Defaults to the system temporary directory.
+    """
+
+    def __init__(self, store, max_size: int, cache_dir: Optional[str] = None):
+        """Create the cache and its temporary directory."""
+        super().__init__(store, max_size=max_size)
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="zarr_cache_", dir=cache_dir)
+        self.cache_dir = self._tmpdir.name
+
+    def __getstate__(self):
+        """The cache is bound to a local directory and cannot be pickled."""
+        raise TypeError(f"{type(self).__name__} cannot be pickled")
+
+    def _path(self, key) -> str:
+        return os.path.join(self.cache_dir, quote(key, safe=""))
+
+    def _pop_value(self):
+        # values are stored as files; the in-memory cache only holds sizes
+        key, value_size = self._values_cache.popitem(last=False)
+        os.remove(self._path(key))
+        return value_size
+
+    def _accommodate_value(self, value_size):
+        while self._values_cache and (self._current_size + value_size > self._max_size):
+            self._current_size -= self._pop_value()
+
+    def _cache_value(self, key, value):
+        value_size = buffer_size(value)
+        if value_size > self._max_size:
+            return
+        # write to a unique file first, so that concurrent readers never see
+        # partially written values
+        tmp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        self._accommodate_value(value_size)
+        os.replace(tmp_path, self._path(key))
+        self._values_cache[key] = value_size
+        self._current_size += value_size
+
+    def _invalidate_value(self, key):
+        if key in self._values_cache:
+            self._current_size -= self._values_cache.pop(key)
+            os.remove(self._path(key))
+
+    def invalidate_values(self):
+        """Clear the values cache."""
+        with self._mutex:
+            while self._values_cache:
+                self._pop_value()
+            self._current_size = 0
+
+    def invalidate(self):
+        """Completely clear the cache."""
+        self.invalidate_values()
+        with self._mutex:
+            self._invalidate_keys()
+
+    def close(self):
+        """Clear the cache and remove its directory."""
+        with self._mutex:
+            self._values_cache.clear()
+            self._current_size = 0
+        self._tmpdir.cleanup()
+
+    def __getitem__(self, key):
+        """Read a value from the disk cache, or from the store on a miss."""
+        with self._mutex:
+            is_cached = key in self._values_cache
+            if is_cached:
+                self._values_cache.move_to_end(key)
+        if is_cached:
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = f.read()
+                with self._mutex:
+                    self.hits += 1
+                return value
+            except FileNotFoundError:
+                # evicted by another thread in the meantime
+                pass
+
+        value = self._store[key]
+        with self._mutex:
+            self.misses += 1
+            if key not in self._values_cache:
+                self._cache_value(key, value)
+        return value
+
+
+class DecodedChunkCache:
+    """Least-recently-used cache of decoded chunks of Zarr arrays.
+
+    Store caches like `LRUStoreCache` hold encoded chunks, which are decoded
+    again on every read. This cache holds decoded chunks instead, and serves
+    as the getter of dask arrays reading whole chunks (see `getitem`). A
+    chunk shared by blocks of a fused image that are computed by separate
+    dask graphs is thus read and decoded once, as long as it stays cached.
+    Cached chunks are read-only, as they are shared by all readers.
+
+    Args:
+        max_size: The maximum size that the cache may grow to, in number of
+            bytes.
+    """
+
+    def __init__(self, max_size: int):
+        """Create an empty cache."""
+        self._max_size = max_size
+        self._values_cache = OrderedDict()
+        self._current_size = 0
+        self._mutex = Lock()
+        self.hits = self.misses = 0
+
+    def __getstate__(self):
+        """The cache is shared by the threads of a process only."""
+        raise TypeError(f"{type(self).__name__} cannot be pickled")
+
+    def getitem(self, array, index):
+        """Read a region of an array through the cache.
+
+        Usable as `getitem` of `dask.array.from_array`, which reads one chunk
+        per call if the dask chunks are those of the array.
+
+        Args:
+            array: Zarr array to read from.
+            index: Tuple of slices of the region to read.
+        """
+        if not all(isinstance(s, slice) for s in index):
+            return array[index]
+        key = (array.path, tuple((s.start, s.stop) for s in index))
+        with self._mutex:
+            value = self._values_cache.get(key)
+            if value is not None:
+                self._values_cache.move_to_end(key)
+                self.hits += 1
+                return value
+
+        # concurrent misses of a chunk read it twice, as in `LRUStoreCache`
+        value = array[index]
+        value.flags.writeable = False
+        with self._mutex:
+            self.misses += 1
+            if key not in self._values_cache and value.nbytes <= self._max_size:
+                while (
+                    self._values_cache
+                    and self._current_size + value.nbytes > self._max_size
+                ):
+                    _, evicted = self._values_cache.popitem(last=False)
+                    self._current_size -= evicted.nbytes
+                self._values_cache[key] = value
+                self._current_size += value.nbytes
+        return value
+
+    def clear(self):
+        """Drop all cached chunks."""
+        with self._mutex:
+            self._values_cache.clear()
+            self._current_size = 0
+
+
+def log_store_cache_statistics(store, name: str = "Input chunk cache"):
+    """Log hits and misses of a store or decoded chunk cache, if it is one."""
+    if not isinstance(store, (LRUStoreCache, DecodedChunkCache)):
+        return
+    num_reads = store.hits + store.misses
+    hit_rate = store.hits / num_reads if num_reads else 0.0
+    logger.info(
+        f"{name}: {store.hits} hits, {store.misses} misses "
+        f"({hit_rate:.1%} hit rate), "
+        f"{store._current_size / 2**20:.1f} MB cached"
+    )
+
+
+class PrefetchingStore(Store):
+    """Store wrapper reading values concurrently and ahead of time.
+
+    On high-latency storage, reading chunks one after the other leaves the
+    bandwidth unused. This wrapper reads the keys requested together through
+    `getitems` concurrently, and `prefetch` starts reading keys that will be
+    needed soon in the background. Both use a thread pool of bounded size.
+    Prefetched values serve all reads of their key until they are discarded,
+    so that chunks shared by several blocks of a batch are read only once.
+
+    Args:
+        store: The store to read from.
+        max_workers: Maximal number of concurrent reads.
+    """
+
+    def __init__(self, store, max_workers: int = 8):
+        """Create the wrapper and its thread pool."""
+        self._store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self._pending = {}
+        self._mutex = Lock()
+        self.prefetched = self.prefetch_hits = 0
+
+    def __getstate__(self):
+        """The thread pool cannot be pickled."""
+        raise TypeError(f"{type(self).__name__} cannot be pickled")
+
+    def prefetch(self, keys):
+        """Start reading keys in the background.
+
+        Args:
+            keys: Keys to read. Keys that are already being prefetched are
+                skipped.
+        """
+        with self._mutex:
+            for key in keys:
+                if key not in self._pending:
+                    self._pending[key] = self._executor.submit(self._get, key)
+                    self.prefetched += 1
+
+    def discard(self, keys=None):
+        """Drop prefetched values that were not read.
+
+        Args:
+            keys: Keys to drop. If not set, all prefetched values are dropped.
+        """
+        with self._mutex:
+            if keys is None:
+                keys = list(self._pending)
+            futures = [self._pending.pop(key, None) for key in keys]
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+    def close(self):
+        """Drop prefetched values and shut down the thread pool."""
+        self.discard()
+        self._executor.shutdown(wait=True)
+
+    def _get(self, key):
+        try:
+            return self._store[key]
+        except KeyError:
+            # missing chunks are fine, zarr fills them with the fill value
+            return None
+
+    def _get_pending(self, key):
+        with self._mutex:
+            future = self._pending.get(key)
+            if future is not None:
+                self.prefetch_hits += 1
+        return future
+
+    def __getitem__(self, key):
+        """Read a value, waiting for it if it is being prefetched."""
+        future = self._get_pending(key)
+        value = self._store[key] if future is None else future.result()
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def getitems(self, keys, *, contexts=None):
+        """Read several values concurrently."""
+        futures = {}
+        for key in keys:
+            future = self._get_pending(key)
+            if future is None:
+                future = self._executor.submit(self._get, key)
+            futures[key] = future
+        values = {key: future.result() for key, future in futures.items()}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def __contains__(self, key):
+        """Check whether the underlying store contains a key."""
+        return key in self._store
+
+    def __iter__(self):
+        """Iterate over the keys of the underlying store."""
+        return iter(self._store)
+
+    def __len__(self):
+        """Number of keys in the underlying store."""
+        return len(self._store)
+
+    def keys(self):
+        """Keys of the underlying store."""
+        return self._store.keys()
+
+    def listdir(self, path=None):
+        """List a directory of the underlying store."""
+        return listdir(self._store, path)
+
+    def __setitem__(self, key, value):
+        """The wrapper is read-only."""
+        raise ReadOnlyError()
+
+    def __delitem__(self, key):
+        """The wrapper is read-only."""
+        raise ReadOnlyError()
+
+
+def log_prefetch_statistics(store):
+    """Log how many prefetched values were used, if the store prefetches."""
+    while isinstance(store, LRUStoreCache):
+        store = store._store
+    if not isinstance(store, PrefetchingStore):
+        return
+    logger.info(
+        f"Input prefetching: {store.prefetched} chunks prefetched, "
+        f"{store.prefetch_hits} reads served from prefetched chunks"
+    )
+
+
+class CountingStore(Store):
+    """Store wrapper counting the bytes read from and written to a store.
+
+    Reads and writes of several keys at once are passed on to the wrapped
+    store, so that stores reading or writing them concurrently still do.
+    Reads are also counted per key, to find values read repeatedly (see
+    `log_chunk_rereads`).
+
+    Args:
+        store: The store to wrap.
+    """
+
+    def __init__(self, store):
+        """Create the wrapper with zero counts."""
+        self._store = store
+        self._mutex = Lock()
+        self.bytes_read = self.bytes_written = 0
+        self.key_reads = Counter()
+        self.key_bytes_read = Counter()
+
+    def _count_read(self, values):
+        sizes = {key: buffer_size(value) for key, value in values.items()}
+        with self._mutex:
+            self.bytes_read += sum(sizes.values())
+            self.key_reads.update(sizes.keys())
+            self.key_bytes_read.update(sizes)
+
+    def _count_written(self, values):
+        num_bytes = sum(buffer_size(value) for value in values)
+        with self._mutex:
+            self.bytes_written += num_bytes
+
+    def __getitem__(self, key):
+        """Read a value."""
+        value = self._store[key]
+        self._count_read({key: value})
+        return value
+
+    def getitems(self, keys, *, contexts=None):
+        """Read several values."""
+        values = self._store.getitems(keys, contexts=contexts)
+        self._count_read(values)
+        return values
+
+    def __setitem__(self, key, value):
+        """Write a value."""
+        self._store[key] = value
+        self._count_written([value])
+
+    def setitems(self, values):
+        """Write several values."""
+        if hasattr(self._store, "setitems"):
+            self._store.setitems(values)
+        else:
+            for key, value in values.items():
+                self._store[key] = value
+        self._count_written(values.values())
+
+    def __delitem__(self, key):
+        """Delete a value."""
+        del self._store[key]
+
+    def delitems(self, keys):
+        """Delete several values, skipping missing ones."""
+        if hasattr(self._store, "delitems"):
+            self._store.delitems(keys)
+            return
+        for key in keys:
+            try:
+                del self._store[key]
+            except KeyError:
+                pass
+
+    def __contains__(self, key):
+        """Check whether the underlying store contains a key."""
+        return key in self._store
+
+    def __iter__(self):
+        """Iterate over the keys of the underlying store."""
+        return iter(self._store)
+
+    def __len__(self):
+        """Number of keys in the underlying store."""
+        return len(self._store)
+
+    def keys(self):
+        """Keys of the underlying store."""
+        return self._store.keys()
+
+    def listdir(self, path=None):
+        """List a directory of the underlying store."""
+        return listdir(self._store, path)
+
+    def rmdir(self, path=""):
+        """Remove a directory of the underlying store."""
+        rmdir(self._store, path)
+
+
+def log_chunk_rereads(
+    store: CountingStore, reads_before: Optional[Counter] = None, name: str = "Fusion"
+) -> float:
+    """Log how often the chunks of a store were read from the storage.
+
+    Metadata keys, e.g. `.zarray`, are not counted.
+
+    Args:
+        store: Counting store of the input image.
+        reads_before: Copy of `store.key_reads` taken before the reads to
+            report, e.g. before fusion. By default, all reads are reported.
+        name: Name of the reading step to log.
+
+    Returns:
+        Re-read ratio, the number of chunk reads per distinct chunk read. 1
+        if every chunk was read once, 0 if no chunk was read.
+    """
+    reads = store.key_reads - (reads_before or Counter())
+    chunk_reads = {
+        key: num_reads
+        for key, num_reads in reads.items()
+        if not posixpath.basename(key).startswith(".")
+    }
+    if not chunk_reads:
+        logger.info(f"{name} read no input chunks from the storage")
+        return 0.0
+    # chunks have the same size on every read
+    chunk_sizes = {
+        key: store.key_bytes_read[key] / store.key_reads[key] for key in chunk_reads
+    }
+    num_reads = sum(chunk_reads.values())
+    bytes_read = sum(chunk_sizes[key] * n for key, n in chunk_reads.items())
+    reread_ratio = num_reads / len(chunk_reads)
+    logger.info(
+        f"{name} read {len(chunk_reads)} input chunks "
+        f"({sum(chunk_sizes.values()) / 2**20:.1f} MB) {num_reads} times "
+        f"({bytes_read / 2**20:.1f} MB), a re-read ratio of {reread_ratio:.2f}"
+    )
+    return reread_ratio
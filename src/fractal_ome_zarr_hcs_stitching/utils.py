@@ -1,54 +1,190 @@
 """Fractal multiview stitcher utils."""
 
 import logging
+import math
 from enum import Enum
-from pathlib import Path
+from functools import partial
+from typing import Optional
 
+import dask
 import dask.array as da
+import dask.threaded
+import networkx as nx
+import numpy as np
 import pandas as pd
+import xarray as xr
+import zarr
+from dask.base import compute, tokenize
 from fractal_tasks_core.channels import (
     ChannelInputModel,
     ChannelNotFoundError,
     OmeroChannel,
-    get_channel_from_image_zarr,
-    get_omero_channel_list,
+    get_channel_from_list,
+)
+from fractal_tasks_core.ngff.zarr_utils import ZarrGroupNotFoundError
+from fractal_tasks_core.tasks._zarr_utils import _split_well_path_image_path
+from multiview_stitcher import (
+    msi_utils,
+    mv_graph,
+    param_utils,
+    registration,
 )
-from fractal_tasks_core.ngff import load_NgffImageMeta
-from multiview_stitcher import msi_utils
 from multiview_stitcher import spatial_image_utils as si_utils
+from multiview_stitcher.mv_graph import NotEnoughOverlapError
+from pydantic import BaseModel, Field
+from skimage.filters import laplace, threshold_otsu
 from spatial_image import to_spatial_image
 
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.io_utils import (
+    replace_image,
+    update_well_metadata,
+)
+from fractal_ome_zarr_hcs_stitching.optimization_utils import solve_translations
+
 logger = logging.getLogger(__name__)
 
+# Largest residual (in pixels of the registration level) of a registered tile
+# pair considered consistent by the sparse global optimization
+OUTLIER_THRESHOLD_PIXELS = 2
+
+# Bytes per pixel and tile held while registering a pair: the tiles as
+# float64 and their complex128 Fourier transforms and cross-power spectrum
+REGISTRATION_BYTES_PER_TILE_PIXEL = 8 + 2 * 16
+
+# Attribute of a fused image holding the FOV corrections it was fused with
+FOV_CORRECTIONS_KEY = "fov_corrections"
+
+
+class RegistrationParallelizationInputModel(BaseModel):
+    """Bounds on the number of tile pairs registered at the same time.
+
+    Attributes:
+        max_parallel_pairs: Maximal number of tile pairs registered at the
+            same time. If not set, the number of CPUs available to dask.
+        memory_limit_mb: Memory (in megabytes) registration may use. If set,
+            fewer pairs are registered at the same time if their estimated
+            memory would exceed it.
+        pair_memory_mb: Memory (in megabytes) needed to register one pair. If
+            not set, estimated from the size of the tiles at the registration
+            resolution level.
+    """
+
+    max_parallel_pairs: Optional[int] = Field(default=None, ge=1)
+    memory_limit_mb: Optional[float] = Field(default=None, gt=0)
+    pair_memory_mb: Optional[float] = Field(default=None, gt=0)
+
+    def get_num_workers(self, pair_memory_bytes: int) -> int:
+        """Number of pairs to register at the same time.
+
+        Args:
+            pair_memory_bytes: Estimated memory needed to register one pair,
+                used if `pair_memory_mb` is not set.
+        """
+        num_workers = self.max_parallel_pairs or dask.system.CPU_COUNT
+        if self.memory_limit_mb is not None:
+            pair_memory_mb = self.pair_memory_mb or pair_memory_bytes / 2**20
+            num_workers = min(num_workers, int(self.memory_limit_mb // pair_memory_mb))
+            if num_workers < 1:
+                logger.warning(
+                    f"Registering one tile pair needs about {pair_memory_mb:.0f} "
+                    f"MB, more than the memory limit of {self.memory_limit_mb} MB"
+                )
+        return max(num_workers, 1)
+
+
+class HierarchicalRegistrationInputModel(BaseModel):
+    """Coarse-to-fine registration, refining only unreliable tile pairs.
+
+    All tile pairs are registered on a coarse pyramid level first. Pairs
+    whose registration quality is low, or whose shift is ambiguous because
+    it disagrees with the other pairs, are registered again on each finer
+    level down to the registration resolution level, in their expected
+    overlap at the current estimate. The other pairs only read a small
+    window of the registration resolution level, centered in their
+    expected overlap, to refine the coarse estimate to its accuracy.
+
+    Attributes:
+        coarse_resolution_level: Pyramid level to register all pairs on. If
+            not set, the coarsest level.
+        min_quality: Lowest registration quality of a pair accepted without
+            refinement. The quality is the rank correlation of the
+            registered overlaps, at most 1.
+        window_size: Side length, in pixels of the registration resolution
+            level, of the window in which reliable pairs are refined. It
+            must exceed a few times the remaining error of the coarse
+            estimate, i.e. a few pixels of the coarse level.
+    """
+
+    coarse_resolution_level: Optional[int] = Field(default=None, ge=0)
+    min_quality: float = Field(default=0.8, le=1)
+    window_size: int = Field(default=128, ge=16)
+
+    def get_coarse_level(
+        self, num_levels: int, registration_resolution_level: int
+    ) -> int:
+        """Level to register all pairs on, at least the registration level.
+
+        Args:
+            num_levels: Number of pyramid levels of the image.
+            registration_resolution_level: Finest level to refine pairs on.
+        """
+        coarse_level = self.coarse_resolution_level
+        if coarse_level is None:
+            coarse_level = num_levels - 1
+        return min(max(coarse_level, registration_resolution_level), num_levels - 1)
+
 
 def get_sim_from_multiscales(
-    multiscales_path: Path,
+    multiscales_path: str,
     resolution: int = 0,
+    image_context: Optional[ImageContext] = None,
 ):
     """Get a spatial image from a multiscales ngff zarr file
     representing a given resolution level.
 
     Parameters
     ----------
-    multiscales_path : Path
-        Path to the multiscales group in the Zarr file.
+    multiscales_path : str
+        Path or URL of the multiscales group in the Zarr file.
     resolution : int, optional
         Resolution level index, by default 0
+    image_context : ImageContext, optional
+        Already loaded metadata of the image. If not provided, the metadata
+        is read from `multiscales_path`.
 
     Returns:
     -------
     spatial_image.SpatialImage
     """
-    ngff_image_meta = load_NgffImageMeta(multiscales_path)
+    if image_context is None:
+        image_context = ImageContext(multiscales_path)
+    ngff_image_meta = image_context.ngff_image_meta
     axes = ngff_image_meta.axes_names
     spatial_dims = [dim for dim in axes if dim in ["z", "y", "x"]]
     scales = ngff_image_meta.pixel_sizes_zyx
 
-    channel_names = [
-        oc.label for oc in get_omero_channel_list(image_zarr_path=multiscales_path)
-    ]
+    channel_names = [oc.label for oc in image_context.omero_channels]
 
-    data = da.from_zarr(f"{multiscales_path / Path(str(resolution))}")
+    # Name the array explicitly: tokenizing a zarr.Array pickles it, which
+    # re-reads its metadata from the store
+    array = image_context.get_array(resolution)
+    name = f"from-zarr-{tokenize(image_context.token, resolution)}"
+    decoded_chunk_cache = image_context.decoded_chunk_cache
+    if decoded_chunk_cache is None:
+        data = da.from_zarr(array, name=name)
+    else:
+        # Read whole chunks through the cache. Unlike the default getter,
+        # dask doesn't fuse a custom getter with the slicing of its chunks,
+        # so that each chunk is read by a single task.
+        data = da.from_array(
+            array,
+            chunks=array.chunks,
+            name=name,
+            getitem=decoded_chunk_cache.getitem,
+            asarray=False,
+            fancy=False,
+        )
 
     sim = to_spatial_image(
         data,
@@ -65,6 +201,7 @@ def get_tiles_from_sim(
     xim_well,
     fov_roi_table: pd.DataFrame,
     transform_key: str = "fractal_input",
+    z_slices: Optional[list[slice]] = None,
 ):
     """_summary_
 
@@ -74,6 +211,9 @@ def get_tiles_from_sim(
         Array representing the well.
     fov_roi_table : pd.DataFrame
         Table with the FOV ROIs.
+    z_slices : list of slice, optional
+        Per FOV, range of z planes to project the tile onto (maximum
+        projection). By default, tiles are not projected.
 
     Returns:
     -------
@@ -81,7 +221,7 @@ def get_tiles_from_sim(
     """
     input_spatial_dims = [dim for dim in xim_well.dims if dim in ["z", "y", "x"]]
     msims = []
-    for _, row in fov_roi_table.iterrows():
+    for ifov, (_, row) in enumerate(fov_roi_table.iterrows()):
         origin = {dim: row[f"{dim}_micrometer"] for dim in input_spatial_dims}
         extent = {dim: row[f"len_{dim}_micrometer"] for dim in input_spatial_dims}
 
@@ -90,13 +230,24 @@ def get_tiles_from_sim(
             for dim in input_spatial_dims
         }
 
+        # The margin has the dtype of the table, so that the tile is the same
+        # under any NumPy promotion rules (NumPy < 2.2 applies the legacy
+        # ones outside of the main thread)
         tile = xim_well.sel(
             {
-                dim: slice(origin[dim], origin[dim] + extent[dim] - 1e-6)
+                dim: slice(
+                    origin[dim],
+                    origin[dim]
+                    + extent[dim]
+                    - np.asarray(origin[dim]).dtype.type(1e-6),
+                )
                 for dim in input_spatial_dims
             }
         )
 
+        if z_slices is not None:
+            tile = tile.isel(z=z_slices[ifov]).max("z")
+
         tile = tile.squeeze(drop=True)
 
         sim = si_utils.get_sim_from_array(
@@ -125,11 +276,15 @@ class StitchingChannelInputModel(ChannelInputModel):
             not set.
     """
 
-    def get_omero_channel(self, zarr_url) -> OmeroChannel:
+    def get_omero_channel(
+        self, zarr_url, image_context: Optional[ImageContext] = None
+    ) -> OmeroChannel:
         """Get the omero channel from the zarr url"""
+        if image_context is None:
+            image_context = ImageContext(zarr_url)
         try:
-            return get_channel_from_image_zarr(
-                image_zarr_path=zarr_url,
+            return get_channel_from_list(
+                channels=image_context.omero_channels,
                 wavelength_id=self.wavelength_id,
                 label=self.label,
             )
@@ -167,3 +322,818 @@ class PreRegistrationPruningMethod(Enum):
         for context. NOPRUNING should return a None, not the string.
         """
         return None if self == PreRegistrationPruningMethod.NOPRUNING else self.value
+
+
+class GlobalOptimizationMethod(Enum):
+    """GlobalOptimizationMethod Enum class
+
+    Attributes:
+        ITERATIVE: Global optimization of multiview-stitcher, which updates
+            one tile at a time until convergence. Suited for up to a few
+            hundred tiles.
+        SPARSELEASTSQUARES: Solve for the translations of all tiles at once
+            as a sparse least-squares problem, rejecting inconsistent tile
+            pairs. Scales to wells with thousands of tiles.
+    """
+
+    ITERATIVE = "iterative"
+    SPARSELEASTSQUARES = "sparse_least_squares"
+
+
+class InitArgsPlateStitching(BaseModel):
+    """Plate stitching init args.
+
+    Passed from `init_plate_stitching_task` to `plate_stitching_task`.
+
+    Attributes:
+        fov_corrections: Translation correction (in micrometer) of the stage
+            position of each FOV, keyed by FOV name and spatial dimension, as
+            learned on the reference wells.
+        reference_zarr_urls: Images the corrections were learned on.
+        is_reference: Whether the image is one of the reference images. Its
+            `fov_corrections` are then those registered on it, which are
+            applied without verification.
+        channel: Channel used for registration.
+        registration_resolution_level: Resolution level used for
+            registration.
+        registration_on_z_proj: Whether registration was performed on a
+            maximum projection along z.
+        registration_focus_planes: Number of planes around the best-focus
+            plane projected for registration, if not all planes.
+        pre_registration_pruning_method: Method used for selecting the tile
+            pairs to register.
+        registration_parallelization: Bounds on the number of tile pairs
+            registered at the same time, if any.
+        global_optimization_method: Method used to find the FOV translations
+            from the registered tile pairs.
+    """
+
+    fov_corrections: dict[str, dict[str, float]]
+    reference_zarr_urls: list[str]
+    is_reference: bool = False
+    channel: StitchingChannelInputModel
+    registration_resolution_level: int = 0
+    registration_on_z_proj: bool = True
+    registration_focus_planes: Optional[int] = None
+    pre_registration_pruning_method: PreRegistrationPruningMethod = (
+        PreRegistrationPruningMethod.KEEPAXISALIGNED
+    )
+    registration_parallelization: Optional[RegistrationParallelizationInputModel] = None
+    global_optimization_method: GlobalOptimizationMethod = (
+        GlobalOptimizationMethod.ITERATIVE
+    )
+
+
+def get_fov_msims(
+    image_context: ImageContext,
+    resolution: int = 0,
+    project_z: bool = False,
+    transform_key: str = "fractal_input",
+    z_slices: Optional[list[slice]] = None,
+):
+    """Get one multiscale spatial image per FOV of the FOV ROI table.
+
+    Args:
+        image_context: Metadata of the image.
+        resolution: Resolution level to load the FOVs from.
+        project_z: Whether to load maximum projections along z (only applies
+            to 3D data).
+        transform_key: Transform key under which the stage positions of the
+            FOVs are set.
+        z_slices: If set together with `project_z`, each FOV is projected
+            along its own range of z planes only, e.g. as returned by
+            `get_focus_z_slices`.
+
+    Returns:
+        List of multiscale spatial images (multiview-stitcher flavor) and
+        their spatial dimensions.
+    """
+    xim_well = get_sim_from_multiscales(
+        image_context.zarr_url,
+        resolution=resolution,
+        image_context=image_context,
+    )
+    is_3d = "z" in si_utils.get_spatial_dims_from_sim(xim_well.squeeze(drop=True))
+    if not (project_z and is_3d):
+        z_slices = None
+    elif z_slices is None:
+        xim_well = xim_well.max("z")
+
+    msims = get_tiles_from_sim(
+        xim_well,
+        image_context.fov_roi_table,
+        transform_key=transform_key,
+        z_slices=z_slices,
+    )
+    spatial_dims = si_utils.get_spatial_dims_from_sim(
+        msi_utils.get_sim_from_msim(msims[0])
+    )
+    return msims, spatial_dims
+
+
+def estimate_pair_registration_bytes(
+    image_context: ImageContext,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+) -> int:
+    """Estimate the memory needed to register one pair of tiles.
+
+    Args:
+        image_context: Metadata of the image.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+
+    Returns:
+        Estimated peak memory in bytes, for the largest tiles of the image.
+    """
+    axes = image_context.ngff_image_meta.axes_names
+    scales = dict(
+        zip(
+            ["z", "y", "x"],
+            image_context.ngff_image_meta.pixel_sizes_zyx[
+                registration_resolution_level
+            ],
+        )
+    )
+    reg_dims = ["y", "x"] if registration_on_z_proj else ["z", "y", "x"]
+    tile_pixels = max(
+        math.prod(
+            round(row[f"len_{dim}_micrometer"] / scales[dim])
+            for dim in reg_dims
+            if dim in axes
+        )
+        for _, row in image_context.fov_roi_table.iterrows()
+    )
+    return 2 * tile_pixels * REGISTRATION_BYTES_PER_TILE_PIXEL
+
+
+def get_num_parallel_pairs(
+    image_context: ImageContext,
+    registration_parallelization: Optional[RegistrationParallelizationInputModel],
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+) -> Optional[int]:
+    """Number of tile pairs to register at a time, see `register_pairs`.
+
+    Args:
+        image_context: Metadata of the image.
+        registration_parallelization: Bounds on the number of pairs, or None
+            for no bound.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+    """
+    if registration_parallelization is None:
+        return None
+    return registration_parallelization.get_num_workers(
+        estimate_pair_registration_bytes(
+            image_context,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+        )
+    )
+
+
+def register_pairs(
+    msims,
+    pairs: list[tuple[int, int]],
+    reg_spatial_dims: list[str],
+    transform_key: str,
+    num_parallel_pairs: Optional[int] = None,
+) -> list[xr.Dataset]:
+    """Register tile pairs in batches of a bounded size.
+
+    Each batch is computed by as many threads as it has pairs, and the next
+    batch is only read once the previous one is registered, so that the
+    tiles of at most `num_parallel_pairs` pairs are held in memory. Without
+    a bound, 2D pairs are registered all at once and 3D pairs one at a time,
+    as by multiview-stitcher.
+
+    Args:
+        msims: Tiles of the registration channel.
+        pairs: Indices of the tiles of each pair.
+        reg_spatial_dims: Spatial dimensions of the tiles.
+        transform_key: Transform key of the tile positions.
+        num_parallel_pairs: Number of pairs to register at a time.
+
+    Returns:
+        Registration parameters of each pair, with its `transform` and
+        `quality`.
+    """
+    pair_params = [
+        registration.register_pair_of_msims_over_time(
+            msims[pair[0]],
+            msims[pair[1]],
+            transform_key=transform_key,
+            registration_binning={dim: 1 for dim in reg_spatial_dims},
+        )
+        for pair in pairs
+    ]
+    scheduler = None
+    if num_parallel_pairs is not None:
+        logger.info(f"Registering up to {num_parallel_pairs} tile pairs in parallel")
+        batch_size = num_parallel_pairs
+        scheduler = partial(dask.threaded.get, num_workers=num_parallel_pairs)
+    elif len(reg_spatial_dims) == 3:
+        batch_size = 1
+    else:
+        batch_size = max(len(pair_params), 1)
+    return [
+        params
+        for ibatch in range(0, len(pair_params), batch_size)
+        for params in compute(
+            pair_params[ibatch : ibatch + batch_size], scheduler=scheduler
+        )[0]
+    ]
+
+
+def get_focus_z_slices(
+    image_context: ImageContext,
+    reg_channel_index: int,
+    num_planes: int = 1,
+) -> Optional[list[slice]]:
+    """Find the best-focus z planes of each FOV.
+
+    The sharpness of each plane is measured as the variance of its Laplacian
+    on the coarsest pyramid level, which is cheap to read. As z is not
+    coarsened in the pyramid, the planes can be used on all levels.
+
+    Args:
+        image_context: Metadata of the image.
+        reg_channel_index: Index of the channel to measure sharpness on.
+        num_planes: Number of planes around the sharpest plane to select.
+
+    Returns:
+        Range of z planes per FOV (in the order of the FOV ROI table), or
+        None for 2D images.
+    """
+    coarsest_level = image_context.ngff_image_meta.num_levels - 1
+    msims, spatial_dims = get_fov_msims(
+        image_context, resolution=coarsest_level, transform_key="coarsest"
+    )
+    if "z" not in spatial_dims:
+        return None
+    sims = compute(
+        [
+            msi_utils.get_sim_from_msim(msim).isel(c=reg_channel_index).squeeze()
+            for msim in msims
+        ]
+    )[0]
+
+    z_slices, focus_planes = [], {}
+    for fov, sim in zip(image_context.fov_roi_table.index, sims):
+        data = sim.transpose("z", ...).data.astype(np.float32)
+        sharpness = [laplace(plane).var() for plane in data]
+        focus_plane = int(np.argmax(sharpness))
+        start = max(min(focus_plane - num_planes // 2, len(data) - num_planes), 0)
+        z_slices.append(slice(start, start + num_planes))
+        focus_planes[fov] = focus_plane
+    logger.info(f"Best-focus z plane per FOV: {focus_planes}")
+    return z_slices
+
+
+def get_pairs_with_signal(
+    image_context: ImageContext,
+    reg_channel_index: int,
+    min_overlap_signal_fraction: float,
+    transform_key: str = "fractal_input",
+) -> list[tuple[int, int]]:
+    """Find the overlapping tile pairs whose overlap contains signal.
+
+    Works on the maximum projection of the coarsest pyramid level only. A
+    pixel counts as signal if it is brighter than the Otsu threshold computed
+    over all FOVs, which separates sample from background in sparse wells.
+
+    Args:
+        image_context: Metadata of the image.
+        reg_channel_index: Index of the channel to use for registration.
+        min_overlap_signal_fraction: Minimal fraction of signal pixels within
+            the overlap of both tiles of a pair.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Pairs of tile indices (in the order of the FOV ROI table).
+    """
+    coarsest_level = image_context.ngff_image_meta.num_levels - 1
+    msims, _ = get_fov_msims(
+        image_context,
+        resolution=coarsest_level,
+        project_z=True,
+        transform_key=transform_key,
+    )
+    sims = [
+        msi_utils.get_sim_from_msim(msim)
+        .isel(c=reg_channel_index)
+        .squeeze(drop=True)
+        .compute()
+        for msim in msims
+    ]
+
+    threshold = threshold_otsu(np.concatenate([sim.data.ravel() for sim in sims]))
+    signal_masks = [sim > threshold for sim in sims]
+    signal_fractions = {
+        fov: round(float(mask.mean()), 3)
+        for fov, mask in zip(image_context.fov_roi_table.index, signal_masks)
+    }
+    logger.info(f"Signal fraction per FOV: {signal_fractions}")
+
+    graph = mv_graph.build_view_adjacency_graph_from_msims(
+        msims, transform_key=transform_key
+    )
+    pairs = []
+    for pair in graph.edges:
+        lowers, uppers = registration.get_overlap_bboxes(
+            sims[pair[0]], sims[pair[1]], input_transform_key=transform_key
+        )
+        overlap_signal_fractions = [
+            float(
+                signal_masks[itile]
+                .sel(
+                    {
+                        dim: slice(lower, upper)
+                        for dim, lower, upper in zip(
+                            signal_masks[itile].dims, lowers[i], uppers[i]
+                        )
+                    }
+                )
+                .mean()
+            )
+            for i, itile in enumerate(pair)
+        ]
+        if min(overlap_signal_fractions) >= min_overlap_signal_fraction:
+            pairs.append(tuple(sorted(pair)))
+
+    logger.info(
+        f"Keeping {len(pairs)} of {len(graph.edges)} overlapping tile pairs "
+        "with signal in their overlap"
+    )
+    return pairs
+
+
+def get_registration_msims(
+    image_context: ImageContext,
+    reg_channel_index: int,
+    resolution: int = 0,
+    project_z: bool = True,
+    transform_key: str = "fractal_input",
+    z_slices: Optional[list[slice]] = None,
+):
+    """Get the tiles of the registration channel of each FOV.
+
+    Args:
+        image_context: Metadata of the image.
+        reg_channel_index: Index of the channel to use for registration.
+        resolution: Resolution level to load the FOVs from.
+        project_z: Whether to load maximum projections along z (only applies
+            to 3D data).
+        transform_key: Transform key under which the stage positions of the
+            FOVs are set.
+        z_slices: If set together with `project_z`, each FOV is projected
+            along its own range of z planes only, see `get_fov_msims`.
+
+    Returns:
+        List of multiscale spatial images of the registration channel and
+        their spatial dimensions.
+    """
+    msims, spatial_dims = get_fov_msims(
+        image_context,
+        resolution=resolution,
+        project_z=project_z,
+        transform_key=transform_key,
+        z_slices=z_slices,
+    )
+    msims = [
+        msi_utils.multiscale_sel_coords(
+            msim,
+            {"c": msi_utils.get_sim_from_msim(msim).coords["c"][reg_channel_index]},
+        )
+        for msim in msims
+    ]
+    return msims, spatial_dims
+
+
+def get_registration_pairs(
+    image_context: ImageContext,
+    msims,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    reg_channel_index: int = 0,
+    transform_key: str = "fractal_input",
+) -> dict[tuple[int, int], float]:
+    """Select the overlapping tile pairs to register.
+
+    Only uses the stage positions of the FOVs, unless
+    `min_overlap_signal_fraction` is set.
+
+    Args:
+        image_context: Metadata of the image.
+        msims: Tiles of the FOVs, as returned by `get_fov_msims`.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs among the overlapping ones.
+        min_overlap_signal_fraction: If set, only tile pairs with signal in
+            their overlap are considered, see `get_pairs_with_signal`.
+        reg_channel_index: Index of the channel to find the signal in.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Overlap of each selected pair, keyed by the sorted tile indices of
+        the pair, in ascending order of the pairs. Empty if no tiles overlap.
+    """
+    pairs = None
+    if min_overlap_signal_fraction is not None:
+        pairs = get_pairs_with_signal(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            min_overlap_signal_fraction=min_overlap_signal_fraction,
+            transform_key=transform_key,
+        )
+    graph = mv_graph.build_view_adjacency_graph_from_msims(
+        msims, transform_key=transform_key, pairs=pairs
+    )
+    try:
+        pruned_graph = registration.prune_view_adjacency_graph(
+            graph, method=pre_registration_pruning_method.get_pruning_method()
+        )
+    except NotEnoughOverlapError:
+        return {}
+    # pruning does not keep the edge attributes
+    return {
+        tuple(sorted(edge)): graph.edges[edge]["overlap"]
+        for edge in sorted(pruned_graph.edges, key=sorted)
+    }
+
+
+def register_fovs(
+    image_context: ImageContext,
+    reg_channel_index: int,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    pre_registration_pruning_method: PreRegistrationPruningMethod = PreRegistrationPruningMethod.KEEPAXISALIGNED,  # noqa: E501
+    min_overlap_signal_fraction: Optional[float] = None,
+    registration_focus_planes: Optional[int] = None,
+    registration_parallelization: Optional[
+        RegistrationParallelizationInputModel
+    ] = None,
+    global_optimization_method: GlobalOptimizationMethod = GlobalOptimizationMethod.ITERATIVE,  # noqa: E501
+    transform_key: str = "fractal_input",
+) -> dict[str, dict[str, float]]:
+    """Register the FOVs of an image.
+
+    Args:
+        image_context: Metadata of the image.
+        reg_channel_index: Index of the channel to use for registration.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        pre_registration_pruning_method: Method to use for selecting the tile
+            pairs to register.
+        min_overlap_signal_fraction: If set, tile pairs whose overlap
+            contains a smaller fraction of signal pixels on the coarsest
+            pyramid level are not registered, see `get_pairs_with_signal`.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many planes around the
+            best-focus plane of each FOV are projected, see
+            `get_focus_z_slices`.
+        registration_parallelization: If set, bounds the number of tile
+            pairs registered at the same time, see `register_pairs`.
+        global_optimization_method: Method to find the FOV translations
+            agreeing best with the registered tile pairs. With
+            `SPARSELEASTSQUARES`, pairs whose residual exceeds
+            `OUTLIER_THRESHOLD_PIXELS` pixels of the registration level are
+            rejected.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Translation (in micrometer) correcting the stage position of each FOV,
+        keyed by FOV name and spatial dimension. Empty if no overlapping
+        tiles were found.
+    """
+    z_slices = None
+    if registration_on_z_proj and registration_focus_planes is not None:
+        z_slices = get_focus_z_slices(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            num_planes=registration_focus_planes,
+        )
+    msims, reg_spatial_dims = get_registration_msims(
+        image_context,
+        reg_channel_index=reg_channel_index,
+        resolution=registration_resolution_level,
+        project_z=registration_on_z_proj,
+        transform_key=transform_key,
+        z_slices=z_slices,
+    )
+
+    logger.info(f"Registration res level: {registration_resolution_level}")
+    logger.info(f"Registration spatial dims: {reg_spatial_dims}")
+
+    overlaps = get_registration_pairs(
+        image_context,
+        msims,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+        min_overlap_signal_fraction=min_overlap_signal_fraction,
+        reg_channel_index=reg_channel_index,
+        transform_key=transform_key,
+    )
+    edges = list(overlaps)
+    if not edges:
+        logger.warning(
+            "Did not find overlapping tiles for stitching. Skipping registration."
+        )
+        return {}
+
+    pair_params = register_pairs(
+        msims,
+        edges,
+        reg_spatial_dims=reg_spatial_dims,
+        transform_key=transform_key,
+        num_parallel_pairs=get_num_parallel_pairs(
+            image_context,
+            registration_parallelization,
+            registration_resolution_level=registration_resolution_level,
+            registration_on_z_proj=registration_on_z_proj,
+        ),
+    )
+
+    if global_optimization_method == GlobalOptimizationMethod.ITERATIVE:
+        # Resolve the pairs as `registration.register` of multiview-stitcher
+        graph = nx.Graph()
+        graph.add_nodes_from(range(len(msims)))
+        for edge, params in zip(edges, pair_params):
+            graph.add_edge(
+                *edge,
+                transform=params["transform"],
+                quality=params["quality"],
+                bbox=params["bbox"],
+                overlap=overlaps[edge],
+            )
+        params = registration.groupwise_resolution(graph)[0]
+        translations = [
+            param_utils.translation_from_affine(params[iview].sel(t=0).data)
+            for iview in sorted(graph.nodes())
+        ]
+    else:
+        pixel_size = max(
+            image_context.ngff_image_meta.pixel_sizes_zyx[
+                registration_resolution_level
+            ][-2:]
+        )
+        translations, inliers = solve_translations(
+            len(msims),
+            np.array(edges),
+            np.array(
+                [
+                    param_utils.translation_from_affine(
+                        params["transform"].sel(t=0).data
+                    )
+                    for params in pair_params
+                ]
+            ),
+            weights=np.array(
+                [float(params["quality"].mean()) for params in pair_params]
+            ),
+            outlier_threshold=OUTLIER_THRESHOLD_PIXELS * pixel_size,
+        )
+        logger.info(f"Kept {int(inliers.sum())} of {len(edges)} registered tile pairs")
+
+    return {
+        fov: dict(zip(reg_spatial_dims, (float(s) for s in translation)))
+        for fov, translation in zip(image_context.fov_roi_table.index, translations)
+    }
+
+
+def set_fov_corrections(
+    msims,
+    fov_names,
+    fov_corrections: dict[str, dict[str, float]],
+    base_transform_key: str = "fractal_input",
+    transform_key: str = "translation_registered",
+):
+    """Set corrected transforms on FOV tiles.
+
+    Corrections obtained in fewer spatial dimensions than the tiles have (e.g.
+    from a registration on z projections) are broadcast, with zero
+    translation along the missing dimensions. FOVs without a correction keep
+    their stage position.
+
+    Args:
+        msims: Multiscale spatial images of the FOVs.
+        fov_names: FOV name of each tile in `msims`.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as returned by `register_fovs`.
+        base_transform_key: Transform key of the stage positions.
+        transform_key: Transform key to set the corrected positions under.
+    """
+    for msim, fov in zip(msims, fov_names):
+        sdims = msi_utils.get_spatial_dims(msim)
+        correction = fov_corrections.get(fov, {})
+        affine = param_utils.affine_to_xaffine(
+            param_utils.affine_from_translation(
+                [correction.get(dim, 0.0) for dim in sdims]
+            ),
+            t_coords=[0],
+        )
+        msi_utils.set_affine_transform(
+            msim,
+            affine,
+            transform_key=transform_key,
+            base_transform_key=base_transform_key,
+        )
+
+
+def verify_fov_corrections(
+    image_context: ImageContext,
+    fov_corrections: dict[str, dict[str, float]],
+    reg_channel_index: int,
+    num_pairs: int = 2,
+    registration_resolution_level: int = 0,
+    registration_on_z_proj: bool = True,
+    registration_focus_planes: Optional[int] = None,
+    transform_key: str = "fractal_input",
+) -> Optional[float]:
+    """Check how well FOV corrections align the tiles of an image.
+
+    Registers a few overlapping, axis-aligned tile pairs after applying the
+    corrections. Pairs with the largest overlap are checked first.
+
+    Args:
+        image_context: Metadata of the image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, e.g. obtained on another well of the same plate.
+        reg_channel_index: Index of the channel to use for registration.
+        num_pairs: Number of tile pairs to register.
+        registration_resolution_level: Resolution level to use for
+            registration.
+        registration_on_z_proj: Whether to register maximum projections along
+            z in case of 3D data.
+        registration_focus_planes: If set together with
+            `registration_on_z_proj`, only this many planes around the
+            best-focus plane of each FOV are projected, as for registration.
+        transform_key: Transform key of the stage positions.
+
+    Returns:
+        Largest remaining shift between the checked tile pairs (in
+        micrometer), or None if there are no overlapping tiles.
+    """
+    corrected_transform_key = "translation_corrected"
+    z_slices = None
+    if registration_on_z_proj and registration_focus_planes is not None:
+        z_slices = get_focus_z_slices(
+            image_context,
+            reg_channel_index=reg_channel_index,
+            num_planes=registration_focus_planes,
+        )
+    msims, reg_spatial_dims = get_registration_msims(
+        image_context,
+        reg_channel_index=reg_channel_index,
+        resolution=registration_resolution_level,
+        project_z=registration_on_z_proj,
+        transform_key=transform_key,
+        z_slices=z_slices,
+    )
+    set_fov_corrections(
+        msims,
+        image_context.fov_roi_table.index,
+        fov_corrections,
+        base_transform_key=transform_key,
+        transform_key=corrected_transform_key,
+    )
+
+    # Select the pairs on the stage positions: the overlap computation of
+    # multiview-stitcher can fail on nearly coincident tile borders, as
+    # produced by sub-pixel corrections
+    overlaps = get_registration_pairs(
+        image_context,
+        msims,
+        pre_registration_pruning_method=PreRegistrationPruningMethod.KEEPAXISALIGNED,
+        transform_key=transform_key,
+    )
+    if not overlaps:
+        return None
+    pairs = sorted(overlaps, key=overlaps.get, reverse=True)[:num_pairs]
+
+    pair_params = compute(
+        [
+            registration.register_pair_of_msims_over_time(
+                msims[pair[0]],
+                msims[pair[1]],
+                transform_key=corrected_transform_key,
+                registration_binning={dim: 1 for dim in reg_spatial_dims},
+            )
+            for pair in pairs
+        ]
+    )[0]
+    residuals = [
+        float(
+            np.linalg.norm(
+                param_utils.translation_from_affine(params["transform"].sel(t=0).data)
+            )
+        )
+        for params in pair_params
+    ]
+    logger.info(f"Remaining shifts of verified tile pairs: {residuals}")
+    return max(residuals)
+
+
+def combine_fov_corrections(
+    fov_corrections_list: list[dict[str, dict[str, float]]],
+) -> dict[str, dict[str, float]]:
+    """Combine FOV corrections obtained on several images.
+
+    Registration fixes an arbitrary reference tile per image. Before taking
+    the median per FOV, the corrections of each image are therefore
+    centered on their mean over the FOVs that all images have in common.
+
+    Args:
+        fov_corrections_list: Corrections per image, as returned by
+            `register_fovs`.
+
+    Returns:
+        Combined translation correction per FOV name and spatial dimension.
+    """
+    fov_corrections_list = [c for c in fov_corrections_list if c]
+    if not fov_corrections_list:
+        return {}
+    common_fovs = set.intersection(*(set(c) for c in fov_corrections_list))
+
+    centered = []
+    for fov_corrections in fov_corrections_list:
+        df = pd.DataFrame.from_dict(fov_corrections, orient="index")
+        centered.append(df - df.loc[sorted(common_fovs)].mean())
+
+    combined = pd.concat(centered).groupby(level=0).median()
+    return {
+        fov: {dim: float(s) for dim, s in row.dropna().items()}
+        for fov, row in combined.iterrows()
+    }
+
+
+def write_fov_corrections(
+    output_zarr_url: str, fov_corrections: dict[str, dict[str, float]]
+):
+    """Record the FOV corrections a fused image was computed with."""
+    output_group = zarr.open_group(output_zarr_url, mode="r+")
+    output_group.attrs[FOV_CORRECTIONS_KEY] = fov_corrections
+
+
+def read_fov_corrections(output_zarr_url: str) -> Optional[dict[str, dict[str, float]]]:
+    """Read the FOV corrections recorded in a fused image, if any."""
+    try:
+        output_group = zarr.open_group(output_zarr_url, mode="r")
+    except zarr.errors.GroupNotFoundError:
+        return None
+    return output_group.attrs.get(FOV_CORRECTIONS_KEY)
+
+
+def get_output_zarr_url(zarr_url: str, output_group_suffix: str = "fused") -> str:
+    """Get the path of the fused image next to the input image."""
+    well_url, _ = _split_well_path_image_path(zarr_url)
+    return f"{well_url}/{zarr_url.split('/')[-1]}_{output_group_suffix}"
+
+
+def finalize_output_image(
+    zarr_url: str,
+    output_zarr_url: str,
+    overwrite_input: bool = False,
+) -> Optional[dict]:
+    """Replace the input image or register the output image in its well.
+
+    Args:
+        zarr_url: Path of the input image.
+        output_zarr_url: Path of the fused image.
+        overwrite_input: Whether to replace the input image with the fused
+            image.
+
+    Returns:
+        Image list updates for Fractal, or None if the input was replaced.
+    """
+    if overwrite_input:
+        logger.info("Replace original zarr image with the newly created Zarr image")
+        replace_image(zarr_url, output_zarr_url)
+        return None
+
+    image_list_updates = dict(
+        image_list_updates=[dict(zarr_url=output_zarr_url, origin=zarr_url)]
+    )
+    # Update the metadata of the the well
+    _, old_img_path = _split_well_path_image_path(zarr_url)
+    well_url, new_img_path = _split_well_path_image_path(output_zarr_url)
+    try:
+        update_well_metadata(
+            well_url=well_url,
+            old_image_path=old_img_path,
+            new_image_path=new_img_path,
+        )
+    except ZarrGroupNotFoundError:
+        logger.debug(f"{zarr_url} is not in an HCS plate. No well metadata got updated")
+    except ValueError:
+        logger.debug(
+            f"Could not update well metadata, likely because "
+            f" {output_zarr_url} was already listed there."
+        )
+
+    return image_list_updates
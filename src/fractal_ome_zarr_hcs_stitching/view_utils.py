@@ -0,0 +1,209 @@
+"""Lazily fused views of images, fusing chunks only when they are read.
+
+Viewers and analyses of a few regions of a well don't need the whole fused
+image. A view fuses the FOVs of the input image with stored corrections,
+one output chunk at a time and only when it is read, e.g.
+
+    view = get_fused_view(zarr_url)
+    region = view.sel(y=slice(0, 500), x=slice(0, 500)).compute()
+
+fuses only the chunks overlapping the region. Fused chunks are kept in a
+least-recently-used cache, so that reading them again is free.
+"""
+
+import itertools
+import logging
+from threading import Lock
+from typing import Optional
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+import zarr
+from zarr.errors import ReadOnlyError
+from zarr.storage import LRUStoreCache, Store, init_array
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.utils import (
+    get_output_zarr_url,
+    read_fov_corrections,
+)
+
+logger = logging.getLogger(__name__)
+
+# Default size of the cache of fused chunks of a view, in megabytes
+FUSED_CHUNK_CACHE_MB = 256
+
+
+class FusedChunkStore(Store):
+    """Read-only Zarr store fusing the chunks of an array when they are read.
+
+    The store holds a single uncompressed Zarr array with the shape, chunks
+    and dtype of a lazy fused image. Reading a chunk computes the matching
+    block of the fusion graph only.
+
+    Args:
+        fused: Lazy fused image data, e.g. of `fuse_fovs`.
+    """
+
+    def __init__(self, fused: da.Array):
+        """Create the store; nothing is fused until read."""
+        # zarr chunks are regular, except at the end of each axis
+        self._fused = fused.rechunk(fused.chunksize)
+        self._metadata = {}
+        init_array(
+            self._metadata,
+            shape=self._fused.shape,
+            chunks=self._fused.chunksize,
+            dtype=self._fused.dtype,
+            compressor=None,
+            fill_value=0,
+        )
+        self._mutex = Lock()
+        self.chunks_fused = 0
+
+    def __getstate__(self):
+        """Views hold a fusion graph and are not meant to be pickled."""
+        raise TypeError(f"{type(self).__name__} cannot be pickled")
+
+    def _get_block_index(self, key) -> Optional[tuple[int, ...]]:
+        try:
+            index = tuple(int(i) for i in key.split("."))
+        except ValueError:
+            return None
+        numblocks = self._fused.numblocks
+        if len(index) != len(numblocks) or not all(
+            0 <= i < n for i, n in zip(index, numblocks)
+        ):
+            return None
+        return index
+
+    def __getitem__(self, key):
+        """Read the metadata of the array, or fuse one of its chunks."""
+        if key in self._metadata:
+            return self._metadata[key]
+        index = self._get_block_index(key)
+        if index is None:
+            raise KeyError(key)
+        block = self._fused.blocks[index].compute()
+        with self._mutex:
+            self.chunks_fused += 1
+        if block.shape != self._fused.chunksize:
+            # zarr expects full chunks also at the end of each axis
+            padded = np.zeros(self._fused.chunksize, dtype=block.dtype)
+            padded[tuple(slice(0, size) for size in block.shape)] = block
+            block = padded
+        return np.ascontiguousarray(block).tobytes()
+
+    def __contains__(self, key):
+        """Check for the metadata or a chunk, without fusing it."""
+        return key in self._metadata or self._get_block_index(key) is not None
+
+    def __iter__(self):
+        """Iterate over the metadata and all chunk keys."""
+        yield from self._metadata
+        for index in itertools.product(*(range(n) for n in self._fused.numblocks)):
+            yield ".".join(str(i) for i in index)
+
+    def __len__(self):
+        """Number of metadata and chunk keys."""
+        return len(self._metadata) + self._fused.npartitions
+
+    def keys(self):
+        """Metadata and chunk keys."""
+        return list(self)
+
+    def __setitem__(self, key, value):
+        """The store is read-only."""
+        raise ReadOnlyError()
+
+    def __delitem__(self, key):
+        """The store is read-only."""
+        raise ReadOnlyError()
+
+
+def open_fused_array(
+    fused: xr.DataArray, cache_size_mb: float = FUSED_CHUNK_CACHE_MB
+) -> zarr.Array:
+    """Open a lazy fused image as a Zarr array fusing chunks when read.
+
+    The array can be passed to viewers reading Zarr arrays, e.g. napari.
+
+    Args:
+        fused: Lazy fused image, as returned by `fuse_fovs`.
+        cache_size_mb: Size of the cache of fused chunks in megabytes. The
+            least recently used chunks are evicted first.
+
+    Returns:
+        Read-only Zarr array on a `FusedChunkStore`, read through an
+        `LRUStoreCache`.
+    """
+    store = LRUStoreCache(
+        FusedChunkStore(fused.data), max_size=int(cache_size_mb * 2**20)
+    )
+    return zarr.open_array(store, mode="r")
+
+
+def get_fused_view(
+    zarr_url: str,
+    fov_corrections: Optional[dict[str, dict[str, float]]] = None,
+    output_group_suffix: str = "fused",
+    resolution: int = 0,
+    low_memory_fusion: bool = False,
+    cache_size_mb: float = FUSED_CHUNK_CACHE_MB,
+    image_context: Optional[ImageContext] = None,
+) -> xr.DataArray:
+    """Lazily fuse the FOVs of an image, without writing the fused image.
+
+    The chunks of the returned image are fused when they are computed and
+    kept in a cache of fused chunks (see `open_fused_array`), so selecting
+    and computing a region only pays for the chunks overlapping it.
+
+    Args:
+        zarr_url: Path or URL of the input image.
+        fov_corrections: Translation correction per FOV name and spatial
+            dimension, as returned by `register_fovs`. If not set, the
+            corrections recorded by stitching the image are used (see
+            `read_fov_corrections`).
+        output_group_suffix: Suffix of the fused image to read the recorded
+            corrections from.
+        resolution: Resolution level to fuse the FOVs on.
+        low_memory_fusion: Whether to fuse in single precision and one FOV at
+            a time (see `fuse_low_memory`).
+        cache_size_mb: Size of the cache of fused chunks in megabytes.
+        image_context: Already loaded metadata of the input image, e.g. with
+            an input cache. If not set, it is read from `zarr_url`.
+
+    Returns:
+        Lazy fused image with the dimensions and coordinates of `fuse_fovs`.
+    """
+    if image_context is None:
+        image_context = ImageContext(zarr_url)
+    if fov_corrections is None:
+        output_zarr_url = get_output_zarr_url(
+            image_context.zarr_url, output_group_suffix
+        )
+        fov_corrections = read_fov_corrections(output_zarr_url)
+        if fov_corrections is None:
+            raise ValueError(
+                f"No FOV corrections recorded in {output_zarr_url}. Stitch the "
+                "image first or pass the corrections."
+            )
+        logger.info(f"Read FOV corrections of {output_zarr_url}")
+
+    fused = fuse_fovs(
+        image_context,
+        fov_corrections,
+        resolution=resolution,
+        low_memory_fusion=low_memory_fusion,
+    )
+    fused_array = open_fused_array(fused, cache_size_mb=cache_size_mb)
+    return fused.copy(
+        data=da.from_zarr(
+            fused_array,
+            chunks=fused.data.chunks,
+            # tokenizing the array would pickle its store
+            name=f"fused-view-{fused.data.name}",
+        )
+    )
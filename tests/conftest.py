@@ -1,9 +1,33 @@
 import os
 import shutil
+from collections import Counter
 from pathlib import Path
+from typing import Optional
 
+import anndata as ad
+import numpy as np
+import pandas as pd
 import pooch
 import pytest
+import zarr
+from fractal_tasks_core.tables import write_table
+
+# Imported before any module of this package: Geometry3D, a dependency of
+# multiview-stitcher, configures logging on import, which disables the
+# loggers that exist by then
+from multiview_stitcher import mv_graph  # noqa: F401
+from scipy import ndimage
+from zarr.storage import DirectoryStore
+
+# Stage positioning errors (in pixels, yx) of the synthetic 2x2 tile grid
+SYNTHETIC_STAGE_ERRORS = {
+    "FOV_1": (0, 0),
+    "FOV_2": (0, 3),
+    "FOV_3": (-2, 0),
+    "FOV_4": (-2, 3),
+}
+SYNTHETIC_TILE_SHAPE = (128, 128)
+SYNTHETIC_TILE_STEP = (96, 96)
 
 
 @pytest.fixture(scope="session")
@@ -137,3 +161,318 @@ def search_first_ome_zarr_3d(tmpdir, zenodo_search_first_ome_zarr) -> str:
         shutil.rmtree(str(target_dir))
     shutil.copytree(Path(zarr_plate_path), target_dir)
     return f"{target_dir}/C/05/0"
+
+
+@pytest.fixture
+def store_reads(monkeypatch) -> Counter:
+    """Count the keys read from any DirectoryStore, by absolute path."""
+    reads = Counter()
+    original_getitem = DirectoryStore.__getitem__
+
+    def counting_getitem(self, key):
+        reads[os.path.normpath(os.path.join(self.path, key))] += 1
+        return original_getitem(self, key)
+
+    monkeypatch.setattr(DirectoryStore, "__getitem__", counting_getitem)
+    return reads
+
+
+@pytest.fixture(scope="function")
+def ngff_example_zarr(tmpdir, testdata_path: Path) -> str:
+    """Copy of the small local example image (two FOVs, no overlap)."""
+    target_dir = tmpdir / "ngff_example"
+    shutil.copytree(testdata_path / "ngff_example", target_dir)
+    return f"{target_dir}/my_image"
+
+
+def write_synthetic_image(
+    zarr_url: str,
+    seed: int = 0,
+    stage_errors: dict = SYNTHETIC_STAGE_ERRORS,
+    num_z: int = 1,
+    empty_fovs: tuple = (),
+    num_columns: int = 2,
+    chunk_shape: Optional[tuple] = None,
+    with_labels: bool = False,
+) -> str:
+    """
+    Write a small OME-Zarr image with a grid of overlapping FOVs.
+
+    The FOVs are cut out of a random smooth ground truth at their true
+    positions and laid out next to each other in the image array, as done
+    by the Fractal converters. The stage positions in the FOV_ROI_table
+    differ from the true positions by `stage_errors` (in pixels), so that
+    registration should recover the negative of the stage errors. FOVs
+    listed in `empty_fovs` only contain dim noise. By default, the FOVs are
+    arranged in a 2x2 grid and chunked by FOV. With `with_labels`, a
+    `nuclei` label image segmented per FOV (IDs starting at 1000 times the
+    FOV number) and a feature table of it are written as well.
+    """
+    rng = np.random.default_rng(seed)
+    tile_shape = np.array(SYNTHETIC_TILE_SHAPE)
+    tile_step = np.array(SYNTHETIC_TILE_STEP)
+    grid_shape = np.array([-(-len(stage_errors) // num_columns), num_columns])
+    chunk_shape = tile_shape if chunk_shape is None else np.array(chunk_shape)
+    ground_truth = ndimage.gaussian_filter(
+        rng.random((num_z, *((grid_shape - 1) * tile_step + tile_shape + 20))),
+        sigma=(0, 2, 2),
+    )
+    ground_truth = (ground_truth - ground_truth.min()) / np.ptp(ground_truth)
+    ground_truth = (ground_truth * 1000).astype(np.uint16)
+
+    data = np.zeros((1, num_z, *(grid_shape * tile_shape)), dtype=np.uint16)
+    labels = np.zeros(data.shape[1:], dtype=np.uint32)
+    rows = []
+    for ifov, (fov, error) in enumerate(stage_errors.items()):
+        grid_pos = np.array([ifov // num_columns, ifov % num_columns])
+        true_pos = grid_pos * tile_step + 10
+        data[
+            0,
+            :,
+            grid_pos[0] * tile_shape[0] : (grid_pos[0] + 1) * tile_shape[0],
+            grid_pos[1] * tile_shape[1] : (grid_pos[1] + 1) * tile_shape[1],
+        ] = ground_truth[
+            :,
+            true_pos[0] : true_pos[0] + tile_shape[0],
+            true_pos[1] : true_pos[1] + tile_shape[1],
+        ]
+        if fov in empty_fovs:
+            data[
+                0,
+                :,
+                grid_pos[0] * tile_shape[0] : (grid_pos[0] + 1) * tile_shape[0],
+                grid_pos[1] * tile_shape[1] : (grid_pos[1] + 1) * tile_shape[1],
+            ] = rng.integers(0, 5, (num_z, *tile_shape))
+        tile_slices = (
+            slice(None),
+            slice(grid_pos[0] * tile_shape[0], (grid_pos[0] + 1) * tile_shape[0]),
+            slice(grid_pos[1] * tile_shape[1], (grid_pos[1] + 1) * tile_shape[1]),
+        )
+        tile_labels = ndimage.label(data[0][tile_slices] > 600)[0]
+        labels[tile_slices] = np.where(
+            tile_labels > 0, tile_labels + 1000 * (ifov + 1), 0
+        )
+        stage_pos = true_pos + np.array(error)
+        rows.append(
+            {
+                "FieldIndex": fov,
+                "x_micrometer": float(grid_pos[1] * tile_shape[1]),
+                "y_micrometer": float(grid_pos[0] * tile_shape[0]),
+                "z_micrometer": 0.0,
+                "len_x_micrometer": float(tile_shape[1]),
+                "len_y_micrometer": float(tile_shape[0]),
+                "len_z_micrometer": float(num_z),
+                "x_micrometer_original": float(stage_pos[1]),
+                "y_micrometer_original": float(stage_pos[0]),
+            }
+        )
+
+    group = zarr.open_group(zarr_url, mode="w")
+    datasets = []
+    for level in range(2):
+        level_data = data[..., :: 2**level, :: 2**level]
+        group.create_dataset(
+            str(level),
+            data=level_data,
+            chunks=(1, 1, *(chunk_shape // 2**level)),
+            dimension_separator="/",
+        )
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [1, 1.0, 2.0**level, 2.0**level]}
+                ],
+            }
+        )
+    group.attrs["multiscales"] = [
+        {
+            "axes": [
+                {"name": "c", "type": "channel"},
+                {"name": "z", "type": "space", "unit": "micrometer"},
+                {"name": "y", "type": "space", "unit": "micrometer"},
+                {"name": "x", "type": "space", "unit": "micrometer"},
+            ],
+            "datasets": datasets,
+            "version": "0.4",
+        }
+    ]
+    group.attrs["omero"] = {
+        "channels": [
+            {
+                "color": "00FFFF",
+                "label": "DAPI",
+                "wavelength_id": "A01_C01",
+                "window": {"end": 1000, "max": 65535, "min": 0, "start": 0},
+            }
+        ],
+        "version": "0.4",
+    }
+
+    df = pd.DataFrame(rows).set_index("FieldIndex")
+    table = ad.AnnData(X=df.to_numpy(dtype=np.float32))
+    table.obs_names = df.index
+    table.var_names = df.columns
+    write_table(group, "FOV_ROI_table", table, table_attrs={"type": "roi_table"})
+
+    if with_labels:
+        label_group = group.create_group("labels").create_group("nuclei")
+        group["labels"].attrs["labels"] = ["nuclei"]
+        for level in range(2):
+            label_group.create_dataset(
+                str(level),
+                data=labels[:, :: 2**level, :: 2**level],
+                chunks=(1, *(chunk_shape // 2**level)),
+                dimension_separator="/",
+            )
+        label_group.attrs["multiscales"] = [
+            {
+                "name": "nuclei",
+                "axes": group.attrs["multiscales"][0]["axes"][1:],
+                "datasets": [
+                    {
+                        "path": dataset["path"],
+                        "coordinateTransformations": [
+                            {"type": "scale", "scale": [1.0, 2.0**level, 2.0**level]}
+                        ],
+                    }
+                    for level, dataset in enumerate(datasets)
+                ],
+                "version": "0.4",
+            }
+        ]
+        label_group.attrs["image-label"] = {
+            "version": "0.4",
+            "source": {"image": "../../"},
+        }
+        label_ids, areas = np.unique(labels[labels > 0], return_counts=True)
+        features = ad.AnnData(X=areas[:, None].astype(np.float32))
+        features.obs_names = label_ids.astype(str)
+        features.var_names = ["area"]
+        write_table(
+            group,
+            "nuclei",
+            features,
+            table_attrs={
+                "type": "feature_table",
+                "region": {"path": "../labels/nuclei"},
+                "instance_key": "label",
+            },
+        )
+    return zarr_url
+
+
+def write_synthetic_plate(
+    plate_url: str, wells: list[str], **image_kwargs
+) -> list[str]:
+    """Write a plate with one synthetic image per well (e.g. `B/03`).
+
+    `image_kwargs` are passed on to `write_synthetic_image`.
+    """
+    plate_group = zarr.open_group(plate_url, mode="w")
+    rows = sorted({well.split("/")[0] for well in wells})
+    columns = sorted({well.split("/")[1] for well in wells})
+    plate_group.attrs["plate"] = {
+        "rows": [{"name": row} for row in rows],
+        "columns": [{"name": column} for column in columns],
+        "wells": [
+            {
+                "path": well,
+                "rowIndex": rows.index(well.split("/")[0]),
+                "columnIndex": columns.index(well.split("/")[1]),
+            }
+            for well in wells
+        ],
+        "version": "0.4",
+    }
+    zarr_urls = []
+    for iwell, well in enumerate(wells):
+        well_group = zarr.open_group(f"{plate_url}/{well}", mode="w")
+        well_group.attrs["well"] = {"images": [{"path": "0"}], "version": "0.4"}
+        zarr_urls.append(
+            write_synthetic_image(f"{plate_url}/{well}/0", seed=iwell, **image_kwargs)
+        )
+    return zarr_urls
+
+
+@pytest.fixture(scope="function")
+def synthetic_ome_zarr(tmpdir) -> str:
+    """Single-well plate with a 2D 2x2 grid of overlapping FOVs."""
+    return write_synthetic_plate(str(tmpdir / "synthetic.zarr"), ["B/03"])[0]
+
+
+@pytest.fixture(scope="function")
+def synthetic_ome_zarr_small_chunks(tmpdir) -> str:
+    """Like `synthetic_ome_zarr`, but with 2x2 chunks per FOV."""
+    return write_synthetic_plate(
+        str(tmpdir / "synthetic.zarr"), ["B/03"], chunk_shape=(64, 64)
+    )[0]
+
+
+@pytest.fixture(scope="function")
+def synthetic_ome_zarr_with_labels(tmpdir) -> str:
+    """Like `synthetic_ome_zarr`, with a label image and its feature table."""
+    return write_synthetic_plate(
+        str(tmpdir / "synthetic.zarr"), ["B/03"], with_labels=True
+    )[0]
+
+
+@pytest.fixture(scope="function")
+def synthetic_plate(tmpdir) -> list[str]:
+    """Plate with three wells sharing the same stage positioning errors."""
+    return write_synthetic_plate(
+        str(tmpdir / "synthetic.zarr"), ["B/03", "B/04", "C/03"]
+    )
+
+
+@pytest.fixture(scope="session")
+def s3_server():
+    """Local S3-compatible server, configured as fsspec's default endpoint."""
+    moto_server = pytest.importorskip("moto.server")
+    pytest.importorskip("s3fs")
+    import fsspec
+
+    server = moto_server.ThreadedMotoServer(
+        ip_address="127.0.0.1", port=0, verbose=False
+    )
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint_url = f"http://{host}:{port}"
+    environ = {
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+    old_environ = {key: os.environ.get(key) for key in environ}
+    os.environ.update(environ)
+    old_conf = fsspec.config.conf.get("s3")
+    fsspec.config.conf["s3"] = {"client_kwargs": {"endpoint_url": endpoint_url}}
+    fs = fsspec.filesystem("s3", skip_instance_cache=True)
+    fs.mkdir("test-bucket")
+    yield "test-bucket"
+    if old_conf is None:
+        fsspec.config.conf.pop("s3")
+    else:
+        fsspec.config.conf["s3"] = old_conf
+    for key, value in old_environ.items():
+        if value is None:
+            os.environ.pop(key)
+        else:
+            os.environ[key] = value
+    server.stop()
+
+
+@pytest.fixture(scope="function")
+def s3_ome_zarr(tmpdir, s3_server) -> str:
+    """Like `synthetic_ome_zarr`, uploaded to a local S3 server.
+
+    Returns the `s3://` URL of the image.
+    """
+    import fsspec
+
+    write_synthetic_plate(str(tmpdir / "synthetic.zarr"), ["B/03"])
+    prefix = f"{s3_server}/{Path(tmpdir).name}"
+    fs = fsspec.filesystem("s3")
+    fs.put(str(tmpdir / "synthetic.zarr"), f"{prefix}/", recursive=True)
+    fs.invalidate_cache()
+    return f"s3://{prefix}/synthetic.zarr/B/03/0"
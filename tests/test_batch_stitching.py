@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+import zarr
+from fractal_tasks_core.ngff.zarr_utils import load_NgffWellMeta
+
+from fractal_ome_zarr_hcs_stitching import batch_stitching_task as batch_module
+from fractal_ome_zarr_hcs_stitching.batch_stitching_task import batch_stitching_task
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+CHANNEL = StitchingChannelInputModel(wavelength_id="A01_C01")
+
+
+def test_batch_stitching(synthetic_plate):
+    image_list_updates = batch_stitching_task(
+        zarr_urls=synthetic_plate, zarr_dir="", channel=CHANNEL
+    )["image_list_updates"]
+    assert image_list_updates == [
+        {"zarr_url": f"{zarr_url}_fused", "origin": zarr_url}
+        for zarr_url in synthetic_plate
+    ]
+
+    for zarr_url in synthetic_plate:
+        stitching_task(zarr_url=zarr_url, channel=CHANNEL, output_group_suffix="single")
+        for level in range(2):
+            np.testing.assert_array_equal(
+                zarr.open(f"{zarr_url}_fused/{level}", mode="r")[:],
+                zarr.open(f"{zarr_url}_single/{level}", mode="r")[:],
+            )
+        well_meta = load_NgffWellMeta(zarr_url.rsplit("/", 1)[0])
+        assert [image.path for image in well_meta.well.images] == [
+            "0",
+            "0_fused",
+            "0_single",
+        ]
+
+
+def test_batch_stitching_pipelines_registration(synthetic_plate, monkeypatch):
+    events = []
+
+    def record(name, function):
+        def recorded(image_context, *args, **kwargs):
+            well = image_context.zarr_url.split("/")[-3:-1]
+            events.append((name, "start", *well, threading.current_thread()))
+            result = function(image_context, *args, **kwargs)
+            if name == "fuse":
+                # give the registration of the next image time to start
+                time.sleep(0.5)
+            events.append((name, "end", *well, threading.current_thread()))
+            return result
+
+        return recorded
+
+    monkeypatch.setattr(
+        batch_module, "register_image", record("register", batch_module.register_image)
+    )
+    monkeypatch.setattr(
+        batch_module, "fuse_image", record("fuse", batch_module.fuse_image)
+    )
+    batch_stitching_task(zarr_urls=synthetic_plate, zarr_dir="", channel=CHANNEL)
+
+    steps = [event[:4] for event in events]
+    # the next image is registered while the current one is fused
+    for well, next_well in [(("B", "03"), ("B", "04")), (("B", "04"), ("C", "03"))]:
+        assert steps.index(("register", "start", *next_well)) < steps.index(
+            ("fuse", "end", *well)
+        )
+        assert steps.index(("register", "end", *well)) < steps.index(
+            ("fuse", "start", *well)
+        )
+    # all images are registered by the calling thread, and fused by another one
+    assert {event[4] for event in events if event[0] == "register"} == {
+        threading.current_thread()
+    }
+    fusion_threads = {event[4] for event in events if event[0] == "fuse"}
+    assert len(fusion_threads) == 1
+    assert threading.current_thread() not in fusion_threads
+
+
+def test_batch_stitching_skips_images_without_channel(synthetic_plate):
+    assert (
+        batch_stitching_task(
+            zarr_urls=synthetic_plate,
+            zarr_dir="",
+            channel=StitchingChannelInputModel(wavelength_id="A99_C99"),
+        )
+        is None
+    )
+
+
+def test_batch_stitching_dry_run(synthetic_plate, monkeypatch, caplog):
+    closed = []
+    close = batch_module.ImageContext.close
+
+    def record_close(image_context):
+        closed.append(image_context.zarr_url)
+        close(image_context)
+
+    monkeypatch.setattr(batch_module.ImageContext, "close", record_close)
+    caplog.set_level("INFO")
+    assert (
+        batch_stitching_task(
+            zarr_urls=synthetic_plate, zarr_dir="", channel=CHANNEL, dry_run=True
+        )
+        is None
+    )
+    assert caplog.text.count("Stitching cost estimate:") == len(synthetic_plate)
+    assert not any(os.path.exists(f"{zarr_url}_fused") for zarr_url in synthetic_plate)
+    assert closed == synthetic_plate
+
+
+def test_batch_stitching_progress_file(synthetic_plate, tmp_path):
+    progress_file = tmp_path / "progress.json"
+    batch_stitching_task(
+        zarr_urls=synthetic_plate,
+        zarr_dir="",
+        channel=CHANNEL,
+        progress_file=str(progress_file),
+    )
+    assert json.loads(progress_file.read_text())["status"] == "finished"
+
+
+def test_batch_stitching_closes_images_on_failure(synthetic_plate, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("registration failed")
+
+    closed = []
+    close = batch_module.ImageContext.close
+
+    def record_close(image_context):
+        closed.append(image_context.zarr_url)
+        close(image_context)
+
+    monkeypatch.setattr(batch_module, "register_image", fail)
+    monkeypatch.setattr(batch_module.ImageContext, "close", record_close)
+    with pytest.raises(RuntimeError, match="registration failed"):
+        batch_stitching_task(
+            zarr_urls=synthetic_plate, zarr_dir="", channel=CHANNEL, prefetch_workers=2
+        )
+    assert closed == synthetic_plate[:1]
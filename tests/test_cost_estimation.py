@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.cost_utils import estimate_stitching_cost
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import (
+    estimate_image_cost,
+    stitching_task,
+)
+from fractal_ome_zarr_hcs_stitching.utils import (
+    HierarchicalRegistrationInputModel,
+    PreRegistrationPruningMethod,
+    StitchingChannelInputModel,
+)
+
+
+def test_dry_run_reads_no_chunks(synthetic_ome_zarr, store_reads, caplog):
+    caplog.set_level("INFO")
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        dry_run=True,
+    )
+    assert not os.path.exists(f"{synthetic_ome_zarr}_fused")
+    image_chunk_reads = [
+        key
+        for key in store_reads
+        if key.startswith(synthetic_ome_zarr)
+        and "tables" not in key
+        and not os.path.basename(key).startswith(".")
+    ]
+    assert image_chunk_reads == []
+
+    report_line = next(
+        line for line in caplog.messages if line.startswith("Stitching cost estimate: ")
+    )
+    report = json.loads(report_line.removeprefix("Stitching cost estimate: "))
+    assert report["num_fovs"] == 4
+
+
+@pytest.mark.parametrize(
+    "pruning_method, expected_pairs",
+    [
+        (PreRegistrationPruningMethod.KEEPAXISALIGNED, 4),
+        (PreRegistrationPruningMethod.NOPRUNING, 6),
+    ],
+)
+def test_estimate_matches_stitching(synthetic_ome_zarr, pruning_method, expected_pairs):
+    report = estimate_stitching_cost(
+        ImageContext(synthetic_ome_zarr),
+        pre_registration_pruning_method=pruning_method,
+    )
+    assert report["num_tile_pairs"] == expected_pairs
+    assert report["max_fovs_per_output_chunk"] == 4
+    assert report["peak_memory_bytes"] > 0
+
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        pre_registration_pruning_method=pruning_method,
+    )
+    output_group = zarr.open_group(f"{synthetic_ome_zarr}_fused", mode="r")
+    for level in report["output_levels"]:
+        output_array = output_group[str(level["level"])]
+        for estimated, actual in zip(level["shape"], output_array.shape):
+            assert abs(estimated - actual) <= 4 // 2 ** level["level"] + 1
+        assert level["bytes"] == pytest.approx(output_array.nbytes, rel=0.1)
+
+
+@pytest.mark.parametrize(
+    "options, registration_levels, num_output_levels, upper_bound",
+    [
+        (dict(), [0], 2, False),
+        (dict(preview=True), [1], 1, False),
+        (
+            dict(hierarchical_registration=HierarchicalRegistrationInputModel()),
+            [0, 1],
+            2,
+            False,
+        ),
+        (dict(min_overlap_signal_fraction=0.1), [0], 2, True),
+    ],
+)
+def test_estimate_image_cost_options(
+    synthetic_ome_zarr, options, registration_levels, num_output_levels, upper_bound
+):
+    report = estimate_image_cost(ImageContext(synthetic_ome_zarr), **options)
+    assert report["registration_levels"] == registration_levels
+    assert len(report["output_levels"]) == num_output_levels
+    assert report["num_tile_pairs"] == 4
+    assert report["num_tile_pairs_is_upper_bound"] == upper_bound
+
+
+def test_estimate_image_cost_incremental(synthetic_ome_zarr):
+    report = estimate_image_cost(ImageContext(synthetic_ome_zarr), incremental=True)
+    assert report["num_tile_pairs"] == 4
+
+    # Once stitched, an unchanged image registers no pairs
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        incremental=True,
+    )
+    report = estimate_image_cost(ImageContext(synthetic_ome_zarr), incremental=True)
+    assert report["num_tile_pairs"] == 0
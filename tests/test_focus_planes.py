@@ -0,0 +1,59 @@
+import numpy as np
+import zarr
+from scipy import ndimage
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.utils import get_focus_z_slices, register_fovs
+
+from .conftest import SYNTHETIC_TILE_SHAPE, write_synthetic_image
+from .test_plate_stitching import assert_corrections_match_stage_errors
+
+FOCUS_PLANES = {"FOV_1": 1, "FOV_2": 3, "FOV_3": 0, "FOV_4": 4}
+
+
+def write_defocused_image(zarr_url: str) -> str:
+    """3D synthetic image of the same sample in all planes, in which each FOV
+    is only in focus in one plane."""
+    write_synthetic_image(zarr_url, num_z=5)
+    for level in range(2):
+        array = zarr.open(f"{zarr_url}/{level}")
+        data = np.repeat(array[:, :1], 5, axis=1)
+        tile_shape = np.array(SYNTHETIC_TILE_SHAPE) // 2**level
+        for ifov, focus_plane in enumerate(FOCUS_PLANES.values()):
+            tile = (
+                0,
+                slice(None),
+                slice((ifov // 2) * tile_shape[0], (ifov // 2 + 1) * tile_shape[0]),
+                slice((ifov % 2) * tile_shape[1], (ifov % 2 + 1) * tile_shape[1]),
+            )
+            for z in range(5):
+                if z != focus_plane:
+                    data[tile][z] = ndimage.gaussian_filter(
+                        data[tile][z], sigma=2 * abs(z - focus_plane) / 2**level
+                    )
+        array[:] = data
+    return zarr_url
+
+
+def test_get_focus_z_slices(tmp_path):
+    zarr_url = write_defocused_image(str(tmp_path / "plate.zarr/B/03/0"))
+    image_context = ImageContext(zarr_url)
+
+    z_slices = get_focus_z_slices(image_context, reg_channel_index=0)
+    assert z_slices == [slice(z, z + 1) for z in FOCUS_PLANES.values()]
+
+    # Windows are shifted to stay within the stack
+    z_slices = get_focus_z_slices(image_context, reg_channel_index=0, num_planes=3)
+    assert z_slices == [slice(0, 3), slice(2, 5), slice(0, 3), slice(2, 5)]
+
+
+def test_get_focus_z_slices_2d(synthetic_ome_zarr):
+    assert get_focus_z_slices(ImageContext(synthetic_ome_zarr), 0) is None
+
+
+def test_register_fovs_on_focus_planes(tmp_path):
+    zarr_url = write_defocused_image(str(tmp_path / "plate.zarr/B/03/0"))
+    fov_corrections = register_fovs(
+        ImageContext(zarr_url), reg_channel_index=0, registration_focus_planes=1
+    )
+    assert_corrections_match_stage_errors(fov_corrections)
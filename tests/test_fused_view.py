@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import (
+    StitchingChannelInputModel,
+    read_fov_corrections,
+)
+from fractal_ome_zarr_hcs_stitching.view_utils import get_fused_view, open_fused_array
+
+FOV_CORRECTIONS = {
+    "FOV_2": {"y": 0.4, "x": -10.7},
+    "FOV_3": {"y": -9.2, "x": 0.3},
+    "FOV_4": {"y": -10.5, "x": -9.6},
+}
+
+
+def test_fused_view_matches_stitching(synthetic_ome_zarr_small_chunks):
+    zarr_url = synthetic_ome_zarr_small_chunks
+    with pytest.raises(ValueError, match="No FOV corrections recorded"):
+        get_fused_view(zarr_url)
+
+    stitching_task(
+        zarr_url=zarr_url, channel=StitchingChannelInputModel(wavelength_id="A01_C01")
+    )
+    fov_corrections = read_fov_corrections(f"{zarr_url}_fused")
+    assert sorted(fov_corrections) == ["FOV_1", "FOV_2", "FOV_3", "FOV_4"]
+
+    view = get_fused_view(zarr_url)
+    fused = zarr.open(f"{zarr_url}_fused/0", mode="r")[:]
+    assert view.dims == ("c", "z", "y", "x")
+    assert view.shape == fused.shape
+    assert view.data.chunks == fuse_fovs(ImageContext(zarr_url), fov_corrections).chunks
+    np.testing.assert_array_equal(view.values, fused)
+
+    region = view.isel(y=slice(0, 64), x=slice(64, 128))
+    np.testing.assert_array_equal(region.values, fused[..., :64, 64:128])
+
+
+def test_fused_view_fuses_read_chunks_only(synthetic_ome_zarr_small_chunks):
+    fused = fuse_fovs(ImageContext(synthetic_ome_zarr_small_chunks), FOV_CORRECTIONS)
+    expected = fused.values
+    assert fused.data.numblocks[-2:] == (4, 4)
+    assert expected.shape[-2:] != (256, 256)
+
+    fused_array = open_fused_array(fused)
+    store = fused_array.store._store
+    np.testing.assert_array_equal(fused_array[..., :64, :100], expected[..., :64, :100])
+    assert store.chunks_fused == 2
+
+    # cached chunks are not fused again
+    np.testing.assert_array_equal(fused_array[..., :50, :50], expected[..., :50, :50])
+    assert store.chunks_fused == 2
+    assert fused_array.store.hits == 1
+
+    # chunks at the end of the axes are cut to the image
+    np.testing.assert_array_equal(fused_array[:], expected)
+    assert store.chunks_fused == 16
+
+    # least recently used chunks are evicted from a small cache
+    chunk_mb = fused.dtype.itemsize * np.prod(fused.data.chunksize) / 2**20
+    fused_array = open_fused_array(fused, cache_size_mb=1.5 * chunk_mb)
+    store = fused_array.store._store
+    for _ in range(2):
+        np.testing.assert_array_equal(
+            fused_array[..., :64, :100], expected[..., :64, :100]
+        )
+    assert store.chunks_fused == 4
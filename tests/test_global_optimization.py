@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.optimization_utils import solve_translations
+from fractal_ome_zarr_hcs_stitching.utils import GlobalOptimizationMethod, register_fovs
+
+from .test_plate_stitching import assert_corrections_match_stage_errors
+
+
+def make_grid_problem(num_rows, num_columns, noise=0.05, seed=0):
+    """Pairs of horizontal and vertical neighbors on a grid of tiles, with
+    shifts measured between their true translations."""
+    rng = np.random.default_rng(seed)
+    num_tiles = num_rows * num_columns
+    translations = rng.normal(scale=3, size=(num_tiles, 2))
+    index = np.arange(num_tiles).reshape(num_rows, num_columns)
+    pairs = np.concatenate(
+        [
+            np.stack([index[:, :-1].ravel(), index[:, 1:].ravel()], axis=1),
+            np.stack([index[:-1].ravel(), index[1:].ravel()], axis=1),
+        ]
+    )
+    shifts = (
+        translations[pairs[:, 0]]
+        - translations[pairs[:, 1]]
+        + rng.normal(scale=noise, size=(len(pairs), 2))
+    )
+    return translations, pairs, shifts
+
+
+def assert_translations_close(translations, expected, atol):
+    # Translations are only defined up to a global offset
+    residuals = translations - expected
+    np.testing.assert_allclose(residuals - residuals.mean(0), 0, atol=atol)
+
+
+def test_solve_translations():
+    expected, pairs, shifts = make_grid_problem(20, 30)
+    translations, inliers = solve_translations(len(expected), pairs, shifts)
+    assert translations.shape == expected.shape
+    assert inliers.all()
+    assert_translations_close(translations, expected, atol=0.25)
+    # The tile with the largest sum of weights stays in place
+    assert np.sum(np.all(translations == 0, axis=1)) == 1
+
+
+def test_solve_translations_rejects_outliers():
+    expected, pairs, shifts = make_grid_problem(20, 30)
+    rng = np.random.default_rng(1)
+    outliers = rng.choice(len(pairs), 20, replace=False)
+    shifts[outliers] += rng.choice([-1, 1], size=(20, 2)) * rng.uniform(
+        5, 20, size=(20, 2)
+    )
+
+    translations, _ = solve_translations(len(expected), pairs, shifts)
+    with pytest.raises(AssertionError):
+        assert_translations_close(translations, expected, atol=0.5)
+
+    translations, inliers = solve_translations(
+        len(expected), pairs, shifts, outlier_threshold=1
+    )
+    assert set(np.flatnonzero(~inliers)) == set(outliers)
+    assert_translations_close(translations, expected, atol=0.25)
+
+
+def test_solve_translations_keeps_bridges_and_components():
+    # Two separate chains of tiles, the second one with an inconsistent pair
+    pairs = np.array([[0, 1], [1, 2], [3, 4], [4, 5]])
+    shifts = np.array([[1.0, 0], [1.0, 0], [0, 2.0], [0, 50.0]])
+    translations, inliers = solve_translations(
+        6, pairs, shifts, weights=[1, 2, 1, 1], outlier_threshold=1
+    )
+    assert inliers.all()
+    np.testing.assert_allclose(
+        translations,
+        [[1, 0], [0, 0], [-1, 0], [0, 2], [0, 0], [0, -50]],
+    )
+
+
+def test_register_fovs_sparse(synthetic_ome_zarr):
+    image_context = ImageContext(synthetic_ome_zarr)
+    fov_corrections = register_fovs(
+        image_context,
+        reg_channel_index=0,
+        global_optimization_method=GlobalOptimizationMethod.SPARSELEASTSQUARES,
+    )
+    assert_corrections_match_stage_errors(fov_corrections)
+
+    iterative_corrections = register_fovs(image_context, reg_channel_index=0)
+    for fov, correction in fov_corrections.items():
+        for dim, value in correction.items():
+            assert value == pytest.approx(iterative_corrections[fov][dim], abs=0.1)
@@ -0,0 +1,118 @@
+import numpy as np
+
+from fractal_ome_zarr_hcs_stitching import hierarchical_utils
+from fractal_ome_zarr_hcs_stitching.hierarchical_utils import (
+    register_fovs_hierarchically,
+)
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import (
+    GlobalOptimizationMethod,
+    HierarchicalRegistrationInputModel,
+    PreRegistrationPruningMethod,
+    StitchingChannelInputModel,
+    read_fov_corrections,
+    register_fovs,
+)
+
+from .test_plate_stitching import assert_corrections_match_stage_errors
+
+
+def test_register_fovs_hierarchically(synthetic_ome_zarr, caplog):
+    image_context = ImageContext(synthetic_ome_zarr)
+    caplog.set_level("INFO")
+
+    # Reliable pairs are not refined, but registered on the full resolution
+    # in windows around the estimate
+    fov_corrections = register_fovs_hierarchically(
+        image_context,
+        reg_channel_index=0,
+        hierarchical_registration=HierarchicalRegistrationInputModel(min_quality=-1),
+    )
+    assert "Registering 4 tile pairs on level 1" in caplog.text
+    assert "Refining the other 4 tile pairs on level 0 in windows of 128" in (
+        caplog.text
+    )
+    assert "Refined 0 of 4 tile pairs" in caplog.text
+    assert_corrections_match_stage_errors(fov_corrections, atol=0.2)
+    assert fov_corrections != register_fovs(
+        image_context,
+        reg_channel_index=0,
+        registration_resolution_level=1,
+        global_optimization_method=GlobalOptimizationMethod.SPARSELEASTSQUARES,
+    )
+
+    # Smaller windows read less data
+    caplog.clear()
+    fov_corrections = register_fovs_hierarchically(
+        image_context,
+        reg_channel_index=0,
+        hierarchical_registration=HierarchicalRegistrationInputModel(
+            min_quality=-1, window_size=32
+        ),
+    )
+    assert "in windows of 32 pixels" in caplog.text
+    assert_corrections_match_stage_errors(fov_corrections)
+
+    # Refined pairs are registered on the full resolution around the estimate
+    caplog.clear()
+    fov_corrections = register_fovs_hierarchically(
+        image_context,
+        reg_channel_index=0,
+        hierarchical_registration=HierarchicalRegistrationInputModel(min_quality=1),
+    )
+    assert "Refining 4 of 4 tile pairs on level 0" in caplog.text
+    assert "Refined 4 of 4 tile pairs" in caplog.text
+    assert_corrections_match_stage_errors(fov_corrections, atol=0.2)
+
+
+def test_register_fovs_hierarchically_refines_new_outliers(
+    synthetic_ome_zarr, monkeypatch, caplog
+):
+    image_context = ImageContext(synthetic_ome_zarr)
+    caplog.set_level("INFO")
+    pixel_size = image_context.ngff_image_meta.pixel_sizes_zyx[0][-1]
+    register_pairs = hierarchical_utils._register_pairs
+
+    calls = []
+
+    def register_pairs_with_error(msims, pairs, *args, **kwargs):
+        shifts, qualities = register_pairs(msims, pairs, *args, **kwargs)
+        calls.append(pairs)
+        if len(calls) == 1:
+            # Shifting one of all pairs by 6 pixels of level 0 on the coarse
+            # level leaves it a residual of about 1.5 pixels of level 1, which
+            # is accepted there, but of 3 pixels of level 0
+            shifts[0, -1] += 6 * pixel_size
+        return shifts, qualities
+
+    monkeypatch.setattr(
+        hierarchical_utils, "_register_pairs", register_pairs_with_error
+    )
+    fov_corrections = register_fovs_hierarchically(
+        image_context,
+        reg_channel_index=0,
+        hierarchical_registration=HierarchicalRegistrationInputModel(min_quality=-1),
+        pre_registration_pruning_method=PreRegistrationPruningMethod.NOPRUNING,
+    )
+    assert "Refining 1 of 6 tile pairs on level 0: [('FOV_1', 'FOV_2')]" in (
+        caplog.text
+    )
+    assert "Refined 1 of 6 tile pairs, kept 6 pairs" in caplog.text
+    # the other pairs are registered on level 0 in windows
+    assert "Refining the other 5 tile pairs on level 0" in caplog.text
+    assert_corrections_match_stage_errors(fov_corrections, atol=0.2)
+
+
+def test_stitching_with_hierarchical_registration(synthetic_ome_zarr):
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        hierarchical_registration=HierarchicalRegistrationInputModel(),
+    )
+    fov_corrections = read_fov_corrections(f"{synthetic_ome_zarr}_fused")
+    assert sorted(fov_corrections) == ["FOV_1", "FOV_2", "FOV_3", "FOV_4"]
+    assert_corrections_match_stage_errors(fov_corrections)
+    assert not np.allclose(
+        [list(correction.values()) for correction in fov_corrections.values()], 0
+    )
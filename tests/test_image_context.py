@@ -0,0 +1,60 @@
+import numpy as np
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import (
+    StitchingChannelInputModel,
+    get_sim_from_multiscales,
+)
+
+
+def test_image_context_reads_metadata_once(ngff_example_zarr, store_reads):
+    image_context = ImageContext(ngff_example_zarr)
+    for resolution in [0, 1]:
+        sim = get_sim_from_multiscales(
+            ngff_example_zarr, resolution=resolution, image_context=image_context
+        )
+        assert list(sim.coords["c"].values) == ["DAPI"]
+    omero_channel = StitchingChannelInputModel(label="DAPI").get_omero_channel(
+        ngff_example_zarr, image_context=image_context
+    )
+    assert omero_channel.index == 0
+    assert len(image_context.fov_roi_table) == 2
+    assert len(image_context.fov_roi_table) == 2
+
+    assert store_reads[f"{ngff_example_zarr}/.zattrs"] == 1
+    assert store_reads[f"{ngff_example_zarr}/0/.zarray"] == 1
+    assert store_reads[f"{ngff_example_zarr}/tables/FOV_ROI_table/X/0.0"] == 1
+
+
+def test_image_context_names_arrays_uniquely(ngff_example_zarr):
+    image_context = ImageContext(ngff_example_zarr)
+    sim = get_sim_from_multiscales(ngff_example_zarr, image_context=image_context)
+    assert (
+        get_sim_from_multiscales(
+            ngff_example_zarr, image_context=image_context
+        ).data.name
+        == sim.data.name
+    )
+
+    # A context opened after rewriting the image doesn't share graph keys
+    # with the earlier one
+    array = zarr.open_array(f"{ngff_example_zarr}/0", mode="r+")
+    array[:] = array[:] + 1
+    new_sim = get_sim_from_multiscales(
+        ngff_example_zarr, image_context=ImageContext(ngff_example_zarr)
+    )
+    assert new_sim.data.name != sim.data.name
+    np.testing.assert_array_equal(new_sim.data.compute(), array[:])
+
+
+def test_stitching_task_reads_input_metadata_once(ngff_example_zarr, store_reads):
+    stitching_task(
+        zarr_url=ngff_example_zarr,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        registration_resolution_level=1,
+    )
+    assert store_reads[f"{ngff_example_zarr}/.zattrs"] == 1
+    assert store_reads[f"{ngff_example_zarr}/tables/FOV_ROI_table/.zattrs"] == 1
+    assert store_reads[f"{ngff_example_zarr}/tables/FOV_ROI_table/X/0.0"] == 1
@@ -0,0 +1,140 @@
+import time
+
+import anndata as ad
+import numpy as np
+import pytest
+import zarr
+from fractal_tasks_core.tables import write_table
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs, write_fused_image
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.incremental_utils import (
+    get_fov_checksums,
+    read_stitching_state,
+)
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import (
+    HierarchicalRegistrationInputModel,
+    StitchingChannelInputModel,
+)
+
+from .test_plate_stitching import assert_corrections_match_stage_errors
+
+
+def test_incremental_stitching(synthetic_ome_zarr_small_chunks, caplog):
+    zarr_url = synthetic_ome_zarr_small_chunks
+    output_zarr_url = f"{zarr_url}_fused"
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    caplog.set_level("INFO")
+
+    # The first run stitches in full and records the state
+    stitching_task(zarr_url=zarr_url, channel=channel, incremental=True)
+    assert "No state of a previous stitching run found" in caplog.text
+    state = read_stitching_state(output_zarr_url)
+    assert sorted(state["fov_checksums"]) == ["FOV_1", "FOV_2", "FOV_3", "FOV_4"]
+
+    caplog.clear()
+    stitching_task(zarr_url=zarr_url, channel=channel, incremental=True)
+    assert "Changed or added FOVs: []" in caplog.text
+    assert "Recomputing 0 of 16 output blocks" in caplog.text
+    assert read_stitching_state(output_zarr_url) == state
+
+    # Re-acquire the bottom right FOV with a different intensity
+    input_array = zarr.open(f"{zarr_url}/0", mode="r+")
+    input_array[..., 128:, 128:] = input_array[..., 128:, 128:] // 2
+    caplog.clear()
+    stitching_task(zarr_url=zarr_url, channel=channel, incremental=True)
+    assert "Changed or added FOVs: ['FOV_4']" in caplog.text
+    assert (
+        "Registering tile pairs [('FOV_2', 'FOV_4'), ('FOV_3', 'FOV_4')]" in caplog.text
+    )
+    assert "Recomputing 9 of 16 output blocks" in caplog.text
+    new_state = read_stitching_state(output_zarr_url)
+    assert new_state["fov_checksums"]["FOV_4"] != state["fov_checksums"]["FOV_4"]
+    for fov in ["FOV_1", "FOV_2", "FOV_3"]:
+        assert new_state["fov_corrections"][fov] == state["fov_corrections"][fov]
+    assert_corrections_match_stage_errors(new_state["fov_corrections"])
+
+    # The updated image equals a full fusion with the same corrections
+    image_context = ImageContext(zarr_url)
+    reference_url = f"{zarr_url}_reference"
+    write_fused_image(
+        image_context,
+        fuse_fovs(image_context, new_state["fov_corrections"]),
+        reference_url,
+    )
+    for level in range(image_context.ngff_image_meta.num_levels):
+        np.testing.assert_array_equal(
+            zarr.open(f"{output_zarr_url}/{level}", mode="r")[:],
+            zarr.open(f"{reference_url}/{level}", mode="r")[:],
+        )
+
+
+@pytest.mark.parametrize("content_checksums", [False, True])
+def test_get_fov_checksums(synthetic_ome_zarr_small_chunks, content_checksums):
+    zarr_url = synthetic_ome_zarr_small_chunks
+    image_context = ImageContext(zarr_url)
+    checksums = get_fov_checksums(image_context, content_checksums=content_checksums)
+    chunk_reads = [
+        key
+        for key in image_context.counting_store.key_reads
+        if key.startswith("0/") and not key.endswith(".zarray")
+    ]
+    # Without content checksums, the chunks are listed but not read
+    num_chunks = image_context.get_array(0).nchunks
+    assert len(chunk_reads) == (num_chunks if content_checksums else 0)
+
+    # Rewrite the chunks of the bottom right FOV with the same content
+    time.sleep(0.05)
+    input_array = zarr.open(f"{zarr_url}/0", mode="r+")
+    input_array[..., 128:, 128:] = input_array[..., 128:, 128:]
+    new_checksums = get_fov_checksums(
+        ImageContext(zarr_url), content_checksums=content_checksums
+    )
+    changed_fovs = [fov for fov in checksums if new_checksums[fov] != checksums[fov]]
+    assert changed_fovs == ([] if content_checksums else ["FOV_4"])
+
+
+def test_incremental_stitching_ignores_hierarchical_registration(
+    synthetic_ome_zarr, caplog
+):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    kwargs = dict(
+        zarr_url=synthetic_ome_zarr,
+        channel=channel,
+        incremental=True,
+        hierarchical_registration=HierarchicalRegistrationInputModel(),
+    )
+    stitching_task(**kwargs)
+    assert "only used when stitching in full" not in caplog.text
+    stitching_task(**kwargs)
+    assert "only used when stitching in full" in caplog.text
+
+
+def test_incremental_stitching_with_removed_fov(synthetic_ome_zarr, caplog):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=channel, incremental=True)
+
+    fov_roi_table = ad.read_zarr(f"{synthetic_ome_zarr}/tables/FOV_ROI_table")
+    write_table(
+        zarr.open_group(synthetic_ome_zarr, mode="r+"),
+        "FOV_ROI_table",
+        fov_roi_table[:3],
+        overwrite=True,
+        table_attrs={"type": "roi_table"},
+    )
+    caplog.set_level("INFO")
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=channel, incremental=True)
+    assert "FOVs ['FOV_4'] were removed" in caplog.text
+    state = read_stitching_state(f"{synthetic_ome_zarr}_fused")
+    assert sorted(state["fov_checksums"]) == ["FOV_1", "FOV_2", "FOV_3"]
+
+
+def test_incremental_stitching_overwriting_input(synthetic_ome_zarr):
+    with pytest.raises(ValueError, match="overwrite_input"):
+        stitching_task(
+            zarr_url=synthetic_ome_zarr,
+            channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+            overwrite_input=True,
+            incremental=True,
+        )
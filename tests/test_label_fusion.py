@@ -0,0 +1,43 @@
+import anndata as ad
+import numpy as np
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+
+def test_stitching_with_labels(synthetic_ome_zarr_with_labels):
+    zarr_url = synthetic_ome_zarr_with_labels
+    stitching_task(
+        zarr_url=zarr_url,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        fuse_labels=True,
+    )
+    output_zarr_url = f"{zarr_url}_fused"
+
+    output_group = zarr.open_group(output_zarr_url, mode="r")
+    assert output_group["labels"].attrs["labels"] == ["nuclei"]
+    fused_image = output_group["0"][0]
+    fused_labels = output_group["labels/nuclei/0"][:]
+    assert fused_labels.shape == fused_image.shape
+    assert fused_labels.dtype == np.uint32
+    assert output_group["labels/nuclei/1"].shape == output_group["1"].shape[1:]
+
+    # No new label IDs appear, and labels match the fused intensities
+    input_labels = zarr.open(f"{zarr_url}/labels/nuclei/0")[:]
+    assert set(np.unique(fused_labels)) <= set(np.unique(input_labels))
+    assert np.mean((fused_labels > 0) == (fused_image > 600)) > 0.95
+
+    # Each FOV is moved to its position in the fused image, where it covers
+    # the center of the FOV outside of the overlaps
+    fov_roi_table = ad.read_zarr(f"{output_zarr_url}/tables/FOV_ROI_table").to_df()
+    for fov_number, (_, row) in enumerate(fov_roi_table.iterrows(), start=1):
+        y, x = int(row["y_micrometer"]), int(row["x_micrometer"])
+        tile_labels = fused_labels[0, y + 40 : y + 88, x + 40 : x + 88]
+        tile_ids = tile_labels[tile_labels > 0] // 1000
+        assert np.all(tile_ids == fov_number)
+
+    features = ad.read_zarr(f"{output_zarr_url}/tables/nuclei")
+    assert set(features.obs_names) == set(
+        ad.read_zarr(f"{zarr_url}/tables/nuclei").obs_names
+    )
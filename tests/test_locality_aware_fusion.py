@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.image_context import (
+    FusionBlockOrder,
+    LocalityAwareFusionInputModel,
+)
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+
+def test_sort_blocks():
+    blocks = list(np.ndindex(2, 1, 4, 4))
+    assert FusionBlockOrder.ROWS.sort_blocks(blocks[::-1]) == blocks
+
+    hilbert = FusionBlockOrder.HILBERT.sort_blocks(blocks)
+    assert sorted(hilbert) == blocks
+    # planes one after the other, each along a continuous curve
+    assert [block[0] for block in hilbert] == [0] * 16 + [1] * 16
+    for previous, block in zip(hilbert[:16], hilbert[1:16]):
+        assert np.abs(np.subtract(block, previous)).sum() == 1
+
+    # grids that aren't a power of two are fused along a cropped curve
+    blocks = list(np.ndindex(1, 1, 3, 5))
+    assert sorted(FusionBlockOrder.HILBERT.sort_blocks(blocks)) == blocks
+
+
+@pytest.mark.parametrize("block_order", list(FusionBlockOrder))
+def test_stitching_with_locality_aware_fusion(
+    synthetic_ome_zarr_small_chunks, block_order, caplog
+):
+    zarr_url = synthetic_ome_zarr_small_chunks
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    # registering on level 1 leaves the full resolution to fusion
+    stitching_task(
+        zarr_url=zarr_url,
+        channel=channel,
+        registration_resolution_level=1,
+        output_group_suffix="default",
+    )
+    assert "Fusion read 16 input chunks" in caplog.text
+    assert "a re-read ratio of 1.00" not in caplog.text
+
+    caplog.clear()
+    stitching_task(
+        zarr_url=zarr_url,
+        channel=channel,
+        registration_resolution_level=1,
+        locality_aware_fusion=LocalityAwareFusionInputModel(block_order=block_order),
+    )
+    assert "Fusion read 16 input chunks" in caplog.text
+    assert "a re-read ratio of 1.00" in caplog.text
+    assert "Decoded input chunk cache:" in caplog.text
+    np.testing.assert_array_equal(
+        zarr.open(f"{zarr_url}_fused/0")[:],
+        zarr.open(f"{zarr_url}_default/0")[:],
+    )
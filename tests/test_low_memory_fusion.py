@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.cost_utils import estimate_stitching_cost
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+from .conftest import write_synthetic_image
+
+FOV_CORRECTIONS = {
+    "FOV_2": {"y": 0.4, "x": -10.7},
+    "FOV_3": {"y": -9.2, "x": 0.3},
+    "FOV_4": {"y": -10.5, "x": -9.6},
+}
+
+
+@pytest.mark.parametrize("z_chunk", [1, 2])
+def test_fuse_low_memory_matches_fusion(tmp_path, z_chunk):
+    zarr_url = write_synthetic_image(str(tmp_path / "image.zarr"), num_z=4)
+    # with chunks of several planes, blocks are fused in 3D
+    array = zarr.open(f"{zarr_url}/0", mode="r")
+    data = array[:]
+    zarr.open(
+        f"{zarr_url}/0",
+        mode="w",
+        shape=data.shape,
+        chunks=(1, z_chunk, *array.chunks[-2:]),
+        dtype=data.dtype,
+        dimension_separator="/",
+    )[:] = data
+
+    image_context = ImageContext(zarr_url)
+    fused = fuse_fovs(image_context, FOV_CORRECTIONS)
+    fused_low_memory = fuse_fovs(image_context, FOV_CORRECTIONS, low_memory_fusion=True)
+    assert fused_low_memory.dims == fused.dims
+    assert fused_low_memory.dtype == fused.dtype
+    assert fused_low_memory.data.chunks == fused.data.chunks
+    assert list(fused_low_memory.coords["c"].values) == list(fused.coords["c"].values)
+    for dim in ["y", "x"]:
+        np.testing.assert_allclose(
+            fused_low_memory.coords[dim].values, fused.coords[dim].values
+        )
+    # rounded to the nearest gray value, while the reference fusion truncates
+    difference = fused_low_memory.data.compute().astype(int) - fused.data.compute()
+    assert difference.min() >= 0
+    assert difference.max() <= 1
+
+
+def test_stitching_with_low_memory_fusion(synthetic_ome_zarr):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=channel,
+        output_group_suffix="low_memory",
+        low_memory_fusion=True,
+    )
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=channel)
+    image_context = ImageContext(synthetic_ome_zarr)
+    for level in range(image_context.ngff_image_meta.num_levels):
+        fused = zarr.open(f"{synthetic_ome_zarr}_fused/{level}", mode="r")[:]
+        fused_low_memory = zarr.open(
+            f"{synthetic_ome_zarr}_low_memory/{level}", mode="r"
+        )[:]
+        assert fused_low_memory.dtype == fused.dtype
+        assert np.abs(fused_low_memory.astype(int) - fused).max() <= 1
+
+    report = estimate_stitching_cost(image_context)
+    report_low_memory = estimate_stitching_cost(image_context, low_memory_fusion=True)
+    assert report_low_memory["peak_memory_bytes"] < report["peak_memory_bytes"]
@@ -0,0 +1,160 @@
+import copy
+
+import fsspec
+import numpy as np
+import pytest
+import zarr
+from fractal_tasks_core.ngff.zarr_utils import load_NgffWellMeta
+from fractal_tasks_core.pyramids import build_pyramid as build_local_pyramid
+
+from fractal_ome_zarr_hcs_stitching import io_utils
+from fractal_ome_zarr_hcs_stitching.io_utils import replace_image
+from fractal_ome_zarr_hcs_stitching.progress_utils import ProgressReporter
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+CHANNEL = StitchingChannelInputModel(wavelength_id="A01_C01")
+
+
+def assert_images_equal(zarr_url, reference_zarr_url, num_levels):
+    for level in range(num_levels):
+        np.testing.assert_array_equal(
+            zarr.open(f"{zarr_url}/{level}", mode="r")[:],
+            zarr.open(f"{reference_zarr_url}/{level}", mode="r")[:],
+        )
+
+
+@pytest.mark.parametrize("prefetch_workers", [None, 4])
+def test_stitching_on_object_store(s3_ome_zarr, synthetic_ome_zarr, prefetch_workers):
+    stitching_task(
+        zarr_url=s3_ome_zarr, channel=CHANNEL, prefetch_workers=prefetch_workers
+    )
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=CHANNEL)
+    assert_images_equal(f"{s3_ome_zarr}_fused", f"{synthetic_ome_zarr}_fused", 2)
+    well_meta = load_NgffWellMeta(s3_ome_zarr.rsplit("/", 1)[0])
+    assert [image.path for image in well_meta.well.images] == ["0", "0_fused"]
+
+
+def test_build_pyramid_uses_fractal_tasks_core_on_local_paths(
+    s3_ome_zarr, synthetic_ome_zarr, monkeypatch
+):
+    zarr_urls = []
+
+    def recording_build_local_pyramid(*, zarrurl, **kwargs):
+        zarr_urls.append(zarrurl)
+        build_local_pyramid(zarrurl=zarrurl, **kwargs)
+
+    monkeypatch.setattr(io_utils, "build_local_pyramid", recording_build_local_pyramid)
+    chunks_done = []
+    for zarr_url in (synthetic_ome_zarr, s3_ome_zarr):
+        with ProgressReporter("pyramid", 1) as progress:
+            io_utils.build_pyramid(
+                zarr_url, num_levels=2, coarsening_xy=2, progress=progress
+            )
+        chunks_done.append(progress.chunks_done)
+    assert zarr_urls == [synthetic_ome_zarr]
+    assert chunks_done[0] == chunks_done[1] > 0
+    assert_images_equal(s3_ome_zarr, synthetic_ome_zarr, 2)
+
+
+def test_overwrite_input_on_object_store(s3_ome_zarr, synthetic_ome_zarr):
+    stitching_task(zarr_url=s3_ome_zarr, channel=CHANNEL, overwrite_input=True)
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=CHANNEL)
+    assert_images_equal(s3_ome_zarr, f"{synthetic_ome_zarr}_fused", 2)
+    fs, path = fsspec.core.url_to_fs(s3_ome_zarr)
+    assert not fs.exists(f"{path}_fused")
+    well_meta = load_NgffWellMeta(s3_ome_zarr.rsplit("/", 1)[0])
+    assert [image.path for image in well_meta.well.images] == ["0"]
+
+
+def test_interrupted_replace_image_can_be_repeated(s3_ome_zarr, monkeypatch):
+    new_zarr_url = f"{s3_ome_zarr}_new"
+    fs, path = fsspec.core.url_to_fs(s3_ome_zarr)
+    fs.copy(path, f"{path}_new", recursive=True)
+    fs.invalidate_cache()
+    expected = zarr.open(f"{new_zarr_url}/0", mode="r")[:]
+
+    # fsspec caches filesystem instances, so `replace_image` uses this one
+    copied = []
+    copy = fs.copy
+
+    def failing_copy(path1, path2, **kwargs):
+        if copied:
+            raise OSError("Connection lost")
+        copied.extend(path1)
+        return copy(path1, path2, **kwargs)
+
+    monkeypatch.setattr(fs, "copy", failing_copy)
+    with pytest.raises(OSError, match="Connection lost"):
+        replace_image(s3_ome_zarr, new_zarr_url)
+    # the chunks were copied over the target image before any metadata,
+    # which was not deleted, while the new image is untouched
+    assert copied
+    assert not any(
+        file.rsplit("/", 1)[-1] in io_utils.ZARR_METADATA_KEYS for file in copied
+    )
+    fs.invalidate_cache()
+    assert fs.exists(f"{path}/.zattrs")
+    np.testing.assert_array_equal(zarr.open(f"{new_zarr_url}/0", mode="r")[:], expected)
+
+    monkeypatch.setattr(fs, "copy", copy)
+    replace_image(s3_ome_zarr, new_zarr_url)
+    np.testing.assert_array_equal(zarr.open(f"{s3_ome_zarr}/0", mode="r")[:], expected)
+    assert not fs.exists(f"{path}_new")
+
+
+def test_replace_image_deletes_stale_objects_last(s3_ome_zarr, monkeypatch):
+    new_zarr_url = f"{s3_ome_zarr}_new"
+    fs, path = fsspec.core.url_to_fs(s3_ome_zarr)
+    fs.copy(path, f"{path}_new", recursive=True)
+    # the new image has a single level
+    fs.rm(f"{path}_new/1", recursive=True)
+    fs.invalidate_cache()
+
+    calls = []
+    copy, rm = fs.copy, fs.rm
+
+    def recording_copy(path1, path2, **kwargs):
+        calls.append("copy")
+        return copy(path1, path2, **kwargs)
+
+    def recording_rm(files, **kwargs):
+        calls.append(("rm", files))
+        return rm(files, **kwargs)
+
+    monkeypatch.setattr(fs, "copy", recording_copy)
+    monkeypatch.setattr(fs, "rm", recording_rm)
+    replace_image(s3_ome_zarr, new_zarr_url)
+    # chunks and metadata are copied before anything is deleted
+    assert calls[:2] == ["copy", "copy"]
+    stale_files = calls[2][1]
+    assert stale_files and all(file.startswith(f"{path}/1/") for file in stale_files)
+    assert calls[3] == ("rm", f"{path}_new")
+    fs.invalidate_cache()
+    assert not fs.exists(f"{path}/1")
+    assert zarr.open(f"{s3_ome_zarr}/0", mode="r").shape
+
+
+def test_update_well_metadata_with_concurrent_edit(s3_ome_zarr, monkeypatch):
+    well_url = s3_ome_zarr.rsplit("/", 1)[0]
+    read_well_attrs = io_utils._read_well_attrs
+    edited = []
+
+    def read_and_edit(url):
+        attrs = read_well_attrs(url)
+        if not edited:
+            # another task adds an image right after the first read
+            edited.append(True)
+            concurrent = copy.deepcopy(attrs)
+            concurrent["well"]["images"].append({"path": "0_other"})
+            zarr.open_group(url, mode="r+").attrs.put(concurrent)
+        return attrs
+
+    monkeypatch.setattr(io_utils, "_read_well_attrs", read_and_edit)
+    io_utils.update_well_metadata(well_url, "0", "0_fused")
+    well_meta = load_NgffWellMeta(well_url)
+    assert [image.path for image in well_meta.well.images] == [
+        "0",
+        "0_fused",
+        "0_other",
+    ]
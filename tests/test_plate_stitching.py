@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import zarr
+from multiview_stitcher import msi_utils
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.init_plate_stitching_task import (
+    init_plate_stitching_task,
+)
+from fractal_ome_zarr_hcs_stitching.plate_stitching_task import (
+    plate_stitching_task,
+)
+from fractal_ome_zarr_hcs_stitching.utils import (
+    PreRegistrationPruningMethod,
+    StitchingChannelInputModel,
+    combine_fov_corrections,
+    get_registration_msims,
+    get_registration_pairs,
+    register_fovs,
+)
+
+from .conftest import SYNTHETIC_STAGE_ERRORS, write_synthetic_image
+
+
+def assert_corrections_match_stage_errors(fov_corrections, atol=0.6):
+    # Corrections are only defined up to a global offset
+    corrections = np.array(
+        [[fov_corrections[fov][dim] for dim in ("y", "x")] for fov in fov_corrections]
+    )
+    errors = np.array([SYNTHETIC_STAGE_ERRORS[fov] for fov in fov_corrections])
+    residuals = corrections + errors
+    np.testing.assert_allclose(residuals - residuals.mean(0), 0, atol=atol)
+
+
+def test_register_fovs(synthetic_ome_zarr):
+    fov_corrections = register_fovs(
+        ImageContext(synthetic_ome_zarr), reg_channel_index=0
+    )
+    assert sorted(fov_corrections) == sorted(SYNTHETIC_STAGE_ERRORS)
+    assert_corrections_match_stage_errors(fov_corrections)
+
+
+@pytest.mark.parametrize(
+    "pruning_method, expected_pairs",
+    [
+        (
+            PreRegistrationPruningMethod.KEEPAXISALIGNED,
+            [(0, 1), (0, 2), (1, 3), (2, 3)],
+        ),
+        (
+            PreRegistrationPruningMethod.NOPRUNING,
+            [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)],
+        ),
+    ],
+)
+def test_get_registration_pairs(synthetic_ome_zarr, pruning_method, expected_pairs):
+    image_context = ImageContext(synthetic_ome_zarr)
+    msims, _ = get_registration_msims(image_context, reg_channel_index=0)
+    assert "c" not in msi_utils.get_sim_from_msim(msims[0]).dims
+    overlaps = get_registration_pairs(
+        image_context, msims, pre_registration_pruning_method=pruning_method
+    )
+    assert list(overlaps) == expected_pairs
+    assert all(overlap > 0 for overlap in overlaps.values())
+
+
+def test_combine_fov_corrections():
+    combined = combine_fov_corrections(
+        [
+            {"FOV_1": {"y": 0.0, "x": 0.0}, "FOV_2": {"y": 2.0, "x": 4.0}},
+            {"FOV_1": {"y": -2.0, "x": -4.0}, "FOV_2": {"y": 0.0, "x": 0.0}},
+            {},
+        ]
+    )
+    assert combined == {"FOV_1": {"y": -1.0, "x": -2.0}, "FOV_2": {"y": 1.0, "x": 2.0}}
+
+
+@pytest.mark.parametrize("reference_wells", [None, ["C/03"]])
+def test_plate_stitching(synthetic_plate, reference_wells, caplog):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    parallelization_list = init_plate_stitching_task(
+        zarr_urls=synthetic_plate,
+        zarr_dir="",
+        channel=channel,
+        reference_wells=reference_wells,
+    )["parallelization_list"]
+
+    assert [p["zarr_url"] for p in parallelization_list] == synthetic_plate
+    init_args = parallelization_list[0]["init_args"]
+    expected_reference = synthetic_plate[0 if reference_wells is None else 2]
+    assert init_args["reference_zarr_urls"] == [expected_reference]
+    assert_corrections_match_stage_errors(init_args["fov_corrections"])
+    # the reference image is fused with the corrections registered on it
+    for parallelization_item in parallelization_list:
+        is_reference = parallelization_item["zarr_url"] == expected_reference
+        assert parallelization_item["init_args"]["is_reference"] == is_reference
+        if is_reference:
+            assert parallelization_item["init_args"][
+                "fov_corrections"
+            ] == register_fovs(ImageContext(expected_reference), reg_channel_index=0)
+
+    for parallelization_item in parallelization_list:
+        image_list_updates = plate_stitching_task(
+            **parallelization_item, num_verification_pairs=2
+        )
+        zarr_url = parallelization_item["zarr_url"]
+        assert image_list_updates == {
+            "image_list_updates": [
+                {"zarr_url": f"{zarr_url}_fused", "origin": zarr_url}
+            ]
+        }
+
+    assert "Registering all tile pairs" not in caplog.text
+    fused_shapes = {zarr.open(f"{url}_fused/0").shape for url in synthetic_plate}
+    assert len(fused_shapes) == 1
+
+
+def test_plate_stitching_falls_back_to_registration(synthetic_plate, caplog):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    parallelization_list = init_plate_stitching_task(
+        zarr_urls=synthetic_plate[:2],
+        zarr_dir="",
+        channel=channel,
+        reference_wells=["B/03"],
+    )["parallelization_list"]
+
+    # Overwrite the second well with different stage errors
+    zarr_url = synthetic_plate[1]
+    write_synthetic_image(
+        zarr_url,
+        stage_errors=dict.fromkeys(SYNTHETIC_STAGE_ERRORS, (0, 0)),
+    )
+    plate_stitching_task(
+        zarr_url=zarr_url,
+        init_args=parallelization_list[1]["init_args"],
+        num_verification_pairs=2,
+    )
+    assert "Registering all tile pairs of this image instead" in caplog.text
+
+
+def test_init_plate_stitching_missing_reference_well(synthetic_plate):
+    with pytest.raises(ValueError, match="not part of the processed wells"):
+        init_plate_stitching_task(
+            zarr_urls=synthetic_plate,
+            zarr_dir="",
+            channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+            reference_wells=["H12"],
+        )
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+
+def test_preview_stitching(synthetic_ome_zarr, store_reads):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    well_url = os.path.dirname(synthetic_ome_zarr)
+    well_images = zarr.open_group(well_url, mode="r").attrs["well"]["images"]
+
+    image_list_updates = stitching_task(
+        zarr_url=synthetic_ome_zarr, channel=channel, preview=True
+    )
+    assert image_list_updates is None
+    assert zarr.open_group(well_url, mode="r").attrs["well"]["images"] == well_images
+    # Only the coarsest level of the input is read
+    assert not [
+        key for key in store_reads if key.startswith(f"{synthetic_ome_zarr}/0/")
+    ]
+
+    preview_url = f"{synthetic_ome_zarr}_fused_preview"
+    preview_group = zarr.open_group(preview_url, mode="r")
+    datasets = preview_group.attrs["multiscales"][0]["datasets"]
+    assert [dataset["path"] for dataset in datasets] == ["0"]
+    assert datasets[0]["coordinateTransformations"][0]["scale"] == [1, 1, 2, 2]
+    assert "well_ROI_table" in preview_group["tables"]
+    preview = preview_group["0"][:]
+
+    # The preview resembles the coarse level of a full stitching
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=channel)
+    fused = zarr.open(f"{synthetic_ome_zarr}_fused/1", mode="r")[:]
+    assert all(abs(a - b) <= 1 for a, b in zip(preview.shape, fused.shape))
+    shape = np.minimum(preview.shape, fused.shape)
+    region = tuple(slice(0, n) for n in shape)
+    # the input pyramid is subsampled, the one of the fused image averaged
+    assert np.corrcoef(preview[region].ravel(), fused[region].ravel())[0, 1] > 0.9
+
+
+def test_preview_stitching_overwriting_input(synthetic_ome_zarr):
+    with pytest.raises(ValueError, match="overwrite_input"):
+        stitching_task(
+            zarr_url=synthetic_ome_zarr,
+            channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+            overwrite_input=True,
+            preview=True,
+        )
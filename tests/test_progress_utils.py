@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.progress_utils import ProgressReporter
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+
+def test_progress_reporter(tmp_path, caplog):
+    progress_file = tmp_path / "progress" / "progress.json"
+    array = da.ones((4, 4), chunks=2, dtype="uint8")
+    with caplog.at_level(logging.INFO):
+        with ProgressReporter(
+            "test", total_chunks=4, interval=0.05, progress_file=str(progress_file)
+        ) as progress:
+            assert json.loads(progress_file.read_text())["chunks_done"] == 0
+            store = progress.wrap_store(zarr.storage.MemoryStore())
+            output = zarr.open_array(
+                store, mode="w", shape=(2, 4), chunks=(2, 2), dtype="uint8"
+            )
+            progress.track(array[:2]).to_zarr(output)
+            time.sleep(0.2)
+            report = json.loads(progress_file.read_text())
+            assert report["status"] == "running"
+            assert report["chunks_done"] == 2
+            assert report["eta_seconds"] >= 0
+            progress.update(2)
+    assert "Test: 2/4 chunks (50.0%)" in caplog.text
+    assert "Test: 4/4 chunks (100.0%)" in caplog.text
+    report = json.loads(progress_file.read_text())
+    assert report["status"] == "finished"
+    assert report["written_mb_per_second"] > 0
+    assert report["eta_seconds"] is None
+
+    with pytest.raises(RuntimeError):
+        with ProgressReporter("test", 4, progress_file=str(progress_file)):
+            raise RuntimeError
+    assert json.loads(progress_file.read_text())["status"] == "failed"
+
+
+@pytest.mark.parametrize("prefetch_workers", [None, 2])
+def test_stitching_with_progress_file(
+    synthetic_ome_zarr_small_chunks, tmp_path, prefetch_workers, caplog
+):
+    progress_file = tmp_path / "progress.json"
+    with caplog.at_level(logging.INFO):
+        stitching_task(
+            zarr_url=synthetic_ome_zarr_small_chunks,
+            channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+            prefetch_workers=prefetch_workers,
+            progress_file=str(progress_file),
+        )
+    fused = zarr.open_array(f"{synthetic_ome_zarr_small_chunks}_fused/0", mode="r")
+    num_chunks = int(np.prod(fused.nchunks))
+    assert f"Fusion: {num_chunks}/{num_chunks} chunks (100.0%)" in caplog.text
+    report = json.loads(progress_file.read_text())
+    assert report["stage"] == "pyramid"
+    assert report["status"] == "finished"
+    assert report["chunks_done"] == report["chunks_total"] > 0
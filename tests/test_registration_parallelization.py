@@ -0,0 +1,77 @@
+import dask.threaded
+import pytest
+from dask.callbacks import Callback
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.utils import (
+    RegistrationParallelizationInputModel,
+    estimate_pair_registration_bytes,
+    register_fovs,
+)
+
+from .conftest import write_synthetic_image
+from .test_plate_stitching import assert_corrections_match_stage_errors
+
+
+@pytest.mark.parametrize(
+    "parallelization, expected_workers",
+    [
+        (dict(max_parallel_pairs=8), 8),
+        (dict(max_parallel_pairs=8, memory_limit_mb=100, pair_memory_mb=30), 3),
+        (dict(max_parallel_pairs=2, memory_limit_mb=100, pair_memory_mb=30), 2),
+        (dict(memory_limit_mb=10, pair_memory_mb=30), 1),
+        (dict(max_parallel_pairs=8, memory_limit_mb=4), 4),
+    ],
+)
+def test_get_num_workers(parallelization, expected_workers):
+    model = RegistrationParallelizationInputModel(**parallelization)
+    assert model.get_num_workers(pair_memory_bytes=2**20) == expected_workers
+
+
+def test_register_fovs_3d_with_bounded_parallelism(tmp_path, monkeypatch):
+    zarr_url = write_synthetic_image(str(tmp_path / "image.zarr"), num_z=4)
+    image_context = ImageContext(zarr_url)
+    pair_bytes = estimate_pair_registration_bytes(
+        image_context, registration_on_z_proj=False
+    )
+    # 4 planes of 128x128 pixels per tile, two tiles per pair
+    assert pair_bytes == 2 * 4 * 128 * 128 * 40
+
+    num_workers_used = []
+    original_get = dask.threaded.get
+
+    def recording_get(*args, num_workers=None, **kwargs):
+        num_workers_used.append(num_workers)
+        return original_get(*args, num_workers=num_workers, **kwargs)
+
+    # Pairs registered by each computation, whose tiles are in memory together
+    pairs_per_computation = []
+
+    class PairCounter(Callback):
+        def _start(self, dsk):
+            pairs_per_computation.append(
+                sum(
+                    get_key_name(key).startswith("phase_correlation_registration")
+                    for key in dsk
+                )
+            )
+
+    monkeypatch.setattr(dask.threaded, "get", recording_get)
+    with PairCounter():
+        fov_corrections = register_fovs(
+            image_context,
+            reg_channel_index=0,
+            registration_on_z_proj=False,
+            registration_parallelization=RegistrationParallelizationInputModel(
+                max_parallel_pairs=4,
+                memory_limit_mb=2.5 * pair_bytes / 2**20,
+            ),
+        )
+    # The 4 pairs of the 2x2 grid are registered 2 at a time
+    assert [n for n in pairs_per_computation if n] == [2, 2]
+    assert num_workers_used == [2, 2]
+    assert_corrections_match_stage_errors(fov_corrections)
+
+
+def get_key_name(key) -> str:
+    return key[0] if isinstance(key, tuple) else key
@@ -0,0 +1,59 @@
+import numpy as np
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.image_context import ImageContext
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.utils import (
+    StitchingChannelInputModel,
+    get_pairs_with_signal,
+    read_fov_corrections,
+    register_fovs,
+)
+
+from .conftest import write_synthetic_image
+
+
+def test_get_pairs_with_signal(tmp_path):
+    zarr_url = write_synthetic_image(
+        str(tmp_path / "image.zarr"), empty_fovs=("FOV_2",)
+    )
+    image_context = ImageContext(zarr_url)
+    all_pairs = get_pairs_with_signal(
+        image_context, reg_channel_index=0, min_overlap_signal_fraction=0.0
+    )
+    signal_pairs = get_pairs_with_signal(
+        image_context, reg_channel_index=0, min_overlap_signal_fraction=0.1
+    )
+    assert len(all_pairs) == 6
+    assert sorted(signal_pairs) == [(0, 2), (0, 3), (2, 3)]
+
+
+def test_register_fovs_skips_empty_tiles(tmp_path):
+    zarr_url = write_synthetic_image(
+        str(tmp_path / "image.zarr"), empty_fovs=("FOV_2",)
+    )
+    fov_corrections = register_fovs(
+        ImageContext(zarr_url), reg_channel_index=0, min_overlap_signal_fraction=0.1
+    )
+    # The empty FOV stays at its stage position
+    assert fov_corrections["FOV_2"] == {"y": 0.0, "x": 0.0}
+    assert fov_corrections["FOV_1"] != {"y": 0.0, "x": 0.0}
+
+
+def test_stitching_with_signal_pruning(tmp_path):
+    zarr_url = write_synthetic_image(
+        str(tmp_path / "image.zarr"), empty_fovs=("FOV_4",)
+    )
+    stitching_task(
+        zarr_url=zarr_url,
+        channel=StitchingChannelInputModel(wavelength_id="A01_C01"),
+        min_overlap_signal_fraction=0.1,
+    )
+    fused = zarr.open(f"{zarr_url}_fused/0", mode="r")
+    assert fused.ndim == 4
+    assert np.any(fused[:])
+
+    # The empty FOV stays at its stage position, the others are registered
+    fov_corrections = read_fov_corrections(f"{zarr_url}_fused")
+    assert fov_corrections["FOV_4"] == {"y": 0.0, "x": 0.0}
+    assert fov_corrections["FOV_2"] != {"y": 0.0, "x": 0.0}
@@ -0,0 +1,197 @@
+import os
+import threading
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+
+from fractal_ome_zarr_hcs_stitching.fusion_utils import fuse_fovs, get_input_chunk_keys
+from fractal_ome_zarr_hcs_stitching.image_context import (
+    ChunkCacheInputModel,
+    ImageContext,
+)
+from fractal_ome_zarr_hcs_stitching.stitching_task import stitching_task
+from fractal_ome_zarr_hcs_stitching.store_utils import (
+    CountingStore,
+    DecodedChunkCache,
+    DiskLRUStoreCache,
+    PrefetchingStore,
+    log_chunk_rereads,
+)
+from fractal_ome_zarr_hcs_stitching.utils import StitchingChannelInputModel
+
+
+def test_disk_lru_store_cache(tmp_path):
+    store = zarr.storage.MemoryStore()
+    for i in range(4):
+        store[f"chunk_{i}"] = bytes([i]) * 100
+
+    cache = DiskLRUStoreCache(store, max_size=250, cache_dir=str(tmp_path))
+    assert cache["chunk_0"] == store["chunk_0"]
+    assert cache["chunk_0"] == store["chunk_0"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Reading two more chunks evicts the least recently used one
+    cache["chunk_1"]
+    cache["chunk_2"]
+    assert sorted(os.listdir(cache.cache_dir)) == ["chunk_1", "chunk_2"]
+    cache["chunk_0"]
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # Values larger than the cache are read through without being cached
+    store["large"] = bytes(300)
+    assert cache["large"] == bytes(300)
+    assert "large" not in os.listdir(cache.cache_dir)
+
+    cache.close()
+    assert not os.path.exists(cache.cache_dir)
+
+
+@pytest.mark.parametrize("use_disk", [False, True])
+def test_stitching_with_input_cache(synthetic_ome_zarr, tmp_path, use_disk, caplog):
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=channel,
+        output_group_suffix="uncached",
+    )
+    caplog.clear()
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=channel,
+        input_cache=ChunkCacheInputModel(
+            max_size_mb=10, cache_dir=str(tmp_path) if use_disk else None
+        ),
+    )
+    assert "Input chunk cache:" in caplog.text
+    # the task removes the disk cache when done
+    assert not any(path.name.startswith("zarr_cache_") for path in tmp_path.iterdir())
+    np.testing.assert_array_equal(
+        zarr.open(f"{synthetic_ome_zarr}_fused/0")[:],
+        zarr.open(f"{synthetic_ome_zarr}_uncached/0")[:],
+    )
+
+
+def test_counting_store():
+    store = CountingStore(zarr.storage.MemoryStore())
+    array = zarr.open_array(
+        store,
+        mode="w",
+        shape=(4, 4),
+        chunks=(2, 2),
+        dtype="uint8",
+        compressor=None,
+        write_empty_chunks=False,
+    )
+    metadata_bytes = store.bytes_written
+    array[:] = 1
+    assert store.bytes_written - metadata_bytes == 16
+    array[:2] = 0
+    # empty chunks are deleted instead of written
+    assert store.bytes_written - metadata_bytes == 16
+    assert len([key for key in store if not key.startswith(".")]) == 2
+
+    reopened = zarr.open_array(store, mode="r")
+    bytes_read = store.bytes_read
+    np.testing.assert_array_equal(reopened[2:], 1)
+    assert store.bytes_read - bytes_read == 8
+
+    # reads are counted per key, and re-reads of chunks are reported
+    reads_before = store.key_reads.copy()
+    np.testing.assert_array_equal(reopened[2:, :2], 1)
+    assert store.key_reads - reads_before == {"1.0": 1}
+    assert log_chunk_rereads(store, reads_before) == 1
+    assert log_chunk_rereads(store) == 1.5
+
+
+def test_decoded_chunk_cache():
+    store = CountingStore(zarr.storage.MemoryStore())
+    array = zarr.open_array(
+        store, mode="w", shape=(4, 4), chunks=(2, 2), dtype="uint8", compressor=None
+    )
+    expected = np.arange(16, dtype="uint8").reshape(4, 4)
+    array[:] = expected
+
+    cache = DecodedChunkCache(max_size=8)
+    data = da.from_array(
+        array, chunks=array.chunks, getitem=cache.getitem, asarray=False
+    )
+    for _ in range(2):
+        np.testing.assert_array_equal(data[:2].compute(), expected[:2])
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert store.key_reads["0.0"] == store.key_reads["0.1"] == 1
+
+    # cached chunks are shared and read-only
+    with pytest.raises(ValueError, match="read-only"):
+        cache.getitem(array, (slice(0, 2), slice(0, 2)))[0, 0] = 1
+
+    # least recently used chunks are evicted
+    np.testing.assert_array_equal(data[2:].compute(), expected[2:])
+    assert cache._current_size == 8
+    np.testing.assert_array_equal(data[:2].compute(), expected[:2])
+    assert store.key_reads["0.0"] == store.key_reads["0.1"] == 2
+
+
+def test_prefetching_store():
+    store = zarr.storage.MemoryStore()
+    for i in range(4):
+        store[f"chunk_{i}"] = bytes([i]) * 100
+
+    prefetching_store = PrefetchingStore(store, max_workers=2)
+    prefetching_store.prefetch(["chunk_0", "chunk_1", "missing"])
+    assert prefetching_store["chunk_0"] == store["chunk_0"]
+    with pytest.raises(KeyError):
+        prefetching_store["missing"]
+    assert prefetching_store.getitems(["chunk_1", "chunk_2", "missing"]) == {
+        "chunk_1": store["chunk_1"],
+        "chunk_2": store["chunk_2"],
+    }
+    assert (prefetching_store.prefetched, prefetching_store.prefetch_hits) == (3, 4)
+
+    # Prefetched values serve repeated reads until they are discarded
+    assert prefetching_store["chunk_0"] == store["chunk_0"]
+    assert prefetching_store.prefetch_hits == 5
+    prefetching_store.discard(["chunk_0"])
+    assert prefetching_store["chunk_0"] == store["chunk_0"]
+    assert prefetching_store.prefetch_hits == 5
+    prefetching_store.close()
+
+
+def test_get_input_chunk_keys(synthetic_ome_zarr_small_chunks):
+    image_context = ImageContext(synthetic_ome_zarr_small_chunks)
+    fused = fuse_fovs(image_context, {})
+    chunk_keys = get_input_chunk_keys(image_context, {}, fused)
+
+    assert set(chunk_keys) == set(np.ndindex(fused.data.numblocks))
+    # The first block is only covered by the top-left FOV, and reaches into
+    # its second row and column of chunks by the interpolation margin
+    assert chunk_keys[(0, 0, 0, 0)] == [
+        "0/0/0/0/0",
+        "0/0/0/0/1",
+        "0/0/0/1/0",
+        "0/0/0/1/1",
+    ]
+    all_keys = {key for keys in chunk_keys.values() for key in keys}
+    assert all_keys == {f"0/0/0/{y}/{x}" for y in range(4) for x in range(4)}
+
+
+def test_stitching_with_prefetching(synthetic_ome_zarr_small_chunks, caplog):
+    synthetic_ome_zarr = synthetic_ome_zarr_small_chunks
+    channel = StitchingChannelInputModel(wavelength_id="A01_C01")
+    stitching_task(
+        zarr_url=synthetic_ome_zarr,
+        channel=channel,
+        output_group_suffix="no_prefetch",
+    )
+    caplog.clear()
+    stitching_task(zarr_url=synthetic_ome_zarr, channel=channel, prefetch_workers=4)
+    assert "Input prefetching:" in caplog.text
+    # the task shuts down the prefetching threads when done
+    assert not any(
+        thread.name.startswith("prefetch") for thread in threading.enumerate()
+    )
+    np.testing.assert_array_equal(
+        zarr.open(f"{synthetic_ome_zarr}_fused/0")[:],
+        zarr.open(f"{synthetic_ome_zarr}_no_prefetch/0")[:],
+    )